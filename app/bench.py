@@ -0,0 +1,220 @@
+"""Benchmark suite: runs a fixed query matrix on generated databases, checked against sqlite3.
+
+    python3 -m app.bench --scales 10k,100k --repeat 5 --output bench.json
+"""
+import argparse, json, os, platform, random, sqlite3, subprocess, sys, time, tracemalloc
+import app.main as db
+
+GENERATOR_VERSION = 1
+SCALES = {"10k":10_000,"100k":100_000,"1m":1_000_000,"10m":10_000_000}
+COUNTRIES = 200
+WIDE_COLS = 16
+INSERT_CHUNK = 10_000
+
+class Shape:
+    NARROW = "narrow"
+    WIDE = "wide"
+
+def table_columns(shape):
+    if shape == Shape.NARROW:
+        return [("name","text"),("country","text"),("score","integer")]
+    cols = [("name","text"),("country","text"),("score","integer")]
+    for idx in range(len(cols),WIDE_COLS):
+        cols.append((f"c{idx}","integer" if idx % 2 else "text"))
+    return cols
+
+def _row_values(rng,rowid,cols):
+    vals = [rowid]
+    for name, dtype in cols:
+        if name == "country":
+            vals.append(f"country_{rng.randrange(COUNTRIES):03d}")
+        elif dtype == "integer":
+            vals.append(rng.randrange(-1_000_000,1_000_000))
+        else:
+            vals.append("".join(rng.choices("abcdefghijklmnopqrstuvwxyz ",k=rng.randrange(4,40))))
+    return vals
+
+def generate_db(path,shape,rows,indexed,seed):
+    """Writes a table t of rows rows, the same for a given shape, scale and seed."""
+    rng = random.Random(seed)
+    cols = table_columns(shape)
+    tmp_path = path+".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute(f"CREATE TABLE t (id integer primary key, {', '.join(name+' '+dtype for name, dtype in cols)})")
+        insert = f"INSERT INTO t VALUES ({', '.join('?'*(len(cols)+1))})"
+        for start in range(1,rows+1,INSERT_CHUNK):
+            conn.executemany(insert,(_row_values(rng,rowid,cols) for rowid in range(start,min(start+INSERT_CHUNK,rows+1))))
+        if indexed:
+            conn.execute("CREATE INDEX idx_t_country ON t (country)")
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path,path)
+
+def database_path(data_dir,shape,rows,indexed,seed):
+    """Cached database for the given parameters, generated on first use."""
+    name = f"{shape}_{rows}_{'idx' if indexed else 'noidx'}_s{seed}_v{GENERATOR_VERSION}.db"
+    path = os.path.join(data_dir,name)
+    if not os.path.exists(path):
+        os.makedirs(data_dir,exist_ok=True)
+        generate_db(path,shape,rows,indexed,seed)
+    return path
+
+class BenchQuery:
+    def __init__(self,name,sql,params=None):
+        self.name = name
+        self.sql = sql
+        self.params = params
+
+    def bind(self,rng,rows):
+        return self.params(rng,rows) if self.params else ()
+
+QUERIES = [
+    BenchQuery("full_scan","SELECT * FROM t"),
+    BenchQuery("count","SELECT COUNT(*) FROM t"),
+    BenchQuery("indexed_eq","SELECT id, name FROM t WHERE country = ?",lambda rng, rows: (f"country_{rng.randrange(COUNTRIES):03d}",)),
+    BenchQuery("rowid_lookup","SELECT * FROM t WHERE id = ?",lambda rng, rows: (rng.randrange(1,rows+1),)),
+    BenchQuery("projection","SELECT name, score FROM t"),
+]
+
+def percentile(values,pct):
+    """Linear interpolation between the closest ranks of the sorted values."""
+    values = sorted(values)
+    pos = (len(values)-1)*pct/100
+    low = int(pos)
+    high = min(low+1,len(values)-1)
+    return values[low]+(values[high]-values[low])*(pos-low)
+
+def pages_read(pg_cache):
+    # Every access to a mapped page goes to the OS page cache
+    return pg_cache.hits if isinstance(pg_cache,db.MmapPageCache) else pg_cache.misses
+
+def check_result(path,query,params,rows):
+    conn = sqlite3.connect(f"file:{path}?mode=ro",uri=True)
+    try:
+        expected = conn.execute(query.sql,params).fetchall()
+    finally:
+        conn.close()
+    return sorted(expected) == sorted(map(tuple,rows))
+
+def run_query(path,catalog,query,params):
+    with open(path,"rb") as db_file:
+        pg_cache = db.open_page_cache(db_file)
+        try:
+            start = time.perf_counter()
+            rows = list(db.execute_select(query.sql,catalog,pg_cache,params))
+            elapsed = time.perf_counter()-start
+            return rows, elapsed, pages_read(pg_cache)
+        finally:
+            pg_cache.close()
+
+def traced_run(path,catalog,query,params):
+    # Tracing slows every allocation, so the peak is taken in an untimed run
+    tracemalloc.start()
+    try:
+        result, _, _ = run_query(path,catalog,query,params)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_query(path,catalog,query,rows,repeat,seed,check):
+    """Times query over repeat runs after a traced warm-up run."""
+    rng = random.Random(seed)
+    params = query.bind(rng,rows)
+    result, peak_alloc = traced_run(path,catalog,query,params)
+    correct = check_result(path,query,params,result) if check else None
+    latencies = []
+    row_counts = []
+    page_counts = []
+    for _ in range(repeat):
+        params = query.bind(rng,rows)
+        result, elapsed, pages = run_query(path,catalog,query,params)
+        if check:
+            # Each run binds new values, so each result is checked
+            correct = correct and check_result(path,query,params,result)
+        latencies.append(elapsed)
+        row_counts.append(len(result))
+        page_counts.append(pages)
+    median = percentile(latencies,50)
+    return {"query":query.name,"sql":query.sql,"runs":repeat,"rows":sum(row_counts)//repeat,
+            "latency_ms":{"min":min(latencies)*1e3,"p50":median*1e3,"p90":percentile(latencies,90)*1e3,
+                          "p99":percentile(latencies,99)*1e3,"max":max(latencies)*1e3},
+            "rows_per_sec":sum(row_counts)/sum(latencies) if sum(latencies) else None,
+            "pages_read":sum(page_counts)//repeat,"peak_alloc_kb":peak_alloc//1024,"correct":correct}
+
+def git_revision():
+    try:
+        return subprocess.run(["git","rev-parse","HEAD"],capture_output=True,text=True,check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scales,shapes,indexes,queries,repeat,data_dir,seed,check,log=None):
+    results = []
+    for scale in scales:
+        for shape in shapes:
+            for indexed in indexes:
+                path = database_path(data_dir,shape,SCALES[scale],indexed,seed)
+                with open(path,"rb") as db_file:
+                    pg_cache = db.open_page_cache(db_file)
+                    catalog = db.load_catalog(pg_cache)
+                    db_pages = os.path.getsize(path)//pg_cache.pg_sz
+                    pg_cache.close()
+                for query in queries:
+                    result = bench_query(path,catalog,query,SCALES[scale],repeat,seed,check)
+                    result.update(scale=scale,shape=shape,indexed=indexed,db_pages=db_pages)
+                    results.append(result)
+                    if log:
+                        print(f"{scale:>5} {shape:<6} {'idx' if indexed else 'noidx':<5} {query.name:<13}"
+                              f" p50 {result['latency_ms']['p50']:10.2f} ms  {result['rows']:>9} rows"
+                              f"{'' if result['correct'] is not False else '  MISMATCH'}",file=log,flush=True)
+    return results
+
+def report(results,args):
+    return {"generated_at":time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime()),
+            "revision":git_revision(),"python":platform.python_version(),"platform":platform.platform(),
+            "config":{"repeat":args.repeat,"seed":args.seed,"check":not args.no_check,
+                      "env":{key:val for key, val in sorted(os.environ.items()) if key.startswith("SQLITE_")}},
+            "results":results}
+
+def _split(value,choices,option):
+    items = [item.strip().lower() for item in value.split(",") if item.strip()]
+    for item in items:
+        if item not in choices:
+            raise argparse.ArgumentTypeError(f"Unknown {option}: {item}")
+    return items
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m app.bench",description="Runs the query benchmark matrix and writes a JSON report.")
+    parser.add_argument("--scales",default="10k,100k",help="comma separated, of "+", ".join(SCALES))
+    parser.add_argument("--shapes",default="narrow,wide",help="comma separated, of narrow, wide")
+    parser.add_argument("--indexes",default="both",choices=["both","with","without"])
+    parser.add_argument("--queries",default=",".join(query.name for query in QUERIES))
+    parser.add_argument("--repeat",type=int,default=5)
+    parser.add_argument("--seed",type=int,default=42)
+    parser.add_argument("--data-dir",default="bench_data",help="where generated databases are kept")
+    parser.add_argument("--output",default="-",help="JSON report path, - for stdout")
+    parser.add_argument("--no-check",action="store_true",help="skip comparing results with sqlite3")
+    args = parser.parse_args(argv)
+    try:
+        scales = _split(args.scales,SCALES,"scale")
+        shapes = _split(args.shapes,(Shape.NARROW,Shape.WIDE),"shape")
+        names = _split(args.queries,[query.name for query in QUERIES],"query")
+    except argparse.ArgumentTypeError as err:
+        parser.error(str(err))
+    indexes = {"both":[False,True],"with":[True],"without":[False]}[args.indexes]
+    queries = [query for query in QUERIES if query.name in names]
+    results = run_benchmarks(scales,shapes,indexes,queries,max(1,args.repeat),args.data_dir,args.seed,not args.no_check,sys.stderr)
+    output = json.dumps(report(results,args),indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output,"w") as out_file:
+            out_file.write(output+"\n")
+    return 1 if any(result["correct"] is False for result in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""DB-API style interface for running queries in process.
+
+    from app.dbapi import connect
+    with connect("companies.db") as conn:
+        for row in conn.execute("SELECT id, name FROM companies WHERE country = ?",("chad",)):
+            ...
+"""
+import weakref
+from itertools import islice
+
+apilevel = "2.0"
+# Threads may share the module, but not connections: a page cache is not locked
+threadsafety = 1
+paramstyle = "qmark"
+
+class Error(Exception):
+    def __init__(self,msg="Database interface error"):
+        self.message = msg
+        super().__init__(self.message)
+
+class ProgrammingError(Error):
+    def __init__(self,msg="Cannot operate on a closed connection"):
+        super().__init__(msg)
+
+def _engine():
+    import app.main as db
+    return db
+
+class _Rows:
+    """Rows as tuples, active on conn from execute until they run out or are closed or dropped."""
+    def __init__(self,conn,rows):
+        self._conn = conn
+        self._rows = iter(rows)
+        conn._active.add(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return tuple(next(self._rows))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self._conn._active.discard(self)
+        close = getattr(self._rows,"close",None)
+        if close is not None:
+            close()
+
+class Connection:
+    """An open database, reloaded before each statement if another process wrote to it."""
+    # The reload waits while a cursor has rows left to fetch, as they read the current cache
+    def __init__(self,path,use_mmap=None,profile=None):
+        db = _engine()
+        self.path = path
+        self.profile = db.PROFILE_QUERIES if profile is None else profile
+        self._use_mmap = db.USE_MMAP if use_mmap is None else use_mmap
+        # Unbuffered, so pages and the change counter are never served stale
+        # from a read buffer after another process writes
+        self._db_file = open(path,"rb",buffering=0)
+        self._pg_cache = None
+        self._catalog = None
+        self._change_counter = None
+        # Weak, so a cursor dropped with rows left is let go of at once
+        self._active = weakref.WeakSet()
+        self._refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._db_file is None
+
+    @property
+    def page_cache(self):
+        self._check()
+        return self._pg_cache
+
+    @property
+    def catalog(self):
+        self._check()
+        return self._catalog
+
+    def _check(self):
+        if self._db_file is None:
+            raise ProgrammingError()
+
+    def _refresh(self):
+        db = _engine()
+        counter = db.read_change_counter(self._db_file)
+        if counter == self._change_counter or self._active:
+            return
+        if self._pg_cache is not None:
+            self._pg_cache.close()
+        self._pg_cache = db.open_page_cache(self._db_file,self._use_mmap)
+        self._catalog = db.load_catalog(self._pg_cache,self._catalog)
+        self._change_counter = counter
+
+    def cursor(self):
+        self._check()
+        return Cursor(self)
+
+    def execute(self,sql,params=()):
+        """Runs sql on a new cursor and returns the cursor."""
+        return self.cursor().execute(sql,params)
+
+    def table_names(self):
+        self._check()
+        self._refresh()
+        return list(self._catalog.tables)
+
+    def commit(self):
+        # Connections only read, so there is never anything to commit
+        self._check()
+
+    def close(self):
+        if self._db_file is None:
+            return
+        if self._pg_cache is not None:
+            self._pg_cache.close()
+        self._db_file.close()
+        self._db_file = self._pg_cache = self._catalog = None
+
+class Cursor:
+    """Runs statements on a Connection, leaving their rows unread until fetched."""
+    arraysize = 1
+
+    def __init__(self,connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self.stats = None
+        self._rows = None
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._result())
+
+    def _check(self):
+        if self._closed:
+            raise ProgrammingError("Cannot operate on a closed cursor")
+        self.connection._check()
+
+    def _result(self):
+        self._check()
+        if self._rows is None:
+            raise ProgrammingError("No statement has been executed")
+        return self._rows
+
+    def _close_rows(self):
+        if self._rows is not None:
+            self._rows.close()
+            self._rows = None
+
+    def execute(self,sql,params=()):
+        self._check()
+        self._close_rows()
+        conn = self.connection
+        conn._refresh()
+        db = _engine()
+        stats = db.QueryStats(sql) if conn.profile else None
+        rows = db.execute_select(sql,conn._catalog,conn._pg_cache,params,stats)
+        self.description = tuple((name,None,None,None,None,None,None) for name in db.prepare(sql,conn._catalog).column_names())
+        self.stats = stats
+        self._rows = _Rows(conn,rows)
+        return self
+
+    def fetchone(self):
+        return next(self._result(),None)
+
+    def fetchmany(self,size=None):
+        return list(islice(self._result(),self.arraysize if size is None else size))
+
+    def fetchall(self):
+        return list(self._result())
+
+    def setinputsizes(self,sizes):
+        pass
+
+    def setoutputsize(self,size,column=None):
+        pass
+
+    def close(self):
+        self._close_rows()
+        self._closed = True
+
+def connect(path,use_mmap=None,profile=None):
+    """Opens the database at path for reading; profile defaults to SQLITE_STATS."""
+    return Connection(path,use_mmap,profile)
@@ -1,12 +1,16 @@
-import sys, struct
+import copy, heapq, math, mmap, operator, os, re, sys, struct, threading, time
 import app.sql_parser as sp
 
-from dataclasses import dataclass
+from array import array
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import accumulate, islice
 
-# import sqlparse - available if you need it!
+# Modules only some queries need, such as concurrent.futures, pickle and
+# tempfile, are imported where they are used to keep the engine quick to import
 
-database_file_path = sys.argv[1]
-command = sys.argv[2]
+# import sqlparse - available if you need it!
 
 class PageType:
     InteriorIndex = 0x02
@@ -35,12 +39,389 @@ class UnknownSerialTypeError(Exception):
     def __init__(self,srl_type,msg="Invalid serial type found:"):
         self.message = msg
         self.serial = srl_type
-        super().__init__(self.message+" "+str(serial))
+        super().__init__(self.message+" "+str(srl_type))
     
 def read_page(db_file,pg_num,pgsz):
     db_file.seek((pg_num-1)*pgsz)
     return db_file.read(pgsz)
 
+def read_page_size(db_file):
+    db_file.seek(16)
+    page_size = int.from_bytes(db_file.read(2))
+    return 65536 if page_size == 1 else page_size
+
+def read_change_counter(db_file):
+    db_file.seek(24)
+    return int.from_bytes(db_file.read(4))
+
+def read_usable_size(db_file,pg_sz):
+    """Page size less the bytes reserved at the end of each page (header offset 20)."""
+    db_file.seek(20)
+    return pg_sz-db_file.read(1)[0]
+
+class CachePolicy:
+    LRU = "lru"
+    CLOCK = "clock"
+    
+class PrefetchMode:
+    OFF = "off"
+    PREAD = "pread"
+    FADVISE = "fadvise"
+
+CACHE_PAGES = int(os.environ.get("SQLITE_CACHE_PAGES",2000))
+CACHE_BYTES = int(os.environ.get("SQLITE_CACHE_BYTES",0)) or None
+CACHE_POLICY = os.environ.get("SQLITE_CACHE_POLICY",CachePolicy.LRU)
+USE_MMAP = os.environ.get("SQLITE_MMAP","0") not in ("","0")
+PARALLEL_WORKERS = int(os.environ.get("SQLITE_PARALLEL_WORKERS",0))
+CATALOG_SIDECAR = os.environ.get("SQLITE_CATALOG_SIDECAR","0") not in ("","0")
+STATEMENT_CACHE_SIZE = int(os.environ.get("SQLITE_STATEMENT_CACHE",256))
+BATCH_DECODE = os.environ.get("SQLITE_BATCH_DECODE","auto")
+BATCH_ROWS = int(os.environ.get("SQLITE_BATCH_ROWS",4096))
+USE_NUMPY = os.environ.get("SQLITE_NUMPY","1") not in ("","0")
+SORT_MEMORY_ROWS = int(os.environ.get("SQLITE_SORT_ROWS",100000))
+PREFETCH_MODE = os.environ.get("SQLITE_PREFETCH",PrefetchMode.OFF) or PrefetchMode.OFF
+PREFETCH_WORKERS = int(os.environ.get("SQLITE_PREFETCH_WORKERS",4))
+PREFETCH_PAGES = int(os.environ.get("SQLITE_PREFETCH_PAGES",32))
+PREFETCH_RUN_PAGES = int(os.environ.get("SQLITE_PREFETCH_RUN",16))
+PROFILE_QUERIES = os.environ.get("SQLITE_STATS","0") not in ("","0")
+
+class _Profiling(threading.local):
+    stats = None
+
+# QueryStats of the query whose rows this thread is producing, set by
+# profile_rows only while that query's iterator runs, so interleaved queries
+# and queries on other threads are kept apart
+_profiling = _Profiling()
+
+def page_runs(pg_nums,max_run):
+    """Groups page numbers into [first page, count] runs of adjacent pages, at most max_run long."""
+    runs = []
+    for pg_num in sorted(pg_nums):
+        if runs and pg_num == runs[-1][0]+runs[-1][1] and runs[-1][1] < max_run:
+            runs[-1][1] += 1
+        else:
+            runs.append([pg_num,1])
+    return runs
+
+class Prefetcher:
+    """Reads pages ahead of a traversal, one read per run of adjacent pages."""
+    # Runs are read with os.pread on a small thread pool or hinted with
+    # posix_fadvise(WILLNEED); take waits for a read still in flight
+    def __init__(self,db_file,pg_sz,mode=PREFETCH_MODE,workers=PREFETCH_WORKERS,max_run=PREFETCH_RUN_PAGES):
+        if mode not in (PrefetchMode.PREAD,PrefetchMode.FADVISE):
+            raise ValueError("Unknown prefetch mode: "+str(mode))
+        if mode == PrefetchMode.FADVISE and not hasattr(os,"posix_fadvise"):
+            mode = PrefetchMode.PREAD
+        self.fd = db_file.fileno()
+        self.pg_sz = pg_sz
+        self.mode = mode
+        self.workers = max(1,workers)
+        self.max_run = max(1,max_run)
+        self.max_pending = max(PREFETCH_PAGES,1)<<3
+        self.issued = 0
+        self.used = 0
+        self._pool = None
+        self._pending = {}
+        
+    def request(self,pg_nums):
+        for first, count in page_runs([pg for pg in pg_nums if pg not in self._pending],self.max_run):
+            offset = (first-1)*self.pg_sz
+            if self.mode == PrefetchMode.FADVISE:
+                os.posix_fadvise(self.fd,offset,count*self.pg_sz,os.POSIX_FADV_WILLNEED)
+                future = None
+            else:
+                if self._pool is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._pool = ThreadPoolExecutor(self.workers,thread_name_prefix="prefetch")
+                future = self._pool.submit(os.pread,self.fd,count*self.pg_sz,offset)
+            for idx in range(count):
+                self._pending[first+idx] = (future,idx)
+            self.issued += count
+        # Pages read ahead for a traversal that stopped early are dropped, oldest first
+        while len(self._pending) > self.max_pending:
+            del self._pending[next(iter(self._pending))]
+            
+    def take(self,pg_num):
+        future, idx = self._pending.pop(pg_num,(None,0))
+        if future is None:
+            return None
+        try:
+            page = future.result()[idx*self.pg_sz:(idx+1)*self.pg_sz]
+        except OSError:
+            return None
+        if len(page) != self.pg_sz:
+            return None
+        self.used += 1
+        return page
+    
+    def clear(self):
+        self._pending.clear()
+        
+    def close(self):
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False,cancel_futures=True)
+            self._pool = None
+
+class PageCache:
+    """Buffer pool in front of read_page, sized in pages or bytes; pinned pages are never evicted."""
+    def __init__(self,db_file,pg_sz,max_pages=CACHE_PAGES,max_bytes=CACHE_BYTES,policy=CACHE_POLICY,prefetch=PREFETCH_MODE):
+        if policy not in (CachePolicy.LRU,CachePolicy.CLOCK):
+            raise ValueError("Unknown cache policy: "+str(policy))
+        self.prefetcher = None if prefetch in (PrefetchMode.OFF,"0") else Prefetcher(db_file,pg_sz,prefetch)
+        self.prefetching = self.prefetcher is not None
+        self.db_file = db_file
+        self.pg_sz = pg_sz
+        self.usable_sz = read_usable_size(db_file,pg_sz)
+        self.capacity = max(1,max_bytes//pg_sz if max_bytes else max_pages)
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pages = OrderedDict()
+        self._pins = {}
+        self._refs = {}
+        self._ring = []
+        self._hand = 0
+        
+    def __len__(self):
+        return len(self._pages)
+    
+    def __contains__(self,pg_num):
+        return pg_num in self._pages
+        
+    def get_page(self,pg_num):
+        page = self._pages.get(pg_num)
+        if page is not None:
+            self.hits += 1
+            if _profiling.stats is not None:
+                _profiling.stats.read(pg_num,True)
+            if self.policy == CachePolicy.LRU:
+                self._pages.move_to_end(pg_num)
+            else:
+                self._refs[pg_num] = True
+            return page
+        self.misses += 1
+        stats = _profiling.stats
+        if stats is not None:
+            start = time.perf_counter()
+        if self.prefetching:
+            page = self.prefetcher.take(pg_num)
+        if page is None:
+            page = read_page(self.db_file,pg_num,self.pg_sz)
+        if stats is not None:
+            stats.read(pg_num,False,len(page),time.perf_counter()-start)
+        if len(self._pages) >= self.capacity:
+            self._evict()
+        self._pages[pg_num] = page
+        if self.policy == CachePolicy.CLOCK:
+            self._ring.append(pg_num)
+            self._refs[pg_num] = True
+        return page
+    
+    def prefetch(self,pg_nums):
+        self.prefetcher.request([pg for pg in pg_nums if pg not in self._pages])
+        
+    def pin(self,pg_num):
+        page = self.get_page(pg_num)
+        self._pins[pg_num] = self._pins.get(pg_num,0) + 1
+        return page
+    
+    def unpin(self,pg_num):
+        pins = self._pins.get(pg_num,0) - 1
+        if pins > 0:
+            self._pins[pg_num] = pins
+        else:
+            self._pins.pop(pg_num,None)
+            
+    @contextmanager
+    def pinned(self,pg_num):
+        page = self.pin(pg_num)
+        try:
+            yield page
+        finally:
+            self.unpin(pg_num)
+            
+    def _evict(self):
+        if self.policy == CachePolicy.LRU:
+            for pg_num in self._pages:
+                if pg_num not in self._pins:
+                    del self._pages[pg_num]
+                    self.evictions += 1
+                    return
+        else:
+            # Two sweeps clear every reference bit, so a frame is found unless all are pinned
+            for _ in range(len(self._ring)<<1):
+                if self._hand >= len(self._ring):
+                    self._hand = 0
+                pg_num = self._ring[self._hand]
+                if pg_num in self._pins:
+                    self._hand += 1
+                elif self._refs[pg_num]:
+                    self._refs[pg_num] = False
+                    self._hand += 1
+                else:
+                    self._ring.pop(self._hand)
+                    del self._refs[pg_num]
+                    del self._pages[pg_num]
+                    self.evictions += 1
+                    return
+        # Every cached page is pinned, let the pool grow past its capacity for now
+        
+    def clear(self):
+        self._pages.clear()
+        self._refs.clear()
+        self._ring.clear()
+        self._hand = 0
+        if self.prefetching:
+            self.prefetcher.clear()
+            
+    def close(self):
+        if self.prefetching:
+            self.prefetcher.close()
+        
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {"policy":self.policy,"capacity":self.capacity,"cached":len(self._pages),
+                 "pinned":len(self._pins),"hits":self.hits,"misses":self.misses,
+                 "evictions":self.evictions,"hit_ratio":self.hits/lookups if lookups else 0.0}
+        if self.prefetching:
+            stats.update(prefetch=self.prefetcher.mode,prefetched=self.prefetcher.issued,
+                         prefetch_used=self.prefetcher.used)
+        return stats
+    
+class MmapPageCache:
+    """Zero-copy PageCache over a read-only mapping, leaving caching to the OS."""
+    def __init__(self,db_file,pg_sz,prefetch=PREFETCH_MODE):
+        self.db_file = db_file
+        self.pg_sz = pg_sz
+        self.usable_sz = read_usable_size(db_file,pg_sz)
+        self.policy = "mmap"
+        self.hits = 0
+        self.misses = 0
+        self._map = mmap.mmap(db_file.fileno(),0,access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self.prefetching = prefetch not in (PrefetchMode.OFF,"0") and hasattr(mmap,"MADV_WILLNEED")
+        
+    def __len__(self):
+        return len(self._map)//self.pg_sz
+    
+    def __contains__(self,pg_num):
+        return 0 < pg_num <= len(self)
+        
+    def get_page(self,pg_num):
+        self.hits += 1
+        if _profiling.stats is not None:
+            # Nothing is kept in the process, every access reads the mapping
+            _profiling.stats.read(pg_num,False,self.pg_sz)
+        start = (pg_num-1)*self.pg_sz
+        return self._view[start:start+self.pg_sz]
+    
+    def prefetch(self,pg_nums):
+        for first, count in page_runs(pg_nums,PREFETCH_RUN_PAGES):
+            # madvise wants a start aligned to the OS page size
+            start = (first-1)*self.pg_sz
+            aligned = start - start%mmap.PAGESIZE
+            self._map.madvise(mmap.MADV_WILLNEED,aligned,min(start+count*self.pg_sz,len(self._map))-aligned)
+    
+    def pin(self,pg_num):
+        return self.get_page(pg_num)
+    
+    def unpin(self,pg_num):
+        pass
+    
+    @contextmanager
+    def pinned(self,pg_num):
+        yield self.get_page(pg_num)
+        
+    def clear(self):
+        pass
+        
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # Page views still alive, the mapping goes away once they are collected
+            pass
+        
+    def stats(self):
+        return {"policy":self.policy,"mapped_pages":len(self),"hits":self.hits,"misses":self.misses}
+    
+def open_page_cache(db_file,use_mmap=USE_MMAP):
+    pg_sz = read_page_size(db_file)
+    if use_mmap:
+        return MmapPageCache(db_file,pg_sz)
+    return PageCache(db_file,pg_sz)
+
+class LockedPageCache:
+    """A page cache shared by threads, each call on it made under one lock."""
+    # Pages are immutable bytes or views, so they stay usable once the lock is released
+    def __init__(self,pg_cache):
+        self._cache = pg_cache
+        self._lock = threading.RLock()
+
+    def __getattr__(self,name):
+        # pg_sz, usable_sz, prefetching, db_file and the counters
+        return getattr(self._cache,name)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+    def __contains__(self,pg_num):
+        with self._lock:
+            return pg_num in self._cache
+
+    def get_page(self,pg_num):
+        with self._lock:
+            return self._cache.get_page(pg_num)
+
+    def prefetch(self,pg_nums):
+        with self._lock:
+            self._cache.prefetch(pg_nums)
+
+    def pin(self,pg_num):
+        with self._lock:
+            return self._cache.pin(pg_num)
+
+    def unpin(self,pg_num):
+        with self._lock:
+            self._cache.unpin(pg_num)
+
+    @contextmanager
+    def pinned(self,pg_num):
+        page = self.pin(pg_num)
+        try:
+            yield page
+        finally:
+            self.unpin(pg_num)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def close(self):
+        with self._lock:
+            self._cache.close()
+
+    def stats(self):
+        with self._lock:
+            return self._cache.stats()
+
+def read_ahead(pg_cache,pg_nums,window=PREFETCH_PAGES):
+    """Iterates over pg_nums, keeping the next window of them requested from the prefetcher."""
+    if not pg_cache.prefetching or len(pg_nums) < 2:
+        return pg_nums
+    return _read_ahead(pg_cache,pg_nums,max(window,2))
+
+def _read_ahead(pg_cache,pg_nums,window):
+    step = window>>1
+    for idx, pg_num in enumerate(pg_nums):
+        if idx % step == 0:
+            pg_cache.prefetch(pg_nums[idx:idx+window])
+        yield pg_num
+
 def read_int(page,start,blen):
     return int.from_bytes(page[start:start+blen])
 
@@ -66,62 +447,160 @@ def read_varint(buffer,offset):
         bidx += 1
     return val, bidx+1
 
+def serial_type_len(srl_type):
+    if srl_type >= 12:
+        return (srl_type-12)>>1
+    elif srl_type > 0 and srl_type < 7:
+        return SRL_TYPE_INT_LENS[srl_type-1]
+    elif srl_type == 7:
+        return 8
+    elif srl_type in (0,8,9):
+        return 0
+    raise UnknownSerialTypeError(srl_type)
+
+# Body length of each serial type that fits in one header byte, None for the
+# reserved types 10 and 11
+SRL_TYPE_LENS = [None if srl_type in (10,11) else serial_type_len(srl_type) for srl_type in range(0x80)]
+REAL_STRUCT = struct.Struct(">d")
+
+def read_signed(page,offset,blen):
+    return int.from_bytes(page[offset:offset+blen],"big",signed=True)
+
 def parse_record_body(srl_type,page,offset):
     if not srl_type:
         return None, 0
     elif srl_type > 0 and srl_type < 7:
         srl_len = SRL_TYPE_INT_LENS[srl_type-1]
-        return read_int(page,offset,srl_len), srl_len
+        return read_signed(page,offset,srl_len), srl_len
     elif srl_type == 7:
-        return struct.unpack(">f",page[offset:offset+8]), 8
+        return REAL_STRUCT.unpack_from(page,offset)[0], 8
     elif srl_type == 8 or srl_type == 9:
         return srl_type&1, 0
     elif srl_type >= 12 and srl_type&1==0:
         datalen = (srl_type-12)>>1
-        return page[offset:offset+datalen], datalen
+        # page may be a memoryview, copy the value out of it
+        return bytes(page[offset:offset+datalen]), datalen
     elif srl_type >= 13 and srl_type&1==1:
         datalen = (srl_type-13)>>1
-        return page[offset:offset+datalen].decode(), datalen
+        return str(page[offset:offset+datalen],"utf-8"), datalen
     else:
         raise UnknownSerialTypeError(srl_type)
     
-def parse_TCell(offset,page):
-    payload_size, bytes_read = read_varint(page,offset)
-    offset += bytes_read
-    row_id, bytes_read = read_varint(page,offset)
-    offset += bytes_read
+def parse_record_header(offset,page,col_end=-1):
+    """Serial types and body offsets of a record's first col_end columns, decoding no value."""
+    record_hdr_sz = page[offset]
+    if record_hdr_sz < 0x80:
+        header = page[offset+1:offset+record_hdr_sz]
+        if not header or max(header) < 0x80:
+            # Every serial type is one byte, as in most records: no varints to walk
+            serial_types = list(header if col_end < 0 else header[:col_end])
+            try:
+                offsets = list(accumulate(map(SRL_TYPE_LENS.__getitem__,serial_types),initial=offset+record_hdr_sz))
+            except TypeError:
+                raise UnknownSerialTypeError(next(t for t in serial_types if SRL_TYPE_LENS[t] is None)) from None
+            offsets.pop()
+            return serial_types, offsets
     record_hdr_sz, bytes_read = read_varint(page,offset)
     record_body_start = offset+record_hdr_sz
+    body_offset = record_body_start
     offset += bytes_read
     serial_types = []
-    while offset < record_body_start:
-        srl, bytes_read = read_varint(page,offset)
-        serial_types.append(srl)
-        offset += bytes_read
+    offsets = []
+    while offset < record_body_start and len(serial_types) != col_end:
+        srl_type = page[offset]
+        if srl_type < 0x80:
+            # Serial types below 64 fit in one byte, which covers every column but long text and blobs
+            offset += 1
+        else:
+            srl_type, bytes_read = read_varint(page,offset)
+            offset += bytes_read
+        serial_types.append(srl_type)
+        offsets.append(body_offset)
+        body_offset += serial_type_len(srl_type)
+    return serial_types, offsets
+
+def parse_record(offset,page,cols=None,col_end=None):
+    """Decodes the record at offset, only the columns in cols; the others are left None."""
+    if col_end is None:
+        col_end = -1 if cols is None else max(cols,default=-1)+1
+    serial_types, offsets = parse_record_header(offset,page,col_end)
     record = []
-    for srl_type in serial_types:
-        value, val_len = parse_record_body(srl_type,page,offset)
-        record.append(value)
-        offset += val_len
-    return record, row_id
+    for col_idx, srl_type in enumerate(serial_types):
+        if cols is None or col_idx in cols:
+            record.append(parse_record_body(srl_type,page,offsets[col_idx])[0])
+        else:
+            record.append(None)
+    if len(record) < col_end:
+        # Rows written before an ALTER TABLE ADD COLUMN are shorter than the schema
+        record.extend([None]*(col_end-len(record)))
+    return record
 
-def parse_ICell(offset,page):
-    payload_size, bytes_read = read_varint(page,offset)
-    offset += bytes_read
-    record_hdr_sz, bytes_read = read_varint(page,offset)
-    record_body_start = offset+record_hdr_sz
-    offset += bytes_read
-    serial_types = []
-    while offset < record_body_start:
-        srl, bytes_read = read_varint(page,offset)
-        serial_types.append(srl)
-        offset += bytes_read
+def decode_columns(page,serial_types,offsets,col_idxs,row_id,rowid_idx):
     record = []
-    for srl_type in serial_types:
-        value, val_len = parse_record_body(srl_type,page,offset)
-        record.append(value)
-        offset += val_len
+    for col_idx in col_idxs:
+        if col_idx >= len(serial_types):
+            record.append(None)
+        elif col_idx == rowid_idx and not serial_types[col_idx]:
+            record.append(row_id)
+        else:
+            record.append(parse_record_body(serial_types[col_idx],page,offsets[col_idx])[0])
     return record
+    
+def parse_ICell(offset,page,pg_cache=None):
+    """Decodes an index cell, reading a spilled payload whole when given pg_cache."""
+    payload_size, bytes_read = read_varint(page,offset)
+    offset += bytes_read
+    if pg_cache is not None and payload_size > max_local_payload(pg_cache.usable_sz,False):
+        page, offset = OverflowPayload(page,offset,payload_size,pg_cache,False).read(payload_size), 0
+    return parse_record(offset,page)
+
+def max_local_payload(usable_sz,is_table):
+    """Largest payload a cell keeps whole on a table leaf or index page."""
+    return usable_sz-35 if is_table else ((usable_sz-12)*64//255)-23
+
+def local_payload_size(payload_size,usable_sz,is_table):
+    """Bytes of a payload kept in the cell, the rest going to overflow pages, as SQLite splits it."""
+    max_local = max_local_payload(usable_sz,is_table)
+    if payload_size <= max_local:
+        return payload_size
+    min_local = ((usable_sz-12)*32//255)-23
+    local_sz = min_local+(payload_size-min_local)%(usable_sz-4)
+    return local_sz if local_sz <= max_local else min_local
+
+class OverflowPayload:
+    """Payload of a cell that spills onto a chain of overflow pages."""
+    # Only the local part is copied up front, overflow pages are read through
+    # the page cache once read asks for bytes they hold
+    def __init__(self,page,offset,payload_size,pg_cache,is_table=True):
+        local_sz = local_payload_size(payload_size,pg_cache.usable_sz,is_table)
+        self.data = bytes(page[offset:offset+local_sz])
+        self.next_pg = read_int(page,offset+local_sz,4)
+        self.size = payload_size
+        self.pg_cache = pg_cache
+        
+    def read(self,end):
+        """The payload from its start up to at least end bytes, or all of it."""
+        if len(self.data) >= end or not self.next_pg:
+            return self.data
+        chunks = [self.data]
+        held = len(self.data)
+        usable_sz = self.pg_cache.usable_sz
+        while held < end and self.next_pg:
+            page = self.pg_cache.get_page(self.next_pg)
+            chunk = bytes(page[4:min(usable_sz,4+self.size-held)])
+            chunks.append(chunk)
+            held += len(chunk)
+            self.next_pg = read_int(page,0,4) if held < self.size else 0
+        self.data = b"".join(chunks)
+        return self.data
+    
+    def header(self):
+        """The payload up to the end of the record header."""
+        return self.read(read_varint(self.read(9),0)[0])
+
+def columns_end(serial_types,offsets,col_idxs):
+    """Record length up to the end of the last value of col_idxs present in the record."""
+    return max((offsets[idx]+serial_type_len(serial_types[idx]) for idx in col_idxs if idx < len(serial_types)),default=0)
 
 def get_table_info(cell_ptrs,dbfile,tbl_name):
     for cell_ptr in cell_ptrs:
@@ -129,21 +608,393 @@ def get_table_info(cell_ptrs,dbfile,tbl_name):
         if record[1] == tbl_name:
             return {"rootpage":record[3],"desc":sp.parse(record[4])}
         
-def get_records(page,cells,tdesc,query_ref):
-    records = []
-    for c_ptr in cells:
-        cell, row_id = parse_TCell(c_ptr,page)
-        record = {}
-        for col_name, col_value in zip(tdesc.col_names,cell):
-            if col_name == "id":
-                record[col_name] = col_value or row_id
+class Affinity:
+    INTEGER = "integer"
+    REAL = "real"
+    NUMERIC = "numeric"
+    TEXT = "text"
+    BLOB = "blob"
+    
+def column_affinity(dtype):
+    dtype = (dtype or "").lower()
+    if "int" in dtype:
+        return Affinity.INTEGER
+    if "char" in dtype or "clob" in dtype or "text" in dtype:
+        return Affinity.TEXT
+    if "blob" in dtype or not dtype:
+        return Affinity.BLOB
+    if "real" in dtype or "floa" in dtype or "doub" in dtype:
+        return Affinity.REAL
+    return Affinity.NUMERIC
+
+def apply_affinity(value,affinity):
+    """Converts a literal the way SQLite does when comparing it to a column."""
+    if affinity == Affinity.TEXT and isinstance(value,(int,float)):
+        return str(value)
+    if affinity in (Affinity.INTEGER,Affinity.REAL,Affinity.NUMERIC) and isinstance(value,str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return value
+
+def declared_collation(tdesc,col):
+    collations = tdesc.col_collations
+    col_idx = tdesc.col_pos[col]
+    return collations[col_idx] if col_idx < len(collations) else None
+
+def column_collation(tdesc,col):
+    return declared_collation(tdesc,col) or sp.Collation.BINARY
+
+def sort_collations(tdesc,order_by,collations):
+    """Collation of each ORDER BY term: its COLLATE clause, else its column's."""
+    return [collation or (None if isinstance(col,sp.Aggregate) else column_collation(tdesc,col))
+            for (col,desc),collation in zip(order_by,collations)]
+
+def affinity_of(tdesc,col):
+    dtypes = tdesc.col_dtypes
+    col_idx = tdesc.col_pos[col]
+    return column_affinity(dtypes[col_idx] if col_idx < len(dtypes) else None)
+
+def comparison_affinity(left,right):
+    """Affinity applied to both sides when comparing two columns: NUMERIC if either is."""
+    numeric = (Affinity.INTEGER,Affinity.REAL,Affinity.NUMERIC)
+    if left in numeric or right in numeric:
+        return Affinity.NUMERIC
+    return None
+
+def bind_affinity(cond,tdesc):
+    """Applies column affinities to the literals of cond and column collations to its terms."""
+    # Done at plan time and again on each set of bound ? values
+    for leaf in cond.leaves():
+        if isinstance(leaf.col,sp.Aggregate):
+            continue
+        for col in leaf.columns():
+            if col not in tdesc.col_names:
+                raise NoSuchColumnError(col)
+        leaf.collation = leaf.collation or column_collation(tdesc,leaf.col)
+        if isinstance(leaf.value,sp.ColumnRef):
+            continue
+        affinity = affinity_of(tdesc,leaf.col)
+        if leaf.op in (sp.WhereCmp.IN,sp.WhereCmp.BETWEEN):
+            leaf.value = [apply_affinity(val,affinity) for val in leaf.value]
+        elif leaf.op != sp.WhereCmp.LIKE:
+            leaf.value = apply_affinity(leaf.value,affinity)
+            
+def raw_value_key(page,srl_type,offset):
+    """value_key of an encoded value, comparing text and blobs as raw bytes."""
+    if not srl_type:
+        return None
+    if srl_type < 12:
+        return (1,parse_record_body(srl_type,page,offset)[0])
+    if srl_type&1:
+        return (2,bytes(page[offset:offset+((srl_type-13)>>1)]))
+    return (3,bytes(page[offset:offset+((srl_type-12)>>1)]))
+
+def literal_key(val):
+    key = sp.value_key(val)
+    return (2,val.encode()) if key[0] == 2 else key
+
+def nocase_key(key):
+    """Folds the ASCII letters of a text key from raw_value_key or literal_key."""
+    return (2,key[1].lower()) if key and key[0] == 2 else key
+    
+CMP_FUNCS = {sp.WhereCmp.EQ:operator.eq,sp.WhereCmp.NE:operator.ne,
+             sp.WhereCmp.LT:operator.lt,sp.WhereCmp.GT:operator.gt,
+             sp.WhereCmp.LE:operator.le,sp.WhereCmp.GE:operator.ge}
+    
+def compile_predicate(cond,tdesc,rowid_idx):
+    """Compiles cond into pred(page,serial_types,offsets,row_id,base) over an encoded record."""
+    # Serial types are checked first and values only read when a leaf needs
+    # them. NOT is already pushed down to the leaves, so NULL fails every leaf
+    # but IS NULL
+    if isinstance(cond,sp.QueryCondGroup):
+        preds = [compile_predicate(sub_cond,tdesc,rowid_idx) for sub_cond in cond.conds]
+        if cond.join == sp.CondJoin.AND:
+            def pred(page,serial_types,offsets,row_id,base):
+                for sub_pred in preds:
+                    if not sub_pred(page,serial_types,offsets,row_id,base):
+                        return False
+                return True
+        else:
+            def pred(page,serial_types,offsets,row_id,base):
+                for sub_pred in preds:
+                    if sub_pred(page,serial_types,offsets,row_id,base):
+                        return True
+                return False
+        return pred
+    col_idx = tdesc.col_pos[cond.col]
+    negated = cond.negated
+    if cond.op == sp.WhereCmp.ISNULL:
+        def pred(page,serial_types,offsets,row_id,base):
+            is_null = col_idx >= len(serial_types) or (not serial_types[col_idx] and col_idx != rowid_idx)
+            return is_null != negated
+        return pred
+    nocase = cond.collation == sp.Collation.NOCASE
+    # A REAL column stores whole numbers as integers, which LIKE reads as reals
+    real = affinity_of(tdesc,cond.col) == Affinity.REAL
+    if cond.op == sp.WhereCmp.EQ and isinstance(cond.value,str) and col_idx != rowid_idx:
+        # Equal text has the same serial type, so most rows are rejected on one int compare.
+        # NOCASE only folds ASCII letters, which keeps the length.
+        raw = cond.value.encode().lower() if nocase else cond.value.encode()
+        raw_len = len(raw)
+        text_srl = (raw_len<<1)+13
+        def pred(page,serial_types,offsets,row_id,base):
+            if col_idx < len(serial_types) and serial_types[col_idx] == text_srl:
+                offset = base+offsets[col_idx]
+                if nocase:
+                    return bytes(page[offset:offset+raw_len]).lower() == raw
+                return page[offset:offset+raw_len] == raw
+            return False
+        return pred
+    if cond.op == sp.WhereCmp.LIKE and cond.value.endswith("%") and not re.search("[%_]",cond.value[:-1]):
+        prefix = cond.value[:-1].encode().lower()
+        prefix_len = len(prefix)
+        min_srl = (prefix_len<<1)+13
+        def pred(page,serial_types,offsets,row_id,base):
+            if col_idx >= len(serial_types):
+                return False
+            srl_type = serial_types[col_idx]
+            if srl_type >= min_srl and srl_type&1:
+                offset = base+offsets[col_idx]
+                return (bytes(page[offset:offset+prefix_len]).lower() == prefix) != negated
+            if srl_type < 12 and (srl_type or col_idx == rowid_idx):
+                val = row_id if not srl_type else parse_record_body(srl_type,page,base+offsets[col_idx])[0]
+                return cond.comp(float(val) if real else val)
+            return negated and srl_type >= 12
+        return pred
+    fold = nocase_key if nocase else (lambda key: key)
+    if cond.op == sp.WhereCmp.IN:
+        keys = {fold(literal_key(val)) for val in cond.value if val is not None}
+        has_null = None in cond.value
+        def test(key):
+            if key in keys:
+                return not negated
+            return negated and not has_null
+    elif cond.op == sp.WhereCmp.BETWEEN:
+        low, high = (None if val is None else fold(literal_key(val)) for val in cond.value)
+        between_test = sp.between_test
+        def test(key):
+            return between_test(key,low,high,negated)
+    elif cond.op == sp.WhereCmp.LIKE:
+        matcher, sql_text = sp.like_to_regex(cond.value), sp.sql_text
+        def test(key):
+            if key[0] == 3:
+                return negated
+            raw = sql_text(float(key[1]) if real else key[1]).encode() if key[0] == 1 else key[1]
+            return bool(matcher.fullmatch(raw)) != negated
+    else:
+        if cond.value is None:
+            return lambda page,serial_types,offsets,row_id,base: False
+        cmp_func = CMP_FUNCS[cond.op]
+        lit = fold(literal_key(cond.value))
+        def test(key):
+            return cmp_func(key,lit)
+    def pred(page,serial_types,offsets,row_id,base):
+        if col_idx >= len(serial_types):
+            return False
+        srl_type = serial_types[col_idx]
+        if not srl_type:
+            if col_idx != rowid_idx:
+                return False
+            return test((1,row_id))
+        key = raw_value_key(page,srl_type,base+offsets[col_idx])
+        return test(nocase_key(key) if nocase and cond.op != sp.WhereCmp.LIKE else key)
+    return pred
+
+class NoSuchColumnError(Exception):
+    def __init__(self,col,msg="No such column:"):
+        self.message = msg
+        self.col = col
+        super().__init__(self.message+" "+str(col))
+        
+class NoSuchTableError(Exception):
+    def __init__(self,table,msg="No such table:"):
+        self.message = msg
+        self.table = table
+        super().__init__(self.message+" "+str(table))
+
+def rowid_column(tdesc):
+    if tdesc.rowid_col in tdesc.col_names:
+        return tdesc.col_pos[tdesc.rowid_col]
+    return None
+
+LAYOUT_CACHE_SIZE = 512
+STRUCT_CODES = {1:"b",2:"h",4:"i",6:"q",7:"d"}
+
+class RecordLayout:
+    """Cached decoding of the records sharing one header for a ScanPlan."""
+    # Fixed-width values are unpacked by one struct.Struct; 3 and 6 byte integers,
+    # which struct cannot read, text, blobs and constants are filled in around them
+    __slots__ = ("serial_types","offsets","template","unpack","fixed","ints","slices","rowid_pos","reals")
+    def __init__(self,header,col_end,col_idxs,rowid_idx,real_idxs):
+        serial_types, offsets = parse_record_header(0,header,col_end)
+        self.serial_types = serial_types
+        self.offsets = offsets
+        self.template = [None]*len(col_idxs)
+        self.ints, self.slices, self.rowid_pos, self.reals = [], [], [], []
+        fields = {}
+        fixed = []
+        for out_pos, col_idx in enumerate(col_idxs):
+            if col_idx >= len(serial_types):
+                continue
+            srl_type, offset = serial_types[col_idx], offsets[col_idx]
+            if col_idx in real_idxs and 0 < srl_type < 10 and srl_type != 7:
+                # A REAL column stores whole numbers as integers on disk
+                self.reals.append(out_pos)
+            if not srl_type:
+                if col_idx == rowid_idx:
+                    self.rowid_pos.append(out_pos)
+            elif srl_type in (8,9):
+                self.template[out_pos] = srl_type&1
+            elif srl_type in STRUCT_CODES:
+                fields[offset] = STRUCT_CODES[srl_type]
+                fixed.append((out_pos,offset))
+            elif srl_type < 7:
+                self.ints.append((out_pos,offset,SRL_TYPE_INT_LENS[srl_type-1]))
             else:
-                record[col_name] = col_value
-        if query_ref.cond and query_ref.cond.col in record.keys():
-            if query_ref.cond.comp(record[query_ref.cond.col]):
+                self.slices.append((out_pos,offset,offset+serial_type_len(srl_type),srl_type&1))
+        fmt = ">"
+        end = 0
+        field_idx = {}
+        for offset in sorted(fields):
+            if offset > end:
+                fmt += str(offset-end)+"x"
+            field_idx[offset] = len(field_idx)
+            fmt += fields[offset]
+            end = offset+struct.calcsize(">"+fields[offset])
+        self.unpack = struct.Struct(fmt).unpack_from if fields else None
+        self.fixed = [(out_pos,field_idx[offset]) for out_pos, offset in fixed]
+        
+    def decode(self,page,base,row_id):
+        row = self.template.copy()
+        if self.unpack is not None:
+            values = self.unpack(page,base)
+            for out_pos, idx in self.fixed:
+                row[out_pos] = values[idx]
+        for out_pos, start, end, is_text in self.slices:
+            row[out_pos] = str(page[base+start:base+end],"utf-8") if is_text else bytes(page[base+start:base+end])
+        for out_pos, start, length in self.ints:
+            row[out_pos] = read_signed(page,base+start,length)
+        for out_pos in self.rowid_pos:
+            row[out_pos] = row_id
+        for out_pos in self.reals:
+            row[out_pos] = float(row[out_pos])
+        return row
+
+class ScanPlan:
+    """Output columns, header extent and compiled predicate of a table traversal."""
+    # Headers seen more than once get a RecordLayout, up to LAYOUT_CACHE_SIZE of them
+    def __init__(self,tdesc,col_names,cond=None):
+        for col in col_names:
+            if col not in tdesc.col_names:
+                raise NoSuchColumnError(col)
+        self.tdesc = tdesc
+        self.rowid_idx = rowid_column(tdesc)
+        self.col_idxs = [tdesc.col_pos[col] for col in col_names]
+        self.cond = cond
+        needed = list(self.col_idxs)
+        if cond:
+            needed.extend(tdesc.col_pos[col] for col in cond.columns())
+            self.predicate = compile_predicate(cond,tdesc,self.rowid_idx)
+        else:
+            self.predicate = None
+        self.col_end = max(needed,default=-1)+1
+        self.cond_idxs = needed[len(self.col_idxs):]
+        self.real_idxs = {col_idx for col_idx in self.col_idxs if affinity_of(tdesc,tdesc.col_names[col_idx]) == Affinity.REAL}
+        self.real_pos = [pos for pos, col_idx in enumerate(self.col_idxs) if col_idx in self.real_idxs]
+        self._layouts = {}
+        self._seen = set()
+        
+    def layout(self,page,offset):
+        """RecordLayout of the record at offset, or None for a header not seen before."""
+        if page[offset] >= 0x80:
+            return None
+        header = bytes(page[offset:offset+page[offset]])
+        layout = self._layouts.get(header)
+        if layout is not None:
+            return layout
+        if header in self._seen and len(self._layouts) < LAYOUT_CACHE_SIZE:
+            layout = self._layouts[header] = RecordLayout(header,self.col_end,self.col_idxs,self.rowid_idx,self.real_idxs)
+            return layout
+        if len(self._seen) >= LAYOUT_CACHE_SIZE<<2:
+            self._seen.clear()
+        self._seen.add(header)
+        return None
+        
+    def decode(self,page,serial_types,offsets,row_id):
+        row = decode_columns(page,serial_types,offsets,self.col_idxs,row_id,self.rowid_idx)
+        for pos in self.real_pos:
+            if isinstance(row[pos],int):
+                row[pos] = float(row[pos])
+        return row
+
+def get_records(page,cells,plan,pg_cache):
+    predicate, layout_of = plan.predicate, plan.layout
+    max_local = pg_cache.usable_sz-35
+    if _profiling.stats is not None:
+        _profiling.stats.cells += len(cells)
+    for c_ptr in cells:
+        payload_size, row_id, offset = parse_table_cell(c_ptr,page)
+        if payload_size > max_local:
+            row = read_overflow_record(page,offset,payload_size,row_id,plan,pg_cache)
+            if row is not None:
+                yield row
+            continue
+        layout = layout_of(page,offset)
+        if layout is not None:
+            if predicate and not predicate(page,layout.serial_types,layout.offsets,row_id,offset):
                 continue
-        records.append(list(record.values()))
-    return records
+            yield layout.decode(page,offset,row_id)
+            continue
+        serial_types, offsets = parse_record_header(offset,page,plan.col_end)
+        if predicate and not predicate(page,serial_types,offsets,row_id,0):
+            continue
+        yield plan.decode(page,serial_types,offsets,row_id)
+        
+def read_record(offset,page,row_id,plan):
+    """Decodes the record at offset for plan, or None if it fails the predicate."""
+    if _profiling.stats is not None:
+        _profiling.stats.cells += 1
+    layout = plan.layout(page,offset)
+    if layout is not None:
+        if plan.predicate and not plan.predicate(page,layout.serial_types,layout.offsets,row_id,offset):
+            return None
+        return layout.decode(page,offset,row_id)
+    serial_types, offsets = parse_record_header(offset,page,plan.col_end)
+    if plan.predicate and not plan.predicate(page,serial_types,offsets,row_id,0):
+        return None
+    return plan.decode(page,serial_types,offsets,row_id)
+
+def read_overflow_record(page,offset,payload_size,row_id,plan,pg_cache):
+    """read_record for a spilled record, following the chain only as far as needed."""
+    payload = OverflowPayload(page,offset,payload_size,pg_cache)
+    serial_types, offsets = parse_record_header(0,payload.header(),plan.col_end)
+    if plan.predicate:
+        record = payload.read(columns_end(serial_types,offsets,plan.cond_idxs))
+        if not plan.predicate(record,serial_types,offsets,row_id,0):
+            return None
+    return plan.decode(payload.read(columns_end(serial_types,offsets,plan.col_idxs)),serial_types,offsets,row_id)
+
+def read_row(c_ptr,page,plan,pg_cache):
+    """Reads one table leaf cell, returning None if it fails the predicate."""
+    payload_size, row_id, offset = parse_table_cell(c_ptr,page)
+    if payload_size > pg_cache.usable_sz-35:
+        if _profiling.stats is not None:
+            _profiling.stats.cells += 1
+        return read_overflow_record(page,offset,payload_size,row_id,plan,pg_cache)
+    return read_record(offset,page,row_id,plan)
+
+def parse_table_cell(offset,page):
+    """Payload size, rowid and record offset of a table leaf cell."""
+    payload_size, bytes_read = read_varint(page,offset)
+    offset += bytes_read
+    row_id, bytes_read = read_varint(page,offset)
+    return payload_size, row_id, offset+bytes_read
 
 def parseTCellheader(offset,page):
     payload_size, bytes_read = read_varint(page,offset)
@@ -152,50 +1003,30 @@ def parseTCellheader(offset,page):
     offset += bytes_read
     return row_id, offset
 
-def parseTCellbody(offset,page):
-    record_hdr_sz, bytes_read = read_varint(page,offset)
-    record_body_start = offset+record_hdr_sz
-    offset += bytes_read
-    serial_types = []
-    while offset < record_body_start:
-        srl, bytes_read = read_varint(page,offset)
-        serial_types.append(srl)
-        offset += bytes_read
-    record = []
-    for srl_type in serial_types:
-        value, val_len = parse_record_body(srl_type,page,offset)
-        record.append(value)
-        offset += val_len
-    return record
-
 def binary_search_for_cell(c_id,cells,page):
+    """Pointer to the cell with rowid c_id, or None if there is none."""
+    if not len(cells):
+        return None
     start = 0
     end = len(cells)-1
-    while start != end:
+    while start < end:
         midcell = (start+end)>>1
         cell_id, record_start = parseTCellheader(cells[midcell],page)
         if c_id == cell_id:
-            return record_start
+            return cells[midcell]
         if c_id < cell_id:
             end = midcell - 1
         elif c_id > cell_id:
             start = midcell + 1
     cell_id, record_start = parseTCellheader(cells[start],page)
-    return record_start if c_id == cell_id else 0
-
-def get_record_by_id(c_id,page,cells,tdesc,query_ref):
-    cell_record_offset = binary_search_for_cell(c_id,cells,page)
-    if cell_record_offset:
-        cell = parseTCellbody(cell_record_offset,page)
-        record = []
-        for col in query_ref.col_names:
-            data = cell[tdesc.col_names.index(col)]
-            if col == "id" and not data:
-                data = c_id
-            record.append(data)
-        return record
+    return cells[start] if c_id == cell_id else None
+
+def get_record_by_id(c_id,page,cells,plan,pg_cache):
+    c_ptr = binary_search_for_cell(c_id,cells,page)
+    if c_ptr is not None:
+        return read_row(c_ptr,page,plan,pg_cache)
     else:
-        return []
+        return None
 
 def parse_interior_header(page):
     cell_amt = read_int(page,3,2)
@@ -221,12 +1052,14 @@ def parse_ITCells(page,cell_ptrs):
         keys.append(cell)
     return pages, keys
 
-def travel_tables(pg_num,db_file,pg_sz,tdesc,query_ref,c_sel=None):
-    page = read_page(db_file,pg_num,pg_sz)
+def travel_tables(pg_num,pg_cache,plan,c_sel=None):
+    with pg_cache.pinned(pg_num) as page:
+        yield from _travel_table_page(page,pg_cache,plan,c_sel)
+
+def _travel_table_page(page,pg_cache,plan,c_sel):
     if page[0] == PageType.InteriorTable:
         cell_ptrs, last_pg_num = parse_interior_header(page)
         pages, keys = parse_ITCells(page,cell_ptrs)
-        records = []
         if c_sel:
             sel_end = 0
             sel_start = sel_end
@@ -234,185 +1067,2319 @@ def travel_tables(pg_num,db_file,pg_sz,tdesc,query_ref,c_sel=None):
             for idx, key in enumerate(keys):
                 if sel_end >= sel_len:
                     break
-                if key <= c_sel[sel_end]:
+                if key < c_sel[sel_end]:
                     continue
                 while sel_end < sel_len and c_sel[sel_end] <= key:
                     sel_end += 1
-                records.extend(travel_tables(pages[idx],db_file,pg_sz,tdesc,query_ref,c_sel[sel_start:sel_end]))
+                yield from travel_tables(pages[idx],pg_cache,plan,c_sel[sel_start:sel_end])
                 sel_start = sel_end
             if sel_end < sel_len:
-                records.extend(travel_tables(last_pg_num,db_file,pg_sz,tdesc,query_ref,c_sel[sel_start:]))
+                yield from travel_tables(last_pg_num,pg_cache,plan,c_sel[sel_start:])
         else:
-            for pg in pages:
-                records.extend(travel_tables(pg,db_file,pg_sz,tdesc,query_ref))
-            records.extend(travel_tables(last_pg_num,db_file,pg_sz,tdesc,query_ref))
-        return records
+            pages.append(last_pg_num)
+            for pg in read_ahead(pg_cache,pages):
+                yield from travel_tables(pg,pg_cache,plan)
     elif page[0] == PageType.LeafTable:
         cell_ptrs = parse_leaf_header(page)
         if c_sel:
-            return [get_record_by_id(cs,page,cell_ptrs,tdesc,query_ref) for cs in c_sel]
+            for cs in c_sel:
+                record = get_record_by_id(cs,page,cell_ptrs,plan,pg_cache)
+                if record is not None:
+                    yield record
         else:
-            return get_records(page,cell_ptrs,tdesc,query_ref)
+            yield from get_records(page,cell_ptrs,plan,pg_cache)
     
-def get_db_schema(page,cell_ptrs):
-    db_objs = {"tables":{},"indexes":{}}
-    for cptr in cell_ptrs:
-        cell = parse_TCell(cptr,page)[0]
-        if cell[1].startswith("sqlite_"):
-            continue
-        obj = {cell[1]:{"pg_num":cell[3],"query":sp.parse(cell[4])}}
-        if cell[0] == "table":
-            db_objs["tables"].update(obj)
-        elif cell[0] == "index":
-            obj[cell[1]]["table"] = cell[2]
-            db_objs["indexes"].update(obj)
+def _interior_key(page,idx):
+    return parse_TKCell(read_int(page,12+(idx<<1),2)+4,page)
+
+def _interior_child(page,idx,cell_amt):
+    if idx < cell_amt:
+        return read_int(page,read_int(page,12+(idx<<1),2),4)
+    return read_int(page,8,4)
+
+def _leaf_rowid(page,idx):
+    return parseTCellheader(read_int(page,8+(idx<<1),2),page)[0]
+
+def _bisect_cells(page,cell_amt,key_at,rowid):
+    """Index of the first cell whose key is >= rowid, or cell_amt if none is."""
+    start = 0
+    end = cell_amt
+    while start < end:
+        mid_cell = (start+end)>>1
+        if key_at(page,mid_cell) < rowid:
+            start = mid_cell + 1
+        else:
+            end = mid_cell
+    return start
+
+def travel_table_range(pg_num,pg_cache,plan,low=None,high=None,reverse=False):
+    """Yields the rows with low <= rowid <= high, either bound None when open."""
+    with pg_cache.pinned(pg_num) as page:
+        cell_amt = read_int(page,3,2)
+        if page[0] == PageType.InteriorTable:
+            # Child i holds the rowids up to key i, the right-most child the rest
+            start = 0 if low is None else _bisect_cells(page,cell_amt,_interior_key,low)
+            end = cell_amt if high is None else _bisect_cells(page,cell_amt,_interior_key,high)
+            children = range(start,end+1)
+            child_pages = [_interior_child(page,idx,cell_amt) for idx in (reversed(children) if reverse else children)]
+            for pg in read_ahead(pg_cache,child_pages):
+                yield from travel_table_range(pg,pg_cache,plan,low,high,reverse)
+        elif page[0] == PageType.LeafTable:
+            start = 0 if low is None else _bisect_cells(page,cell_amt,_leaf_rowid,low)
+            end = cell_amt if high is None else _bisect_cells(page,cell_amt,_leaf_rowid,high+1)
+            cells = range(start,end)
+            for idx in (reversed(cells) if reverse else cells):
+                row = read_row(read_int(page,8+(idx<<1),2),page,plan,pg_cache)
+                if row is not None:
+                    yield row
+    
+class BTreeStats:
+    def __init__(self,pages,depth,rows,max_rowid=None):
+        self.pages = pages
+        self.depth = depth
+        self.rows = rows
+        self.max_rowid = max_rowid
+
+def btree_levels(pg_num,pg_cache):
+    """Yields the page numbers of each level of the B-tree at pg_num, root first."""
+    level = [pg_num]
+    while True:
+        yield level
+        if pg_cache.get_page(level[0])[0] in (PageType.LeafTable,PageType.LeafIndex):
+            return
+        next_level = []
+        for pg in level:
+            page = pg_cache.get_page(pg)
+            cell_ptrs, last_pg_num = parse_interior_header(page)
+            next_level.extend(read_int(page,c_ptr,4) for c_ptr in cell_ptrs)
+            next_level.append(last_pg_num)
+        level = next_level
+
+def sample_btree(pg_num,pg_cache):
+    """BTreeStats estimated from the leftmost path, and for tables the largest rowid."""
+    root_pg = pg_num
+    pages = width = 1
+    depth = 0
+    while True:
+        page = pg_cache.get_page(pg_num)
+        depth += 1
+        if page[0] in (PageType.LeafTable,PageType.LeafIndex):
+            break
+        width *= read_int(page,3,2)+1
+        pages += width
+        pg_num = read_int(page,read_int(page,12,2),4)
+    stats = BTreeStats(pages,depth,width*read_int(page,3,2))
+    if page[0] == PageType.LeafTable:
+        page = pg_cache.get_page(root_pg)
+        while page[0] == PageType.InteriorTable:
+            page = pg_cache.get_page(read_int(page,8,4))
+        cell_amt = read_int(page,3,2)
+        stats.max_rowid = _leaf_rowid(page,cell_amt-1) if cell_amt else 0
+    return stats
+
+def count_table_cells(pg_num,pg_cache):
+    """Rows below a table B-tree page, summed from leaf cell counts."""
+    with pg_cache.pinned(pg_num) as page:
+        if page[0] == PageType.LeafTable:
+            return read_int(page,3,2)
+        cell_ptrs, last_pg_num = parse_interior_header(page)
+        child_pages = [read_int(page,c_ptr,4) for c_ptr in cell_ptrs]
+    child_pages.append(last_pg_num)
+    return sum(count_table_cells(pg,pg_cache) for pg in read_ahead(pg_cache,child_pages))
+
+def limit_rows(rows,query_ref):
+    if query_ref.limit is None:
+        return islice(rows,query_ref.offset,None)
+    return islice(rows,query_ref.offset,query_ref.offset+query_ref.limit)
+    
+CATALOG_VERSION = 3
+SCHEMA_TABLE = sp.parse("CREATE TABLE sqlite_schema (type text, name text, tbl_name text, rootpage integer, sql text)")
+STAT1_TABLE = sp.parse("CREATE TABLE sqlite_stat1 (tbl text, idx text, stat text)")
+
+class SchemaCatalog:
+    """Parsed schema and planner statistics, valid while the schema cookie is unchanged."""
+    # Row counts come from sqlite_stat1 when ANALYZE filled it in, else from
+    # B-trees sampled when the catalog is read
+    def __init__(self,cookie):
+        self.version = CATALOG_VERSION
+        self.cookie = cookie
+        self.tables = {}
+        self.indexes = {}
+        self.col_indexes = {}
+        self.table_indexes = {}
+        self.stat1_pg = None
+        self.stat1 = {}
+        self.sizes = {}
+        self.statements = OrderedDict()
+        
+    def add(self,obj_type,name,tbl_name,root_pg,sql):
+        if name == "sqlite_stat1":
+            self.stat1_pg = root_pg
+        if name.startswith("sqlite_") or obj_type not in ("table","index"):
+            # Internal tables, views and triggers are not queried through the catalog
+            return
+        self.add_parsed(obj_type,name,tbl_name,root_pg,sp.parse(sql))
+
+    def add_parsed(self,obj_type,name,tbl_name,root_pg,query):
+        obj = {"pg_num":root_pg,"query":query}
+        if obj_type == "table":
+            self.tables[name] = obj
+            return
+        obj["table"] = tbl_name
+        obj["name"] = name
+        self.indexes[name] = obj
+        self.table_indexes.setdefault(tbl_name,[]).append(obj)
+        key = (tbl_name,obj["query"].col_names[0])
+        if key not in self.col_indexes or len(obj["query"].col_names) < len(self.col_indexes[key]["query"].col_names):
+            # The narrowest index starting with the column has the most entries per page
+            self.col_indexes[key] = obj
+
+    def read_stats(self,pg_cache):
+        """Reads sqlite_stat1 and samples the B-tree of every table and index."""
+        if self.stat1_pg is not None:
+            for tbl, idx, stat in travel_tables(self.stat1_pg,pg_cache,ScanPlan(STAT1_TABLE,STAT1_TABLE.col_names)):
+                nums = []
+                for tok in str(stat or "").split():
+                    if not tok.isdigit():
+                        # Flags such as unordered or sz=n follow the numbers
+                        break
+                    nums.append(int(tok))
+                if nums:
+                    self.stat1[(tbl,idx)] = nums
+        for obj in list(self.tables.values())+list(self.indexes.values()):
+            self.sizes[obj["pg_num"]] = sample_btree(obj["pg_num"],pg_cache)
+
+    def index_collation(self,index,pos):
+        """Collation of an indexed column: its COLLATE in the index, else the column's."""
+        collation = index["query"].col_collations[pos]
+        if collation:
+            return collation
+        return column_collation(self.tables[index["table"]]["query"],index["query"].col_names[pos])
+
+    def index_name(self,index):
+        return index["name"]
+
+    def index_on(self,table_name,col,collation=sp.Collation.BINARY):
+        """The index starting with column col, if its keys are ordered by collation."""
+        index = self.col_indexes.get((table_name,col))
+        if index is None or self.index_collation(index,0) != collation:
+            return None
+        return index
+
+    def table_rows(self,table_name):
+        stats = [self.stat1.get((table_name,None))]
+        stats += [self.stat1.get((table_name,index["name"])) for index in self.table_indexes.get(table_name,())]
+        stat = next((stat for stat in stats if stat),None)
+        if stat is not None:
+            return stat[0]
+        return self.sizes[self.tables[table_name]["pg_num"]].rows
+
+    def prefix_rows(self,index,eq_len):
+        """Estimated entries of index sharing one value of its first eq_len columns."""
+        rows = self.table_rows(index["table"])
+        if not eq_len:
+            return rows
+        stat = self.stat1.get((index["table"],index["name"]))
+        if stat and len(stat) > eq_len:
+            return stat[eq_len]
+        return rows*EQ_SELECTIVITY**eq_len
+
+    def depth(self,obj):
+        return self.sizes[obj["pg_num"]].depth
+
+    def to_json(self):
+        # Plain values only: parsed CREATE statements hold no expressions
+        objs = [["table",name,name,obj["pg_num"],vars(obj["query"])] for name, obj in self.tables.items()]
+        objs += [["index",name,obj["table"],obj["pg_num"],vars(obj["query"])] for name, obj in self.indexes.items()]
+        return {"version":self.version,"cookie":self.cookie,"objects":objs,"stat1_pg":self.stat1_pg,
+                "stat1":[[tbl,idx,nums] for (tbl,idx), nums in self.stat1.items()],
+                "sizes":[[pg,size.pages,size.depth,size.rows,size.max_rowid] for pg, size in self.sizes.items()]}
+
+    @classmethod
+    def from_json(cls,data):
+        catalog = cls(data["cookie"])
+        for obj_type, name, tbl_name, root_pg, state in data["objects"]:
+            query = sp.ParsedQuery()
+            query.__dict__.update(state)
+            catalog.add_parsed(obj_type,name,tbl_name,root_pg,query)
+        catalog.stat1_pg = data["stat1_pg"]
+        catalog.stat1 = {(tbl,idx):nums for tbl, idx, nums in data["stat1"]}
+        catalog.sizes = {pg:BTreeStats(*size) for pg, *size in data["sizes"]}
+        return catalog
+
+def schema_cookie(pg_cache):
+    return read_int(pg_cache.get_page(1),40,4)
+
+def schema_rows(pg_cache):
+    """Rows of sqlite_schema, whose root is page 1 after the file header."""
+    page = pg_cache.get_page(1)
+    plan = ScanPlan(SCHEMA_TABLE,SCHEMA_TABLE.col_names)
+    cell_amt = read_int(page,103,2)
+    if page[100] == PageType.LeafTable:
+        yield from get_records(page,[read_int(page,i,2) for i in range(108,108+(cell_amt<<1),2)],plan,pg_cache)
+        return
+    child_pages = [read_int(page,read_int(page,i,2),4) for i in range(112,112+(cell_amt<<1),2)]
+    child_pages.append(read_int(page,108,4))
+    for pg in child_pages:
+        yield from travel_tables(pg,pg_cache,plan)
+
+def read_catalog(pg_cache):
+    catalog = SchemaCatalog(schema_cookie(pg_cache))
+    for row in schema_rows(pg_cache):
+        catalog.add(*row)
+    catalog.read_stats(pg_cache)
+    return catalog
+
+def _sidecar_path(pg_cache):
+    return pg_cache.db_file.name+"-catalog"
+
+def _sidecar_identity(pg_cache):
+    # Schema cookies are small counters that unrelated or recreated databases
+    # share, so the file and its change counter are matched as well
+    st = os.fstat(pg_cache.db_file.fileno())
+    return [CATALOG_VERSION,st.st_ino,st.st_size,st.st_mtime_ns,read_int(pg_cache.get_page(1),24,4),schema_cookie(pg_cache)]
+
+def load_catalog(pg_cache,catalog=None,sidecar=CATALOG_SIDECAR):
+    """Returns catalog if still current, else the sidecar catalog or a fresh one."""
+    cookie = schema_cookie(pg_cache)
+    if catalog is not None and catalog.cookie == cookie:
+        return catalog
+    if sidecar:
+        import json
+        identity = _sidecar_identity(pg_cache)
+        try:
+            with open(_sidecar_path(pg_cache)) as sc_file:
+                data = json.load(sc_file)
+            if data["identity"] == identity:
+                return SchemaCatalog.from_json(data["catalog"])
+        except (OSError,ValueError,TypeError,KeyError,IndexError,AttributeError):
+            # A missing, stale or corrupt sidecar is rebuilt from the schema
+            pass
+    catalog = read_catalog(pg_cache)
+    if sidecar:
+        tmp_path = f"{_sidecar_path(pg_cache)}.{os.getpid()}"
+        try:
+            with open(tmp_path,"w") as sc_file:
+                json.dump({"identity":identity,"catalog":catalog.to_json()},sc_file)
+            os.replace(tmp_path,_sidecar_path(pg_cache))
+        except (OSError,TypeError,ValueError):
+            # Saving is only an optimisation, e.g. the directory may be read only
+            pass
+    return catalog
+
+def index_key(values,collations=None):
+    if collations is None:
+        return tuple(sp.value_key(val) for val in values)
+    return tuple(sp.collate_key(val,collation) for val, collation in zip(values,collations))
+
+class KeyRange:
+    """Bounds on the leading columns of an index, None when open, under their collations."""
+    def __init__(self,low=None,low_incl=True,high=None,high_incl=True,collations=None):
+        self.low = low
+        self.low_incl = low_incl
+        self.high = high
+        self.high_incl = high_incl
+        self.collations = collations
+        
+    @classmethod
+    def from_cond(cls,cond):
+        """Key range a single WHERE term matches, or None if an index cannot narrow it."""
+        if not isinstance(cond,sp.QueryCond) or cond.negated:
+            return None
+        if cond.op == sp.WhereCmp.LIKE and cond.has_params():
+            # Whether a pattern maps to a range is only known once it is bound
+            return None
+        no_nulls = ((None,),False)
+        if cond.op in CMP_FUNCS and cond.op != sp.WhereCmp.NE:
+            if cond.value is None:
+                return None
+            val = (cond.value,)
+            if cond.op == sp.WhereCmp.EQ:
+                return cls(val,True,val,True)
+            if cond.op == sp.WhereCmp.LT:
+                return cls(*no_nulls,val,False)
+            if cond.op == sp.WhereCmp.LE:
+                return cls(*no_nulls,val,True)
+            if cond.op == sp.WhereCmp.GT:
+                return cls(val,False)
+            return cls(val,True)
+        if cond.op == sp.WhereCmp.BETWEEN:
+            low, high = cond.value
+            if low is None or high is None:
+                return None
+            return cls((low,),True,(high,),True)
+        if cond.op == sp.WhereCmp.LIKE:
+            # LIKE folds ASCII case, so only prefixes without letters map to one range
+            prefix = cond.value[:-1]
+            if not cond.value.endswith("%") or not prefix or re.search("[%_a-zA-Z]",prefix):
+                return None
+            return cls((prefix,),True,(prefix[:-1]+chr(ord(prefix[-1])+1),),False)
+        return None
+    
+    @staticmethod
+    def is_exact(cond):
+        """True if the range of cond matches exactly its rows, so it needs no recheck."""
+        return cond.op != sp.WhereCmp.LIKE
+    
+    def key(self,values):
+        return index_key(values,self.collations)
+    
+    def intersect(self,other):
+        low, low_incl, high, high_incl = self.low, self.low_incl, self.high, self.high_incl
+        if other.low is not None:
+            if low is None or self.key(other.low) > self.key(low):
+                low, low_incl = other.low, other.low_incl
+            elif self.key(other.low) == self.key(low):
+                low_incl = low_incl and other.low_incl
+        if other.high is not None:
+            if high is None or self.key(other.high) < self.key(high):
+                high, high_incl = other.high, other.high_incl
+            elif self.key(other.high) == self.key(high):
+                high_incl = high_incl and other.high_incl
+        return KeyRange(low,low_incl,high,high_incl,self.collations)
+    
+    def above_high(self,entry):
+        if self.high is None:
+            return False
+        key = self.key(entry[:len(self.high)])
+        high = self.key(self.high)
+        return key > high or (key == high and not self.high_incl)
+    
+    def below_low(self,entry):
+        if self.low is None:
+            return False
+        key = self.key(entry[:len(self.low)])
+        low = self.key(self.low)
+        return key < low or (key == low and not self.low_incl)
+
+class IndexCursor:
+    """Ordered cursor over an index B-tree."""
+    # The path to the current entry is a stack of [pg_num,page,cell_ptrs,right_ptr,idx]
+    # frames, each page pinned. idx is the cell in a leaf, the child being visited
+    # in an interior frame, or the current entry when that frame is on top
+    def __init__(self,pg_cache,root_pg):
+        self.pg_cache = pg_cache
+        self.root_pg = root_pg
+        self._stack = []
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self,*exc_info):
+        self.close()
+        
+    @property
+    def valid(self):
+        return bool(self._stack)
+        
+    def close(self):
+        while self._stack:
+            self._pop()
+        
+    def _push(self,pg_num):
+        page = self.pg_cache.pin(pg_num)
+        if page[0] == PageType.InteriorIndex:
+            cell_ptrs, right_ptr = parse_interior_header(page)
         else:
-            print("Invalid database object",cell[0])
-    return db_objs
+            cell_ptrs, right_ptr = parse_leaf_header(page), None
+        frame = [pg_num,page,cell_ptrs,right_ptr,0]
+        self._stack.append(frame)
+        return frame
+    
+    def _pop(self):
+        self.pg_cache.unpin(self._stack.pop()[0])
+        
+    def _child(self,frame,idx):
+        if idx < len(frame[2]):
+            return read_int(frame[1],frame[2][idx],4)
+        return frame[3]
+    
+    def _cell_entry(self,frame,idx):
+        c_ptr = frame[2][idx]
+        return parse_ICell(c_ptr if frame[3] is None else c_ptr+4,frame[1],self.pg_cache)
+    
+    def entry(self):
+        """The record of the current entry: the indexed columns then the rowid."""
+        if _profiling.stats is not None:
+            _profiling.stats.cells += 1
+        return self._cell_entry(self._stack[-1],self._stack[-1][4])
+    
+    def _descend_first(self,pg_num):
+        while True:
+            frame = self._push(pg_num)
+            if frame[3] is None:
+                return bool(frame[2]) or self._ascend_next()
+            pg_num = self._child(frame,0)
+            
+    def _descend_last(self,pg_num):
+        while True:
+            frame = self._push(pg_num)
+            if frame[3] is None:
+                frame[4] = len(frame[2])-1
+                return frame[4] >= 0 or self._ascend_prev()
+            frame[4] = len(frame[2])
+            pg_num = frame[3]
+            
+    def _ascend_next(self):
+        self._pop()
+        while self._stack:
+            frame = self._stack[-1]
+            if frame[4] < len(frame[2]):
+                return True
+            self._pop()
+        return False
+    
+    def _ascend_prev(self):
+        self._pop()
+        while self._stack:
+            frame = self._stack[-1]
+            if frame[4] > 0:
+                frame[4] -= 1
+                return True
+            self._pop()
+        return False
+            
+    def first(self):
+        self.close()
+        return self._descend_first(self.root_pg)
+    
+    def last(self):
+        self.close()
+        return self._descend_last(self.root_pg)
+    
+    def next(self):
+        frame = self._stack[-1]
+        frame[4] += 1
+        if frame[3] is not None:
+            return self._descend_first(self._child(frame,frame[4]))
+        return frame[4] < len(frame[2]) or self._ascend_next()
+    
+    def prev(self):
+        frame = self._stack[-1]
+        if frame[3] is not None:
+            return self._descend_last(self._child(frame,frame[4]))
+        frame[4] -= 1
+        return frame[4] >= 0 or self._ascend_prev()
+    
+    def seek(self,key,inclusive=True,collations=None):
+        """Moves to the first entry >= key, or > key when not inclusive; False if none."""
+        self.close()
+        target = index_key(key,collations)
+        key_len = len(key)
+        pg_num = self.root_pg
+        while True:
+            frame = self._push(pg_num)
+            start = 0
+            end = len(frame[2])
+            while start < end:
+                mid_cell = (start+end)>>1
+                cell_key = index_key(self._cell_entry(frame,mid_cell)[:key_len],collations)
+                if cell_key < target or (cell_key == target and not inclusive):
+                    start = mid_cell + 1
+                else:
+                    end = mid_cell
+            frame[4] = start
+            if frame[3] is None:
+                return start < len(frame[2]) or self._ascend_next()
+            pg_num = self._child(frame,start)
+            
+    def seek_last(self,key,inclusive=True,collations=None):
+        """Moves to the last entry <= key, or < key when not inclusive."""
+        if self.seek(key,not inclusive,collations):
+            return self.prev()
+        return self.last()
+    
+    def scan(self,key_range=None,reverse=False):
+        """Yields the entries in key_range in index order or reverse, then unpins."""
+        key_range = key_range or KeyRange()
+        try:
+            if reverse:
+                if key_range.high is not None:
+                    valid = self.seek_last(key_range.high,key_range.high_incl,key_range.collations)
+                else:
+                    valid = self.last()
+                while valid:
+                    entry = self.entry()
+                    if key_range.below_low(entry):
+                        break
+                    yield entry
+                    valid = self.prev()
+            else:
+                if key_range.low is not None:
+                    valid = self.seek(key_range.low,key_range.low_incl,key_range.collations)
+                else:
+                    valid = self.first()
+                while valid:
+                    entry = self.entry()
+                    if key_range.above_high(entry):
+                        break
+                    yield entry
+                    valid = self.next()
+        finally:
+            self.close()
+
+def travel_idxs(key_range,pg_num,pg_cache,reverse=False):
+    """Yields the index entries in key_range, each the indexed values then the rowid."""
+    yield from IndexCursor(pg_cache,pg_num).scan(key_range,reverse)
+
+def and_terms(cond):
+    """The top-level ANDed terms of cond, or cond itself."""
+    if cond is None:
+        return []
+    if isinstance(cond,sp.QueryCondGroup) and cond.join == sp.CondJoin.AND:
+        return cond.conds
+    return [cond]
+
+def and_cond(terms):
+    if not terms:
+        return None
+    return terms[0] if len(terms) == 1 else sp.QueryCondGroup(sp.CondJoin.AND,terms)
+
+def terms_range(terms,collations=None):
+    """Intersected key range of the terms on one column, or None if one compares with NULL."""
+    key_range = KeyRange(collations=collations)
+    for term in terms:
+        term_range = KeyRange.from_cond(term)
+        if term_range is None:
+            return None
+        key_range = key_range.intersect(term_range)
+    return key_range
 
-def get_valid_index(indexes,table_name,col):
-    for idxkey, index in indexes.items():
-        if index["table"] != table_name:
+EQ_SELECTIVITY = 0.1
+RANGE_SELECTIVITY = 0.5
+# Rows decoded by a table scan that one row fetched by rowid from an index
+# costs, and the cost of sorting a row
+LOOKUP_COST = 3
+SORT_COST = 0.2
+
+def term_selectivity(term):
+    """Share of rows a WHERE term is taken to keep without column statistics."""
+    if not isinstance(term,sp.QueryCond):
+        return RANGE_SELECTIVITY
+    if term.op in (sp.WhereCmp.EQ,sp.WhereCmp.IN,sp.WhereCmp.ISNULL):
+        return EQ_SELECTIVITY
+    if term.op in (sp.WhereCmp.BETWEEN,sp.WhereCmp.LIKE):
+        return RANGE_SELECTIVITY**2
+    return RANGE_SELECTIVITY
+
+def index_range(terms,cols,collations=None):
+    """Key range over the index columns cols from bound terms, or None if it matches nothing."""
+    if not cols:
+        return KeyRange()
+    prefix = []
+    for col in cols[:-1]:
+        val = next(term.value for term in terms if term.col == col)
+        if val is None:
+            return None
+        prefix.append(val)
+    last = terms_range([term for term in terms if term.col == cols[-1]],collations and collations[-1:])
+    if last is None or not prefix:
+        return last
+    prefix = tuple(prefix)
+    low, low_incl = (prefix,True) if last.low is None else (prefix+last.low,last.low_incl)
+    high, high_incl = (prefix,True) if last.high is None else (prefix+last.high,last.high_incl)
+    return KeyRange(low,low_incl,high,high_incl,collations)
+
+class IndexAccess:
+    """How a query reads an index: the seek terms, the columns they bound and the residual."""
+    def __init__(self,index,used,residual,ordered=False,reverse=False,equality=False,cols=(),cost=None,collations=None):
+        self.index = index
+        self.used = used
+        self.residual = residual
+        self.ordered = ordered
+        self.reverse = reverse
+        self.equality = equality
+        self.cols = list(cols)
+        self.cost = cost
+        self.collations = collations
+
+def index_prefix(catalog,index,terms):
+    """The terms index can seek with, one list per leading column."""
+    # Equalities on a leading run, then the range terms on the next column. A
+    # term only bounds a column the index orders by the term's collation, and
+    # a LIKE prefix, a text range, only a column holding nothing but text
+    tdesc = catalog.tables[index["table"]]["query"]
+    prefix = []
+    for pos, col in enumerate(index["query"].col_names):
+        collation = catalog.index_collation(index,pos)
+        text_only = affinity_of(tdesc,col) == Affinity.TEXT
+        col_terms = [term for term in terms if KeyRange.from_cond(term) is not None
+                     and term.col == col and term.collation == collation
+                     and (text_only or term.op != sp.WhereCmp.LIKE)]
+        eq_term = next((term for term in col_terms if term.op == sp.WhereCmp.EQ),None)
+        if eq_term is not None:
+            prefix.append([eq_term])
             continue
-        if len(index["query"].col_names) != 1:
+        if col_terms:
+            prefix.append(col_terms)
+        break
+    return prefix
+
+def index_order(catalog,index,tdesc,order_by,start,collations):
+    """True if index yields ORDER BY order, or its reverse, with its first start columns fixed."""
+    cols = index["query"].col_names
+    if not order_by or len(order_by) > len(cols)-start or any(desc != order_by[0][1] for col, desc in order_by):
+        return False
+    return all(cols[pos] == col and catalog.index_collation(index,pos) == collation
+               for pos, ((col,desc),collation) in enumerate(zip(order_by,sort_collations(tdesc,order_by,collations)),start))
+
+def choose_index_access(catalog,tdesc,table_name,cond,order_by,order_collations,out_cols,limit=None):
+    """The cheapest index for the query, or None when a table scan costs less."""
+    # Cost in rows decoded: entries in range, a rowid lookup each unless
+    # covering, and a sort unless the index gives the ORDER BY order
+    terms = and_terms(cond)
+    table_rows = catalog.table_rows(table_name)
+    out_rows = table_rows
+    for term in terms:
+        out_rows *= term_selectivity(term)
+    sort_cost = out_rows*SORT_COST if order_by else 0
+    best, best_cost = None, table_rows+sort_cost
+    for index in catalog.table_indexes.get(table_name,()):
+        prefix = index_prefix(catalog,index,terms)
+        eq_len = sum(1 for col_terms in prefix if col_terms[0].op == sp.WhereCmp.EQ)
+        ordered = index_order(catalog,index,tdesc,order_by,eq_len,order_collations)
+        if not prefix and not ordered:
             continue
-        if index["query"].col_names[0] == col:
+        used = [term for col_terms in prefix for term in col_terms]
+        residual = and_cond([term for term in terms if term not in used or not KeyRange.is_exact(term)])
+        entries = catalog.prefix_rows(index,eq_len)
+        if eq_len < len(prefix):
+            for term in prefix[-1]:
+                entries *= term_selectivity(term)
+        if ordered and limit is not None:
+            # Each row out of the residual terms takes entries/out_rows entries
+            entries = min(entries,limit*entries/max(out_rows,1))
+        covering = covering_columns(index,tdesc,out_cols,residual) is not None
+        cost = catalog.depth(index)+entries*(1 if covering else LOOKUP_COST)+(0 if ordered else sort_cost)
+        if cost < best_cost:
+            cols = index["query"].col_names[:len(prefix)]
+            collations = [catalog.index_collation(index,pos) for pos in range(len(prefix))]
+            best = IndexAccess(index,used,residual,ordered,ordered and order_by[0][1],bool(prefix) and eq_len == len(prefix),cols,cost,collations)
+            best_cost = cost
+    return best
+
+def _is_number(val):
+    return isinstance(val,(int,float)) and not math.isnan(val)
+
+def rowid_bounds(key_range):
+    """Integer rowid bounds of a key range, or None if a bound is not numeric."""
+    bounds = []
+    for bound, incl, is_low in ((key_range.low,key_range.low_incl,True),(key_range.high,key_range.high_incl,False)):
+        if bound is None or bound[0] is None:
+            bounds.append(None)
+        elif not _is_number(bound[0]):
+            return None
+        elif is_low:
+            bounds.append(math.floor(bound[0])+1 if not incl or bound[0] != math.floor(bound[0]) else int(bound[0]))
+        else:
+            bounds.append(math.ceil(bound[0])-1 if not incl or bound[0] != math.ceil(bound[0]) else int(bound[0]))
+    return bounds
+
+class RowidAccess:
+    """Reads the table B-tree by rowid with the terms on the INTEGER PRIMARY KEY."""
+    def __init__(self,used,residual,ordered=False,reverse=False,equality=False):
+        self.used = used
+        self.residual = residual
+        self.ordered = ordered
+        self.reverse = reverse
+        self.equality = equality
+
+def _is_rowid_term(term,rowid_col):
+    if not isinstance(term,sp.QueryCond) or term.col != rowid_col or term.negated:
+        return False
+    if term.op == sp.WhereCmp.IN:
+        return True
+    if term.op == sp.WhereCmp.LIKE or (term_range := KeyRange.from_cond(term)) is None:
+        return False
+    # A ? is taken to be a number here and checked by rowid_seek once bound
+    return term.has_params() or rowid_bounds(term_range) is not None
+        
+def choose_rowid_access(tdesc,cond,order_by):
+    """RowidAccess from the rowid terms and ORDER BY, or None when none apply."""
+    rowid_idx = rowid_column(tdesc)
+    if rowid_idx is None:
+        return None
+    rowid_col = tdesc.col_names[rowid_idx]
+    terms = and_terms(cond)
+    used = [term for term in terms if _is_rowid_term(term,rowid_col)]
+    ordered = len(order_by) == 1 and order_by[0][0] == rowid_col
+    if not used and not ordered:
+        return None
+    residual = and_cond([term for term in terms if term not in used])
+    if any(term.op == sp.WhereCmp.IN for term in used):
+        return RowidAccess(used,residual,ordered and not order_by[0][1],False,True)
+    equality = any(term.op == sp.WhereCmp.EQ for term in used)
+    return RowidAccess(used,residual,ordered,ordered and order_by[0][1],equality)
+
+def rowid_seek(terms):
+    """Inclusive rowid bounds and sorted IN rowids of bound terms, or None if not numeric."""
+    key_range = KeyRange()
+    rowids = None
+    for term in terms:
+        if term.op == sp.WhereCmp.IN:
+            # A rowid can only equal a whole number
+            in_rowids = {int(val) for val in term.value if _is_number(val) and val == math.floor(val)}
+            rowids = in_rowids if rowids is None else rowids & in_rowids
+            continue
+        term_range = KeyRange.from_cond(term)
+        if term_range is None:
+            # Compared with NULL
+            return None, None, []
+        if rowid_bounds(term_range) is None:
+            return None
+        key_range = key_range.intersect(term_range)
+    low, high = rowid_bounds(key_range)
+    if rowids is not None:
+        rowids = sorted(r for r in rowids if (low is None or r >= low) and (high is None or r <= high))
+    return low, high, rowids
+
+SPILL_BLOCK_ROWS = 1024
+
+class _Desc:
+    """Reverses a sort key, for DESC columns in an ORDER BY mixing directions."""
+    __slots__ = ("key",)
+    
+    def __init__(self,key):
+        self.key = key
+        
+    def __eq__(self,other):
+        return self.key == other.key
+    
+    def __lt__(self,other):
+        return other.key < self.key
+
+def sort_key(out_len,order_by,collations):
+    """Key function over the ORDER BY values after out_len columns, and whether to reverse."""
+    terms = [(out_len+pos,collation,desc) for pos, ((col,desc),collation) in enumerate(zip(order_by,collations))]
+    collate_key = sp.collate_key
+    if len({desc for pos, collation, desc in terms}) > 1:
+        return lambda row: tuple(_Desc(collate_key(row[pos],collation)) if desc else collate_key(row[pos],collation)
+                                 for pos, collation, desc in terms), False
+    if len(terms) == 1:
+        pos, collation, desc = terms[0]
+        return lambda row: collate_key(row[pos],collation), desc
+    return lambda row: tuple(collate_key(row[pos],collation) for pos, collation, desc in terms), terms[0][2]
+
+def _spill_run(rows):
+    import pickle, tempfile
+    run = tempfile.TemporaryFile()
+    for start in range(0,len(rows),SPILL_BLOCK_ROWS):
+        pickle.dump(rows[start:start+SPILL_BLOCK_ROWS],run,pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+def _read_run(run):
+    import pickle
+    while True:
+        try:
+            block = pickle.load(run)
+        except EOFError:
+            return
+        yield from block
+
+def external_sort(rows,key,reverse=False,run_rows=SORT_MEMORY_ROWS):
+    """Sorts rows in memory runs of run_rows, spilling and merging larger inputs."""
+    rows = iter(rows)
+    runs = []
+    try:
+        while True:
+            chunk = list(islice(rows,run_rows))
+            chunk.sort(key=key,reverse=reverse)
+            if len(chunk) < run_rows:
+                break
+            runs.append(_spill_run(chunk))
+        if not runs:
+            yield from chunk
+            return
+        yield from heapq.merge(*(_read_run(run) for run in runs),chunk,key=key,reverse=reverse)
+    finally:
+        for run in runs:
+            run.close()
+
+def sort_rows(rows,out_len,order_by,collations=None,limit=None):
+    """Sorts rows on the ORDER BY values after out_len columns and strips them."""
+    # A limit keeps a bounded heap, otherwise large sorts spill; the sort is stable
+    key, reverse = sort_key(out_len,order_by,collations or [None]*len(order_by))
+    if limit is not None:
+        top = heapq.nlargest(limit,rows,key) if reverse else heapq.nsmallest(limit,rows,key)
+        return [row[:out_len] for row in top]
+    return (row[:out_len] for row in external_sort(rows,key,reverse))
+
+def lookup_rows(rowids,page_num,pg_cache,plan):
+    """Fetches rows one rowid at a time, keeping the order of rowids."""
+    for rowid in rowids:
+        yield from travel_table_range(page_num,pg_cache,plan,rowid,rowid)
+
+def index_columns(index,tdesc):
+    """Positions in an index entry of its columns, the rowid and the INTEGER PRIMARY KEY."""
+    col_pos = dict(index["query"].col_pos)
+    rowid_idx = rowid_column(tdesc)
+    if rowid_idx is not None:
+        col_pos.setdefault(tdesc.col_names[rowid_idx],-1)
+    return col_pos
+
+def covering_columns(index,tdesc,col_names,cond):
+    """index_columns if the index holds every column the query reads, else None."""
+    col_pos = index_columns(index,tdesc)
+    needed = col_names + (cond.columns() if cond else [])
+    return col_pos if all(col in col_pos for col in needed) else None
+
+def find_covering_index(catalog,table_name,tdesc,col_names,cond):
+    for index in catalog.table_indexes.get(table_name,()):
+        if covering_columns(index,tdesc,col_names,cond):
             return index
     return None
 
-def parse_IICells(page,cell_ptrs):
-    pages = []
-    keys = []
-    for c_ptr in cell_ptrs:
-        pg_num = read_int(page,c_ptr,4)
-        cell = parse_ICell(c_ptr+4,page)
-        pages.append(pg_num)
-        keys.append(cell)
-    return pages, keys
+def compile_entry_filter(cond,col_pos,tdesc=None):
+    """compile_predicate for decoded rows, col_pos giving each column's position."""
+    if isinstance(cond,sp.QueryCondGroup):
+        filters = [compile_entry_filter(sub_cond,col_pos,tdesc) for sub_cond in cond.conds]
+        if cond.join == sp.CondJoin.AND:
+            return lambda entry: all(entry_filter(entry) for entry_filter in filters)
+        return lambda entry: any(entry_filter(entry) for entry_filter in filters)
+    pos = col_pos[cond.col]
+    if isinstance(cond.value,sp.ColumnRef):
+        return _column_filter(cond,pos,col_pos[cond.value.col],tdesc)
+    if cond.op == sp.WhereCmp.LIKE and tdesc is not None and affinity_of(tdesc,cond.col) == Affinity.REAL:
+        return lambda entry: cond.comp(float(entry[pos]) if isinstance(entry[pos],int) else entry[pos])
+    return lambda entry: cond.comp(entry[pos])
 
-def binary_search_first(cell_ptrs,page,val):
-    start = 0
-    end = len(cell_ptrs)-1
-    while start != end:
-        mid_cell = (start+end)>>1
-        cell = parse_ICell(cell_ptrs[mid_cell],page)
-        if not cell[0] or val > cell[0]:
-            start = mid_cell + 1
-        elif val <= cell[0]:
-            end = mid_cell
-    cell = parse_ICell(cell_ptrs[start],page)
-    if not cell[0] or cell[0] != val:
-        return None, None
+def _column_filter(cond,pos,other_pos,tdesc):
+    affinity = comparison_affinity(affinity_of(tdesc,cond.col),affinity_of(tdesc,cond.value.col))
+    compare, collation = CMP_FUNCS[cond.op], cond.collation
+    def column_filter(entry):
+        left, right = entry[pos], entry[other_pos]
+        if left is None or right is None:
+            return False
+        return compare(sp.collate_key(apply_affinity(left,affinity),collation),sp.collate_key(apply_affinity(right,affinity),collation))
+    return column_filter
+
+def covering_rows(entries,col_pos,col_names,cond,tdesc=None):
+    """Answers a query from index entries alone, without touching the table."""
+    positions = [col_pos[col] for col in col_names]
+    real_pos = [idx for idx, col in enumerate(col_names) if tdesc and affinity_of(tdesc,col) == Affinity.REAL]
+    entry_filter = compile_entry_filter(cond,col_pos,tdesc) if cond else None
+    for entry in entries:
+        if entry_filter is None or entry_filter(entry):
+            row = [entry[pos] for pos in positions]
+            for idx in real_pos:
+                if isinstance(row[idx],int):
+                    row[idx] = float(row[idx])
+            yield row
+            
+INTEGER_TEXT_RE = re.compile(rb"\s*[+-]?\d+\s*")
+NUMERIC_PREFIX_RE = re.compile(rb"\s*[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?")
+
+def numeric_value(val):
+    """The number SUM and AVG add for a value, converting text as SQLite does."""
+    if not isinstance(val,(str,bytes)):
+        return val
+    raw = val.encode() if isinstance(val,str) else val
+    if isinstance(val,str) and INTEGER_TEXT_RE.fullmatch(raw) and INT64_MIN <= (num := int(raw)) <= INT64_MAX:
+        return num
+    match = NUMERIC_PREFIX_RE.match(raw)
+    return float(match.group()) if match else 0.0
+
+class Accumulator:
+    """Running state of one aggregate over one group."""
+    # step says whether MIN or MAX took the value; DISTINCT aggregates collect
+    # their values, keyed under their collation, until result
+    __slots__ = ("func","collation","distinct","count","total","is_real","best","best_key")
+    
+    def __init__(self,func,collation=None,distinct=False):
+        self.func = func
+        self.collation = collation
+        self.distinct = {} if distinct else None
+        self.count = 0
+        self.total = 0
+        self.is_real = False
+        self.best = None
+        self.best_key = None
+        
+    def _offer(self,val,key):
+        if self.best_key is not None and (key >= self.best_key if self.func == sp.AggFunc.MIN else key <= self.best_key):
+            return False
+        self.best, self.best_key = val, key
+        return True
+        
+    def step(self,val):
+        if val is None:
+            return False
+        if self.distinct is not None:
+            self.distinct.setdefault(sp.collate_key(val,self.collation),val)
+            return False
+        self.count += 1
+        if self.func == sp.AggFunc.SUM or self.func == sp.AggFunc.AVG:
+            num = numeric_value(val)
+            if isinstance(num,float):
+                self.is_real = True
+            self.total += num
+        elif self.func != sp.AggFunc.COUNT:
+            return self._offer(val,sp.collate_key(val,self.collation))
+        return False
+    
+    def merge(self,other):
+        if self.distinct is not None:
+            for key, val in other.distinct.items():
+                self.distinct.setdefault(key,val)
+            return False
+        self.count += other.count
+        self.total += other.total
+        self.is_real = self.is_real or other.is_real
+        return other.best_key is not None and self._offer(other.best,other.best_key)
+    
+    def result(self):
+        if self.distinct is not None:
+            acc = Accumulator(self.func,self.collation)
+            for val in self.distinct.values():
+                acc.step(val)
+            return acc.result()
+        if self.func == sp.AggFunc.COUNT:
+            return self.count
+        if self.func in (sp.AggFunc.MIN,sp.AggFunc.MAX):
+            return self.best
+        if not self.count:
+            return None
+        if self.func == sp.AggFunc.AVG:
+            return self.total/self.count
+        if self.is_real:
+            return float(self.total)
+        if not INT64_MIN <= self.total <= INT64_MAX:
+            raise OverflowError("integer overflow")
+        return self.total
+
+def _fold_array(acc,arr,is_real):
+    """Folds a NumPy array of non-NULL numbers into acc in one step."""
+    if not len(arr):
+        return
+    if acc.func in (sp.AggFunc.MIN,sp.AggFunc.MAX):
+        acc.step((arr.min() if acc.func == sp.AggFunc.MIN else arr.max()).item())
+        return
+    acc.count += len(arr)
+    if acc.func == sp.AggFunc.COUNT:
+        return
+    if is_real:
+        acc.total += float(arr.sum())
+        acc.is_real = True
+    elif len(arr)*max(-int(arr.min()),int(arr.max())) <= INT64_MAX:
+        acc.total += int(arr.sum())
     else:
-        return start, cell
-
-def travel_idxs(qry_cond,pg_num,db_file,pg_sz):
-    rowids = []
-    page = read_page(db_file,pg_num,pg_sz)
-    col_val = qry_cond.value
-    searching = True
-    search_started = False
-    if page[0] == PageType.InteriorIndex:
-        cell_ptrs, last_pg_num = parse_interior_header(page)
-        pages, keys = parse_IICells(page,cell_ptrs)
-        del page
-        idx = 0
-        key_amt = len(keys)
-        while idx < key_amt and (not keys[idx][0] or col_val > keys[idx][0]):
-            idx += 1
-        while searching and idx < key_amt and col_val <= keys[idx][0]:
-            more_rowids, searching, search_started = travel_idxs(qry_cond,pages[idx],db_file,pg_sz)
-            rowids.extend(more_rowids)
-            if searching:
-                if col_val == keys[idx][0]:
-                    rowids.append(keys[idx][1])
+        # The int64 sum could wrap
+        acc.total += sum(arr.tolist())
+
+class AggregateSpec:
+    """How an aggregate query folds rows of in_cols into groups keyed on the GROUP BY values."""
+    # Holds no query objects, so it pickles to process pool workers
+    def __init__(self,p_query,tdesc):
+        aggs = [item for item in p_query.select_items if isinstance(item,sp.Aggregate)]
+        plain_cols = list(p_query.col_names)
+        if p_query.having:
+            for leaf in p_query.having.leaves():
+                (aggs if isinstance(leaf.col,sp.Aggregate) else plain_cols).append(leaf.col)
+        for col, desc in p_query.order_by:
+            (aggs if isinstance(col,sp.Aggregate) else plain_cols).append(col)
+        self.aggs = list(dict.fromkeys(aggs))
+        self.in_cols = list(dict.fromkeys(p_query.group_by+plain_cols+[agg.col for agg in self.aggs if agg.col is not None]))
+        for col in self.in_cols:
+            if col not in tdesc.col_pos:
+                raise NoSuchColumnError(col)
+        col_pos = {col:pos for pos, col in enumerate(self.in_cols)}
+        self.group_pos = [col_pos[col] for col in p_query.group_by]
+        self.group_collations = [column_collation(tdesc,col) for col in p_query.group_by]
+        self.arg_pos = [None if agg.col is None else col_pos[agg.col] for agg in self.aggs]
+        self.collations = [None if agg.col is None else column_collation(tdesc,agg.col) for agg in self.aggs]
+        self.row_aggs = {idx for idx, agg in enumerate(self.aggs) if agg.func in (sp.AggFunc.MIN,sp.AggFunc.MAX) and not agg.distinct}
+        self.batchable = not self.group_pos and not (self.row_aggs and plain_cols)
+        
+    def new_group(self):
+        return [[Accumulator(agg.func,collation,agg.distinct) for agg, collation in zip(self.aggs,self.collations)],None]
+    
+    def group_key(self,row):
+        return tuple(sp.collate_key(row[pos],collation) for pos, collation in zip(self.group_pos,self.group_collations))
+    
+    def step(self,group,row):
+        improved = False
+        for idx, (acc,pos) in enumerate(zip(group[0],self.arg_pos)):
+            if acc.step(True if pos is None else row[pos]) and idx in self.row_aggs:
+                improved = True
+        if improved or group[1] is None:
+            group[1] = row
+            
+    def accumulate(self,rows):
+        """Hash aggregation of rows in any order into a dict of groups."""
+        if not self.group_pos:
+            group = self.new_group()
+            for row in rows:
+                self.step(group,row)
+            return {():group}
+        groups = {}
+        for row in rows:
+            key = self.group_key(row)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = self.new_group()
+            self.step(group,row)
+        return groups
+    
+    def stream(self,rows):
+        """Aggregates rows arriving in GROUP BY order, one group held at a time."""
+        key = group = None
+        for row in rows:
+            row_key = self.group_key(row)
+            if group is None or row_key != key:
+                if group is not None:
+                    yield key, group
+                key, group = row_key, self.new_group()
+            self.step(group,row)
+        if group is not None:
+            yield key, group
+            
+    def merge(self,groups,other):
+        """Folds the groups of a later run of rows into groups."""
+        for key, (accs,row) in other.items():
+            group = groups.get(key)
+            if group is None:
+                groups[key] = [accs,row]
+                continue
+            improved = False
+            for idx, (acc,other_acc) in enumerate(zip(group[0],accs)):
+                if acc.merge(other_acc) and idx in self.row_aggs:
+                    improved = True
+            if row is not None and (improved or group[1] is None):
+                group[1] = row
+        return groups
+    
+    def accumulate_batches(self,batches,cond):
+        """accumulate over ColumnBatches, folding numeric columns with NumPy."""
+        np = numpy_module()
+        group = self.new_group()
+        for batch in batches:
+            if cond is None:
+                idxs = None
+                selected = len(batch)
+            else:
+                mask = batch_mask(cond,batch)
+                idxs = np.flatnonzero(mask) if np is not None else [idx for idx, keep in enumerate(mask) if keep]
+                selected = len(idxs)
+            if not selected:
+                continue
+            for acc, agg in zip(group[0],self.aggs):
+                if agg.col is None:
+                    acc.count += selected
+                    continue
+                vec = batch.columns[agg.col]
+                arr = vec.to_numpy() if acc.distinct is None else None
+                if arr is not None:
+                    if idxs is not None:
+                        arr = arr[idxs]
+                    if vec.has_nulls:
+                        nulls = vec.nulls_numpy()
+                        arr = arr[~(nulls if idxs is None else nulls[idxs])]
+                    _fold_array(acc,arr,vec.kind == VectorKind.REAL)
                 else:
-                    searching = False
-            idx += 1
-        if searching:
-            more_rowids, searching, search_started = travel_idxs(qry_cond,last_pg_num,db_file,pg_sz)
-            rowids.extend(more_rowids)
-    elif page[0] == PageType.LeafIndex:
-        cell_ptrs = parse_leaf_header(page)
-        if search_started:
-            cptr = cell_ptrs[0]
-            first_idx = 0
-            cell = parse_ICell(cptr,page)
+                    values = vec.to_list()
+                    for idx in (range(len(batch)) if idxs is None else idxs):
+                        acc.step(values[idx])
+            if group[1] is None:
+                group[1] = batch.row(0 if idxs is None else int(idxs[0]),self.in_cols)
+        return {():group}
+
+@lru_cache(maxsize=None)
+def numpy_module():
+    """NumPy, imported on first use, or None if missing or disabled with SQLITE_NUMPY=0."""
+    if not USE_NUMPY:
+        return None
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def batch_decode_enabled(root_page=None):
+    """Whether aggregate scans of the table decode ColumnBatches."""
+    # auto only batches with NumPy, and only multi-page tables, as pure Python
+    # batches are no faster than the compiled predicates
+    if BATCH_DECODE != "auto":
+        return BATCH_DECODE not in ("","0")
+    if root_page is not None and root_page[0] != PageType.InteriorTable:
+        return False
+    return numpy_module() is not None
+
+class VectorKind:
+    INT  = "int"
+    REAL = "real"
+    TEXT = "text"
+    ANY  = "any"
+
+INT64_MIN, INT64_MAX = -(1<<63), (1<<63)-1
+
+class ColumnVector:
+    """One column of a ColumnBatch, with a 1 in nulls for each NULL row."""
+    # Numbers are kept in an array.array, text as one UTF-8 buffer plus offsets,
+    # and mixed storage classes as a list
+    def __init__(self,kind,values,nulls,buffer=None):
+        self.kind = kind
+        self.values = values
+        self.nulls = nulls
+        self.buffer = buffer
+        self.has_nulls = any(nulls)
+        
+    def __len__(self):
+        return len(self.nulls)
+    
+    def value(self,idx):
+        if self.nulls[idx]:
+            return None
+        if self.kind == VectorKind.TEXT:
+            return str(self.buffer[self.values[idx]:self.values[idx+1]],"utf-8")
+        return self.values[idx]
+    
+    def to_list(self):
+        if self.kind == VectorKind.ANY:
+            return self.values
+        return [self.value(idx) for idx in range(len(self))]
+    
+    def to_numpy(self):
+        """The values as a NumPy array sharing the array's memory, or None."""
+        np = numpy_module()
+        if np is None or self.kind not in (VectorKind.INT,VectorKind.REAL):
+            return None
+        return np.frombuffer(self.values,dtype=np.int64 if self.kind == VectorKind.INT else np.float64)
+    
+    def nulls_numpy(self):
+        return numpy_module().frombuffer(self.nulls,dtype=numpy_module().bool_)
+
+class _VectorBuilder:
+    """Collects the values of one column over the leaves of a batch."""
+    def __init__(self,col_idx,affinity,rowid_idx):
+        self.col_idx = col_idx
+        self.affinity = affinity
+        self.is_rowid = col_idx == rowid_idx
+        self.values = []
+        self.nulls = bytearray()
+        self.is_text = bytearray()
+        self.kinds = set()
+        
+    def add_page(self,records):
+        """Decodes the column from the (rowid, serial types, offsets, buffer) records of a leaf."""
+        col_idx, is_rowid = self.col_idx, self.is_rowid
+        values, nulls, is_text = self.values, self.nulls, self.is_text
+        int_lens = SRL_TYPE_INT_LENS
+        has_text = has_int = has_real = has_other = False
+        for row_id, serial_types, offsets, page in records:
+            srl_type = serial_types[col_idx] if col_idx < len(serial_types) else 0
+            if srl_type >= 13 and srl_type&1:
+                offset = offsets[col_idx]
+                values.append(bytes(page[offset:offset+((srl_type-13)>>1)]))
+                nulls.append(0)
+                is_text.append(1)
+                has_text = True
+                continue
+            if 0 < srl_type < 7:
+                offset = offsets[col_idx]
+                values.append(int.from_bytes(page[offset:offset+int_lens[srl_type-1]],"big",signed=True))
+                has_int = True
+            elif srl_type in (8,9):
+                values.append(srl_type&1)
+                has_int = True
+            elif not srl_type:
+                if is_rowid and col_idx < len(serial_types):
+                    values.append(row_id)
+                    has_int = True
+                else:
+                    values.append(None)
+                    nulls.append(1)
+                    is_text.append(0)
+                    continue
+            else:
+                values.append(parse_record_body(srl_type,page,offsets[col_idx])[0])
+                if srl_type == 7:
+                    has_real = True
+                else:
+                    has_other = True
+            nulls.append(0)
+            is_text.append(0)
+        for kind, present in ((VectorKind.TEXT,has_text),(VectorKind.INT,has_int),(VectorKind.REAL,has_real),(VectorKind.ANY,has_other)):
+            if present:
+                self.kinds.add(kind)
+            
+    def build(self):
+        kinds = self.kinds
+        if kinds <= {VectorKind.TEXT}:
+            offsets = array("q",[0])
+            total = 0
+            for val in self.values:
+                total += len(val) if val is not None else 0
+                offsets.append(total)
+            buffer = b"".join(val for val in self.values if val is not None)
+            return ColumnVector(VectorKind.TEXT,offsets,self.nulls,buffer)
+        if kinds == {VectorKind.INT} and all(INT64_MIN <= val <= INT64_MAX for val in self.values if val is not None):
+            return ColumnVector(VectorKind.INT,array("q",[val or 0 for val in self.values]),self.nulls)
+        if kinds <= {VectorKind.INT,VectorKind.REAL} and (VectorKind.REAL in kinds or self.affinity == Affinity.REAL):
+            # A REAL column stores whole numbers as integers on disk
+            return ColumnVector(VectorKind.REAL,array("d",[val or 0.0 for val in self.values]),self.nulls)
+        values = [str(val,"utf-8") if is_text else val for val, is_text in zip(self.values,self.is_text)]
+        if self.affinity == Affinity.REAL:
+            values = [float(val) if isinstance(val,int) else val for val in values]
+        return ColumnVector(VectorKind.ANY,values,self.nulls)
+
+class ColumnBatch:
+    """Rows of a table decoded column by column, with their rowids."""
+    def __init__(self,row_ids,columns):
+        self.row_ids = row_ids
+        self.columns = columns
+        
+    def __len__(self):
+        return len(self.row_ids)
+    
+    def row(self,idx,col_names):
+        return [self.columns[col].value(idx) for col in col_names]
+
+def leaf_pages(pg_num,pg_cache):
+    """Yields the leaf pages of a table B-tree in rowid order."""
+    with pg_cache.pinned(pg_num) as page:
+        if page[0] == PageType.LeafTable:
+            yield page
+            return
+        cell_ptrs, last_pg_num = parse_interior_header(page)
+        child_pages = [read_int(page,c_ptr,4) for c_ptr in cell_ptrs]
+    child_pages.append(last_pg_num)
+    for pg in read_ahead(pg_cache,child_pages):
+        yield from leaf_pages(pg,pg_cache)
+
+def scan_batches(pg_num,pg_cache,tdesc,col_names,batch_rows=BATCH_ROWS):
+    """Full table scan yielding ColumnBatches of whole leaf pages with at least batch_rows rows."""
+    for col in col_names:
+        if col not in tdesc.col_pos:
+            raise NoSuchColumnError(col)
+    col_names = list(dict.fromkeys(col_names))
+    col_idxs = [tdesc.col_pos[col] for col in col_names]
+    dtypes = tdesc.col_dtypes
+    affinities = [column_affinity(dtypes[idx] if idx < len(dtypes) else None) for idx in col_idxs]
+    rowid_idx = rowid_column(tdesc)
+    col_end = max(col_idxs,default=-1)+1
+    new_builders = lambda: [_VectorBuilder(col_idx,affinity,rowid_idx) for col_idx, affinity in zip(col_idxs,affinities)]
+    max_local = pg_cache.usable_sz-35
+    row_ids = array("q")
+    builders = new_builders()
+    for page in leaf_pages(pg_num,pg_cache):
+        records = []
+        for c_ptr in parse_leaf_header(page):
+            payload_size, row_id, offset = parse_table_cell(c_ptr,page)
+            if payload_size > max_local:
+                payload = OverflowPayload(page,offset,payload_size,pg_cache)
+                serial_types, offsets = parse_record_header(0,payload.header(),col_end)
+                records.append((row_id,serial_types,offsets,payload.read(columns_end(serial_types,offsets,col_idxs))))
+            else:
+                records.append((row_id,*parse_record_header(offset,page,col_end),page))
+            row_ids.append(row_id)
+        if _profiling.stats is not None:
+            _profiling.stats.cells += len(records)
+        for builder in builders:
+            builder.add_page(records)
+        if len(row_ids) >= batch_rows:
+            yield ColumnBatch(row_ids,{col:builder.build() for col, builder in zip(col_names,builders)})
+            row_ids = array("q")
+            builders = new_builders()
+    if row_ids:
+        yield ColumnBatch(row_ids,{col:builder.build() for col, builder in zip(col_names,builders)})
+
+def _is_int64(val):
+    return _is_number(val) and (not isinstance(val,int) or INT64_MIN <= val <= INT64_MAX)
+
+def _numpy_leaf_mask(cond,vec,np):
+    """NumPy mask of a numeric comparison, or None when values need checking one by one."""
+    values = cond.value if isinstance(cond.value,list) else [cond.value]
+    if cond.op == sp.WhereCmp.ISNULL or not all(_is_int64(val) for val in values if val is not None):
+        return None
+    arr = vec.to_numpy()
+    if cond.op in CMP_FUNCS and cond.value is not None:
+        mask = CMP_FUNCS[cond.op](arr,cond.value)
+    elif cond.op == sp.WhereCmp.BETWEEN and None not in values:
+        mask = (arr >= values[0]) & (arr <= values[1])
+        mask = ~mask if cond.negated else mask
+    elif cond.op == sp.WhereCmp.IN:
+        numbers = [val for val in values if val is not None]
+        mask = np.isin(arr,numbers) if numbers else np.zeros(len(arr),dtype=np.bool_)
+        if cond.negated:
+            mask = ~mask if None not in values else np.zeros(len(arr),dtype=np.bool_)
+    else:
+        return None
+    # Comparisons with NULL are never true
+    return mask & ~vec.nulls_numpy() if vec.has_nulls else mask
+
+def _text_eq_mask(cond,vec):
+    nocase = cond.collation == sp.Collation.NOCASE
+    raw = cond.value.encode()
+    raw = raw.lower() if nocase else raw
+    buffer, offsets, nulls = vec.buffer, vec.values, vec.nulls
+    want = cond.op == sp.WhereCmp.EQ
+    mask = []
+    for idx in range(len(nulls)):
+        if nulls[idx]:
+            mask.append(False)
+            continue
+        text = buffer[offsets[idx]:offsets[idx+1]]
+        mask.append(((text.lower() if nocase else text) == raw) == want)
+    return mask
+
+def batch_mask(cond,batch):
+    """Evaluates cond over a ColumnBatch, a bool per row."""
+    np = numpy_module()
+    if isinstance(cond,sp.QueryCondGroup):
+        masks = [batch_mask(sub_cond,batch) for sub_cond in cond.conds]
+        if np is not None:
+            combine = np.logical_and if cond.join == sp.CondJoin.AND else np.logical_or
+            return combine.reduce(masks)
+        join = all if cond.join == sp.CondJoin.AND else any
+        return [join(row_mask) for row_mask in zip(*masks)]
+    vec = batch.columns[cond.col]
+    mask = None
+    if np is not None and vec.kind in (VectorKind.INT,VectorKind.REAL):
+        mask = _numpy_leaf_mask(cond,vec,np)
+    elif vec.kind == VectorKind.TEXT and cond.op in (sp.WhereCmp.EQ,sp.WhereCmp.NE) and isinstance(cond.value,str):
+        mask = _text_eq_mask(cond,vec)
+    if mask is None:
+        mask = [cond.comp(val) for val in vec.to_list()]
+    if np is not None and not isinstance(mask,np.ndarray):
+        mask = np.array(mask,dtype=np.bool_)
+    return mask
+
+def partition_table(pg_num,pg_cache,parts):
+    """Splits the table B-tree under pg_num into at least parts subtree roots, in rowid order."""
+    pg_nums = [pg_num]
+    while len(pg_nums) < parts:
+        next_level = []
+        for pg in pg_nums:
+            page = pg_cache.get_page(pg)
+            if page[0] != PageType.InteriorTable:
+                return pg_nums
+            cell_ptrs, last_pg_num = parse_interior_header(page)
+            next_level.extend(read_int(page,c_ptr,4) for c_ptr in cell_ptrs)
+            next_level.append(last_pg_num)
+        pg_nums = next_level
+    return pg_nums
+
+def scan_subtrees(db_path,use_mmap,tdesc,col_names,cond,pg_nums,spec):
+    """Process pool worker scanning subtrees with its own page cache."""
+    with open(db_path,"rb") as db_file:
+        pg_cache = open_page_cache(db_file,use_mmap)
+        if spec is not None and spec.batchable and batch_decode_enabled():
+            batches = (batch for pg in pg_nums for batch in scan_batches(pg,pg_cache,tdesc,col_names+(cond.columns() if cond else [])))
+            return spec.accumulate_batches(batches,cond)
+        plan = ScanPlan(tdesc,col_names,cond)
+        rows = (row for pg in pg_nums for row in travel_tables(pg,pg_cache,plan))
+        return spec.accumulate(rows) if spec is not None else list(rows)
+
+def parallel_scan(pg_num,pg_cache,tdesc,col_names,cond,workers,spec=None,ordered=True):
+    """Full table scan spread over a process pool in contiguous chunks of subtrees."""
+    pg_nums = partition_table(pg_num,pg_cache,workers<<2)
+    chunk_sz = -(-len(pg_nums)//(workers<<2))
+    chunks = [pg_nums[i:i+chunk_sz] for i in range(0,len(pg_nums),chunk_sz)]
+    use_mmap = pg_cache.policy == "mmap"
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(min(workers,len(chunks))) as pool:
+        futures = [pool.submit(scan_subtrees,pg_cache.db_file.name,use_mmap,tdesc,col_names,cond,chunk,spec)
+                   for chunk in chunks]
+        for future in (futures if ordered else as_completed(futures)):
+            yield future.result()
+
+class AccessPath:
+    TABLE_COUNT = 0
+    ROWID       = 1
+    TABLE_SCAN  = 2
+    INDEX       = 3
+
+class Binding:
+    """The parts of a SelectPlan that depend on the values bound to ?."""
+    __slots__ = ("cond","key_range","seek","scan_plan","having")
+    def __init__(self,cond=None,key_range=None,seek=None,scan_plan=None,having=None):
+        self.cond = cond
+        self.key_range = key_range
+        self.seek = seek
+        self.scan_plan = scan_plan
+        self.having = having
+
+def check_where(cond):
+    if any(isinstance(leaf.col,sp.Aggregate) for leaf in cond.leaves()):
+        raise sp.InvalidQuerySyntaxError("Aggregates are not allowed in WHERE")
+
+def bind_cond(cond,params,tdesc):
+    bound = sp.bind_params(cond,params)
+    if bound:
+        bind_affinity(bound,tdesc)
+    return bound
+
+def rename_cond(cond,rename):
+    """Renames the columns of a condition in place."""
+    for leaf in cond.leaves():
+        leaf.col = _rename_item(leaf.col,rename)
+        if isinstance(leaf.value,sp.ColumnRef):
+            leaf.value = sp.ColumnRef(rename(leaf.value.col))
+    return cond
+
+def _rename_item(item,rename):
+    if isinstance(item,sp.Aggregate):
+        return sp.Aggregate(item.func,item.col and rename(item.col),item.distinct)
+    return rename(item)
+
+def rename_columns(p_query,rename):
+    """Applies rename to every column a SELECT references."""
+    p_query.select_items = [_rename_item(item,rename) for item in p_query.select_items]
+    p_query.col_names = [item for item in p_query.select_items if not isinstance(item,sp.Aggregate)]
+    for cond in [p_query.cond,p_query.having]+[join.cond for join in p_query.joins]:
+        if cond:
+            rename_cond(cond,rename)
+    p_query.group_by = [rename(col) for col in p_query.group_by]
+    p_query.order_by = [(_rename_item(col,rename),desc) for col, desc in p_query.order_by]
+
+def expand_stars(p_query,stars):
+    """Replaces * and table.* in the select list with the columns stars maps them to."""
+    items = []
+    for item in p_query.select_items:
+        if isinstance(item,str) and item.endswith("*"):
+            if item not in stars:
+                raise NoSuchTableError(item[:-2])
+            items.extend(stars[item])
         else:
-            first_idx, cell = binary_search_first(cell_ptrs,page,col_val)
-            if first_idx == None:
-                return [], searching, search_started
-        if first_idx == None:
-            print("Error find value")
-            return [], searching, search_started
+            items.append(item)
+    p_query.select_items = items
+    p_query.col_names = [item for item in items if not isinstance(item,sp.Aggregate)]
+
+def unqualified(col,names):
+    """col without its table.col qualifier, which must name the table."""
+    if "." not in col:
+        return col
+    prefix, col_name = col.split(".",1)
+    if prefix not in names:
+        raise NoSuchColumnError(col)
+    return col_name
+
+SEARCH_TEXT = {sp.WhereCmp.EQ:"{}=?",sp.WhereCmp.IN:"{}=?",sp.WhereCmp.ISNULL:"{}=?",
+               sp.WhereCmp.LT:"{}<?",sp.WhereCmp.LE:"{}<?",sp.WhereCmp.GT:"{}>?",sp.WhereCmp.GE:"{}>?",
+               sp.WhereCmp.BETWEEN:"{0}>? AND {0}<?",sp.WhereCmp.LIKE:"{0}>? AND {0}<?"}
+
+def search_text(terms,col=None):
+    """Seek terms as SQLite writes them in EXPLAIN QUERY PLAN, e.g. (country=? AND id>?)."""
+    parts = [SEARCH_TEXT[term.op].format(col or term.col) if term.op in SEARCH_TEXT else str(term) for term in terms]
+    return "("+" AND ".join(parts)+")"
+
+def plan_rows(lines):
+    """EXPLAIN QUERY PLAN rows from (depth, detail) pairs."""
+    parents = [0]
+    rows = []
+    for row_id, (depth, detail) in enumerate(lines,2):
+        del parents[depth+1:]
+        rows.append([row_id,parents[depth],0,detail])
+        parents.append(row_id)
+    return rows
+
+class SelectPlan:
+    """A SELECT planned against the catalog, run any number of times."""
+    # Without ? markers key ranges and predicates are worked out once here,
+    # otherwise on each run from the bound values
+    def __init__(self,p_query,catalog):
+        if p_query.table not in catalog.tables:
+            raise NoSuchTableError(p_query.table)
+        self.query = p_query
+        self.catalog = catalog
+        self.page_num = catalog.tables[p_query.table]["pg_num"]
+        self.tdesc = tbl_info = catalog.tables[p_query.table]["query"]
+        names = {p_query.alias or p_query.table}
+        rename_columns(p_query,lambda col: unqualified(col,names))
+        expand_stars(p_query,{"*":list(tbl_info.col_names)})
+        if p_query.cond:
+            check_where(p_query.cond)
+            if any(isinstance(leaf.value,sp.ColumnRef) for leaf in p_query.cond.leaves()):
+                raise sp.InvalidQuerySyntaxError("Columns can only be compared with columns of another table")
+            bind_affinity(p_query.cond,tbl_info)
+        if p_query.having:
+            bind_affinity(p_query.having,tbl_info)
+        self._plan_output()
+        if self.aggregated and len(p_query.group_by) == 1:
+            # Rows read in GROUP BY order are aggregated as they stream past
+            self.order_by = [(p_query.group_by[0],False)]
+            self.order_collations = [None]
+        self.access = None
+        self.col_pos = None
+        self.in_order = False
+        if p_query.count_cols and not p_query.cond:
+            self.path = AccessPath.TABLE_COUNT
         else:
-            search_started = True
-        rowids.append(cell[1])
-        c_idx = first_idx+1
-        while c_idx < len(cell_ptrs):
-            cptr = cell_ptrs[c_idx]
-            cell = parse_ICell(cptr,page)
-            if cell[0] == col_val:
-                rowids.append(cell[1])
-                c_idx += 1
+            self._choose_path()
+            if self.aggregated and self.path == AccessPath.INDEX and not self.access.used and self.col_pos is None:
+                # Reading the table in GROUP BY order through an index costs a
+                # lookup per row, far more than hashing the groups of a scan
+                self.order_by, self.order_collations = [], []
+                self.access = self.col_pos = None
+                self._choose_path()
+        self._binding = None if p_query.param_count else self._bind(())
+
+    def _plan_output(self):
+        """Whether the query aggregates and which columns it reads into each row."""
+        p_query = self.query
+        self.aggregated = bool(p_query.group_by) or any(isinstance(item,sp.Aggregate)
+                                                      for item in p_query.select_items+[col for col, desc in p_query.order_by])
+        if self.aggregated:
+            self.spec = AggregateSpec(p_query,self.tdesc)
+            self.out_cols = self.spec.in_cols
+            self.order_by, self.order_collations = [], []
+        else:
+            self.spec = None
+            self.order_by = p_query.order_by
+            self.order_collations = p_query.order_collations
+            self.out_cols = p_query.col_names + [col for col, desc in self.order_by]
+        for col in self.out_cols:
+            if col not in self.tdesc.col_pos:
+                raise NoSuchColumnError(col)
+        # A sort followed by LIMIT only needs its first OFFSET+LIMIT rows
+        self.sort_limit = None if p_query.limit is None else p_query.offset+p_query.limit
+        self.in_order = False
+
+    def _choose_path(self):
+        p_query, tbl_info, out_cols = self.query, self.tdesc, self.out_cols
+        limit = None if self.aggregated else self.sort_limit
+        access = choose_index_access(self.catalog,tbl_info,p_query.table,p_query.cond,self.order_by,self.order_collations,out_cols,limit)
+        rowid_access = choose_rowid_access(tbl_info,p_query.cond,self.order_by)
+        if access is None and not rowid_access:
+            # An index holding every column read is smaller to scan than the table
+            if covering_index := find_covering_index(self.catalog,p_query.table,tbl_info,out_cols,p_query.cond):
+                access = IndexAccess(covering_index,[],p_query.cond)
+        if rowid_access and (rowid_access.equality or not access or self._rowid_cost(rowid_access) <= access.cost):
+            self.path = AccessPath.ROWID
+            self.access = rowid_access
+        elif access is None:
+            self.path = AccessPath.TABLE_SCAN
+        else:
+            self.path = AccessPath.INDEX
+            self.access = access
+            self.col_pos = covering_columns(access.index,tbl_info,out_cols,access.residual)
+        self.in_order = self.access is not None and self.access.ordered
+
+    def _rowid_cost(self,access):
+        """Rows decoded reading the table by rowid, costed as in choose_index_access."""
+        size = self.catalog.sizes[self.page_num]
+        rows = estimate_rows(BTreeStats(0,0,self.catalog.table_rows(self.query.table),size.max_rowid),and_cond(access.used),self.tdesc)
+        if self.order_by and not access.ordered:
+            rows *= 1+SORT_COST
+        return rows
+
+    def explain(self,pg_cache,params=()):
+        """EXPLAIN QUERY PLAN lines of the plan, as (depth, detail) pairs."""
+        return [(0,self._access_detail(pg_cache))]+self._output_details()
+    
+    def _access_detail(self,pg_cache):
+        p_query, access = self.query, self.access
+        table = p_query.alias or p_query.table
+        if self.path == AccessPath.TABLE_COUNT:
+            return "SCAN "+table+" USING PAGE CELL COUNTS"
+        if self.path == AccessPath.TABLE_SCAN:
+            if PARALLEL_WORKERS > 1 and (p_query.limit is None or self.aggregated or self.order_by):
+                return f"SCAN {table} IN PARALLEL ({PARALLEL_WORKERS} WORKERS)"
+            if self.aggregated and self.spec.batchable and batch_decode_enabled(pg_cache.get_page(self.page_num)):
+                return "SCAN "+table+" USING COLUMN BATCHES"
+            return "SCAN "+table
+        if self.path == AccessPath.ROWID:
+            if not access.used:
+                return "SCAN "+table
+            return f"SEARCH {table} USING INTEGER PRIMARY KEY {search_text(access.used,'rowid')}"
+        index = ("COVERING INDEX " if self.col_pos is not None else "INDEX ")+self.catalog.index_name(access.index)
+        if access.used:
+            return f"SEARCH {table} USING {index} {search_text(access.used)}"
+        return f"SCAN {table} USING {index}"
+        
+    def _output_details(self):
+        lines = []
+        if self.aggregated and self.query.group_by and not self.in_order:
+            lines.append((0,"USE HASH TABLE FOR GROUP BY"))
+        if self.query.order_by and (self.aggregated or not self.in_order):
+            top = "" if self.sort_limit is None else f" (TOP {self.sort_limit})"
+            lines.append((0,"USE SORTER FOR ORDER BY"+top))
+        return lines
+
+    def _bind(self,params):
+        """Binding for one set of ? values, or None if they do not suit the access path."""
+        tdesc, out_cols = self.tdesc, self.out_cols
+        bind = (lambda cond: bind_cond(cond,params,tdesc)) if params else (lambda cond: cond)
+        if self.path == AccessPath.TABLE_COUNT:
+            return Binding()
+        having = bind(self.query.having)
+        if self.path == AccessPath.TABLE_SCAN:
+            cond = bind(self.query.cond)
+            return Binding(cond=cond,scan_plan=ScanPlan(tdesc,out_cols,cond),having=having)
+        residual = bind(self.access.residual)
+        used = [bind(term) for term in self.access.used]
+        if self.path == AccessPath.ROWID:
+            seek = rowid_seek(used)
+            if seek is None:
+                return None
+            return Binding(cond=residual,seek=seek,scan_plan=ScanPlan(tdesc,out_cols,residual),having=having)
+        scan_plan = ScanPlan(tdesc,out_cols,residual) if self.col_pos is None else None
+        return Binding(cond=residual,key_range=index_range(used,self.access.cols,self.access.collations),scan_plan=scan_plan,having=having)
+        
+    def _group_rows(self,groups,having):
+        """Result rows of an aggregate query from its groups."""
+        p_query, spec = self.query, self.spec
+        if isinstance(groups,dict):
+            if not groups and not p_query.group_by:
+                groups[()] = spec.new_group()
+            groups = sorted(groups.items(),key=lambda item: item[0])
+        out_items = p_query.select_items + [col for col, desc in p_query.order_by]
+        empty_row = [None]*len(spec.in_cols)
+        rows = self._having_rows(groups,having,out_items,empty_row)
+        if not p_query.order_by:
+            return rows
+        collations = sort_collations(self.tdesc,p_query.order_by,p_query.order_collations)
+        return sort_rows(rows,len(p_query.select_items),p_query.order_by,collations,self.sort_limit)
+    
+    def _having_rows(self,groups,having,out_items,empty_row):
+        spec = self.spec
+        for key, (accs,row) in groups:
+            record = dict(zip(spec.in_cols,row or empty_row))
+            record.update(zip(spec.aggs,(acc.result() for acc in accs)))
+            if having is None or sp.comp_record(having,record):
+                yield [record[item] for item in out_items]
+
+    def rows(self,pg_cache,params=()):
+        """Runs the plan, returning its rows before LIMIT/OFFSET."""
+        p_query = self.query
+        if len(params) != p_query.param_count:
+            raise sp.UnboundParameterError(f"Expected {p_query.param_count} bound values, got {len(params)}")
+        if self.path == AccessPath.TABLE_COUNT:
+            return [[count_table_cells(self.page_num,pg_cache)]]
+        binding = self._binding or self._bind(params)
+        if binding is None:
+            # Plan again with the values in place, as the query would have been without ?
+            bound_query = copy.copy(p_query)
+            bound_query.cond = sp.bind_params(p_query.cond,params)
+            bound_query.having = sp.bind_params(p_query.having,params)
+            bound_query.param_count = 0
+            return SelectPlan(bound_query,self.catalog).rows(pg_cache)
+        page_num, tbl_info, out_cols = self.page_num, self.tdesc, self.out_cols
+        aggregated, order_by, access = self.aggregated, self.order_by, self.access
+        if self.path == AccessPath.ROWID:
+            low, high, rowids = binding.seek
+            if rowids is None:
+                rows = travel_table_range(page_num,pg_cache,binding.scan_plan,low,high,access.reverse)
+            elif rowids:
+                rows = travel_tables(page_num,pg_cache,binding.scan_plan,CellGroup(rowids))
             else:
-                searching = False
-                break
-        del page
-    return rowids, searching, search_started
+                rows = iter(())
+        elif self.path == AccessPath.TABLE_SCAN:
+            if PARALLEL_WORKERS > 1 and (p_query.limit is None or aggregated or order_by):
+                chunks = parallel_scan(page_num,pg_cache,tbl_info,out_cols,binding.cond,PARALLEL_WORKERS,self.spec,ordered=not p_query.count_cols)
+                if aggregated:
+                    groups = {}
+                    for chunk in chunks:
+                        self.spec.merge(groups,chunk)
+                    return self._group_rows(groups,binding.having)
+                rows = (row for chunk in chunks for row in chunk)
+            elif aggregated and self.spec.batchable and batch_decode_enabled(pg_cache.get_page(page_num)):
+                batch_cols = out_cols+(binding.cond.columns() if binding.cond else [])
+                groups = self.spec.accumulate_batches(scan_batches(page_num,pg_cache,tbl_info,batch_cols),binding.cond)
+                return self._group_rows(groups,binding.having)
+            else:
+                rows = travel_tables(page_num,pg_cache,binding.scan_plan)
+        else:
+            if binding.key_range is None:
+                entries = iter(())
+            else:
+                entries = travel_idxs(binding.key_range,access.index["pg_num"],pg_cache,access.reverse)
+            if p_query.count_cols and binding.cond is None:
+                return [[sum(1 for _ in entries)]]
+            if self.col_pos is not None:
+                rows = covering_rows(entries,self.col_pos,out_cols,binding.cond,tbl_info)
+            else:
+                rowids = (entry[-1] for entry in entries)
+                if access.ordered:
+                    rows = lookup_rows(rowids,page_num,pg_cache,binding.scan_plan)
+                else:
+                    if p_query.limit is not None and binding.cond is None and not order_by and not aggregated:
+                        # Every index entry in range produces exactly one row
+                        rowids = islice(rowids,p_query.offset+p_query.limit)
+                    rowids = sorted(rowids)
+                    rows = travel_tables(page_num,pg_cache,binding.scan_plan,CellGroup(rowids)) if rowids else iter(())
+        return self._finish(rows,binding.having)
+    
+    def _finish(self,rows,having):
+        """Aggregates, filters on HAVING and sorts the rows read."""
+        p_query, order_by = self.query, self.order_by
+        if p_query.count_cols:
+            return [[sum(1 for _ in rows)]]
+        if self.aggregated:
+            groups = self.spec.stream(rows) if self.in_order else self.spec.accumulate(rows)
+            return self._group_rows(groups,having)
+        if not order_by:
+            return rows
+        if self.in_order:
+            out_len = len(p_query.col_names)
+            return (row[:out_len] for row in rows)
+        collations = sort_collations(self.tdesc,order_by,self.order_collations)
+        return sort_rows(rows,len(p_query.col_names),order_by,collations,self.sort_limit)
+
+class JoinStrategy:
+    HASH       = "hash join"
+    INDEX_LOOP = "index nested loop"
+    ROWID_LOOP = "rowid nested loop"
+
+class JoinKey:
+    """A column = column term joining a table to those before it."""
+    def __init__(self,outer,inner,affinity,collation):
+        self.outer = outer
+        self.inner = inner
+        self.affinity = affinity
+        self.collation = collation
+
+def join_key(keys,positions):
+    """Hash key function over the join columns, None when one is NULL."""
+    parts = [(pos,key.affinity,key.collation) for key, pos in zip(keys,positions)]
+    def row_key(row):
+        values = []
+        for pos, affinity, collation in parts:
+            val = row[pos]
+            if val is None:
+                return None
+            values.append(sp.collate_key(apply_affinity(val,affinity),collation))
+        return tuple(values)
+    return row_key
+
+def hash_join(outer_rows,inner_rows,outer_key,inner_key,match,left,inner_len,build_outer=False):
+    """Joins two row streams on equal keys through a hash table on one side."""
+    build_rows, build_key = (outer_rows,outer_key) if build_outer else (inner_rows,inner_key)
+    built = []
+    table = {}
+    for row in build_rows:
+        key = build_key(row)
+        if key is not None:
+            table.setdefault(key,[]).append(len(built))
+        built.append(row)
+    if not build_outer:
+        for outer in outer_rows:
+            key = outer_key(outer)
+            matched = False
+            for idx in (table.get(key,()) if key is not None else ()):
+                row = outer+built[idx]
+                if match is None or match(row):
+                    matched = True
+                    yield row
+            if left and not matched:
+                yield outer+[None]*inner_len
+        return
+    matched = bytearray(len(built))
+    for inner in inner_rows:
+        key = inner_key(inner)
+        for idx in (table.get(key,()) if key is not None else ()):
+            row = built[idx]+inner
+            if match is None or match(row):
+                matched[idx] = 1
+                yield row
+    if left:
+        for idx, outer in enumerate(built):
+            if not matched[idx]:
+                yield outer+[None]*inner_len
+
+def loop_join(outer_rows,lookup,outer_value,match,left,inner_len):
+    """Index nested-loop join, fetching each outer row's inner rows with lookup."""
+    for outer in outer_rows:
+        val = outer_value(outer)
+        matched = False
+        if val is not None:
+            for inner in lookup(val):
+                row = outer+inner
+                if match is None or match(row):
+                    matched = True
+                    yield row
+        if left and not matched:
+            yield outer+[None]*inner_len
+
+def estimate_rows(stats,cond,tdesc):
+    """Rows of a table left after cond, by term selectivity and rowid bounds."""
+    rows = stats.rows
+    for term in and_terms(cond):
+        rows *= term_selectivity(term)
+    access = choose_rowid_access(tdesc,cond,[])
+    seek = rowid_seek(access.used) if access else None
+    if seek is not None:
+        low, high, rowids = seek
+        if rowids is not None:
+            rows = min(rows,len(rowids))
+        elif high is not None:
+            rows = min(rows,high-max(low or 1,1)+1)
+        elif low is not None:
+            rows = min(rows,(stats.rows if stats.max_rowid is None else stats.max_rowid)-low+1)
+    return max(rows,1)
+
+class JoinTable:
+    """One table of a JoinPlan: its columns, pushed-down terms and join keys."""
+    def __init__(self,name,alias,join_type,on,entry):
+        self.name = name
+        self.alias = alias
+        self.join_type = join_type
+        self.on = on
+        self.pg_num = entry["pg_num"]
+        self.tdesc = entry["query"]
+        self.cols = []
+        self.pushed = []
+        self.keys = []
+        self.filters = []
+        self.plan = None
+
+class JoinChoice:
+    """The strategy joining one table and, for nested loops, its key and index."""
+    def __init__(self,strategy,key=None,index=None,build_outer=False):
+        self.strategy = strategy
+        self.key = key
+        self.index = index
+        self.build_outer = build_outer
+
+class JoinPlan(SelectPlan):
+    """A SELECT over joined tables, run as a pipeline in FROM order."""
+    # Single-table terms are pushed into each table's own SelectPlan, except
+    # WHERE terms on the right of a LEFT JOIN
+    def __init__(self,p_query,catalog):
+        self.query = p_query
+        self.catalog = catalog
+        self.tables = []
+        from_tables = [(p_query.table,p_query.alias,sp.JoinType.INNER,None)]
+        from_tables += [(join.table,join.alias,join.join_type,join.cond) for join in p_query.joins]
+        for tbl_name, alias, join_type, on in from_tables:
+            if tbl_name not in catalog.tables:
+                raise NoSuchTableError(tbl_name)
+            alias = alias or tbl_name
+            if any(table.alias == alias for table in self.tables):
+                raise sp.InvalidQuerySyntaxError("Table name used twice: "+alias)
+            self.tables.append(JoinTable(tbl_name,alias,join_type,on,catalog.tables[tbl_name]))
+        self.tdesc = joined = self._joined_tdesc()
+        rename_columns(p_query,self._qualify)
+        stars = {"*":list(joined.col_names)}
+        for table in self.tables:
+            stars[table.alias+".*"] = [table.alias+"."+col for col in table.tdesc.col_names]
+        expand_stars(p_query,stars)
+        for cond in [p_query.cond]+[table.on for table in self.tables]:
+            if cond:
+                check_where(cond)
+                bind_affinity(cond,joined)
+        if p_query.having:
+            bind_affinity(p_query.having,joined)
+        self._plan_output()
+        self._place_terms()
+        self._layout()
+        
+    def _joined_tdesc(self):
+        joined = sp.ParsedQuery()
+        for table in self.tables:
+            tdesc = table.tdesc
+            for col_idx, col in enumerate(tdesc.col_names):
+                joined.col_names.append(table.alias+"."+col)
+                joined.col_dtypes.append(tdesc.col_dtypes[col_idx] if col_idx < len(tdesc.col_dtypes) else None)
+                joined.col_collations.append(declared_collation(tdesc,col))
+        joined.col_pos = {col:pos for pos, col in enumerate(joined.col_names)}
+        return joined
+        
+    def _qualify(self,col):
+        if "." in col:
+            prefix, col_name = col.split(".",1)
+            table = next((table for table in self.tables if table.alias == prefix),None)
+            if table is None or (col_name != "*" and col_name not in table.tdesc.col_pos):
+                raise NoSuchColumnError(col)
+            return col
+        if col == "*":
+            return col
+        owners = [table for table in self.tables if col in table.tdesc.col_pos]
+        if not owners:
+            raise NoSuchColumnError(col)
+        if len(owners) > 1:
+            raise sp.InvalidQuerySyntaxError("Ambiguous column name: "+col)
+        return owners[0].alias+"."+col
+    
+    def _tables_of(self,term):
+        aliases = [table.alias for table in self.tables]
+        return {aliases.index(col.split(".",1)[0]) for col in term.columns()}
+    
+    def _join_key(self,term,table):
+        inner, outer = term.col, term.value.col
+        if not inner.startswith(table.alias+"."):
+            inner, outer = outer, inner
+        affinity = comparison_affinity(affinity_of(self.tdesc,outer),affinity_of(self.tdesc,inner))
+        return JoinKey(outer,inner,affinity,term.collation)
+        
+    def _place_terms(self):
+        """Sorts the WHERE and ON terms into pushed-down terms, join keys and the rest."""
+        tables = self.tables
+        is_key = lambda term, used: (isinstance(term,sp.QueryCond) and term.op == sp.WhereCmp.EQ
+                                     and isinstance(term.value,sp.ColumnRef) and len(used) == 2)
+        self.residual = []
+        for term in and_terms(self.query.cond):
+            used = self._tables_of(term)
+            table = tables[max(used)]
+            if table.join_type != sp.JoinType.INNER:
+                self.residual.append(term)
+            elif len(used) == 1:
+                table.pushed.append(term)
+            elif is_key(term,used):
+                table.keys.append(self._join_key(term,table))
+            else:
+                self.residual.append(term)
+        for idx, table in enumerate(tables):
+            for term in and_terms(table.on):
+                used = self._tables_of(term)
+                if max(used) > idx:
+                    raise sp.InvalidQuerySyntaxError("An ON clause can only refer to tables joined before it")
+                if used == {idx}:
+                    table.pushed.append(term)
+                elif is_key(term,used):
+                    table.keys.append(self._join_key(term,table))
+                else:
+                    table.filters.append(term)
+                    
+    def _layout(self):
+        """Picks the columns read from each table and plans its scan."""
+        needed = set(self.out_cols)
+        for term in self.residual:
+            needed.update(term.columns())
+        for table in self.tables:
+            needed.update(col for key in table.keys for col in (key.outer,key.inner))
+            for term in table.filters:
+                needed.update(term.columns())
+        self.row_pos = {}
+        for table in self.tables:
+            table.cols = [col for col in table.tdesc.col_names if table.alias+"."+col in needed]
+            for col in table.cols:
+                self.row_pos[table.alias+"."+col] = len(self.row_pos)
+            sub_query = sp.ParsedQuery()
+            sub_query.action = sp.SQLAction.SELECT
+            sub_query.table, sub_query.alias = table.name, table.alias
+            sub_query.col_names, sub_query.select_items = list(table.cols), list(table.cols)
+            sub_query.cond = copy.deepcopy(and_cond(table.pushed))
+            sub_query.param_count = self.query.param_count
+            table.plan = SelectPlan(sub_query,self.catalog)
             
-if command == ".dbinfo":
-    with open(database_file_path, "rb") as database_file:
-        database_file.seek(16)  # Skip the first 16 bytes of the header
-        page_size = int.from_bytes(database_file.read(2))
-        database_file.seek(103)
-        table_amt = int.from_bytes(database_file.read(2))
-        print(f"database page size: {page_size}\nnumber of tables: {table_amt}")
-elif command == ".tables":
-    with open(database_file_path, "rb") as database_file:
-        database_file.seek(16)
-        page_size = int.from_bytes(database_file.read(2))
-        page = read_page(database_file,1,page_size)
-        cell_amt = read_int(page,103,2)
-        cell_ptrs = [read_int(page,100+i,2) for i in range(8,8+(cell_amt<<1),2)]
-        db_objs = get_db_schema(page,cell_ptrs)
-        tbl_names = list(db_objs["tables"].keys())
-        print(*tbl_names)
-elif command.lower().startswith("select"):
-    p_query = sp.parse(command)
-    with open(database_file_path, "rb") as database_file:
-        database_file.seek(16)
-        page_size = int.from_bytes(database_file.read(2))
-        page = read_page(database_file,1,page_size)
-        
-        cell_amt = read_int(page,103,2)
-        cell_ptrs = [read_int(page,100+i,2) for i in range(8,8+(cell_amt<<1),2)]
-        db_objs = get_db_schema(page,cell_ptrs)
-        
-        del page
-        records = []
-        if p_query.table != "companies" and p_query.cond:
-            p_query.cond.value = p_query.cond.value.title()
-        if p_query.cond and (index := get_valid_index(db_objs["indexes"],p_query.table,p_query.cond.col)):
-            rowids, _, _1 = travel_idxs(p_query.cond,index["pg_num"],database_file,page_size)
-            rowids.sort()
-            page_num = db_objs["tables"][p_query.table]["pg_num"]
-            tbl_info = db_objs["tables"][p_query.table]["query"]
-            records = travel_tables(page_num,database_file,page_size,tbl_info,p_query, CellGroup(rowids))
-            for rcd in records:
-                print(*rcd, sep = "|")
-        else:     
-            page_num = db_objs["tables"][p_query.table]["pg_num"]
-            tbl_info = db_objs["tables"][p_query.table]["query"]
-            records = travel_tables(page_num,database_file,page_size,tbl_info,p_query)
-            if p_query.count_cols:
-                print(len(records))
+    def choose_joins(self,params=()):
+        """JoinChoice for each table after the first, by estimated pages read."""
+        # Sizes sampled when the catalog loaded, so choosing reads no pages
+        sizes = self.catalog.sizes
+        pushed_cond = lambda table: bind_cond(table.plan.query.cond,params,table.tdesc) if params else table.plan.query.cond
+        first = self.tables[0]
+        outer_rows = estimate_rows(sizes[first.pg_num],pushed_cond(first),first.tdesc)
+        choices = []
+        for table in self.tables[1:]:
+            stats = sizes[table.pg_num]
+            inner_rows = estimate_rows(stats,pushed_cond(table),table.tdesc)
+            choice, cost = JoinChoice(JoinStrategy.HASH,build_outer=outer_rows < inner_rows), stats.pages
+            rowid_idx = rowid_column(table.tdesc)
+            for key in table.keys:
+                inner_col = key.inner.split(".",1)[1]
+                inner_affinity = affinity_of(table.tdesc,inner_col)
+                if rowid_idx is not None and inner_col == table.tdesc.col_names[rowid_idx]:
+                    if key.affinity != Affinity.NUMERIC:
+                        continue
+                    key_cost, loop = outer_rows*stats.depth, JoinChoice(JoinStrategy.ROWID_LOOP,key)
+                else:
+                    index = self.catalog.index_on(table.name,inner_col,key.collation)
+                    # The index holds values under the column's own affinity
+                    if index is None or comparison_affinity(inner_affinity,inner_affinity) != key.affinity:
+                        continue
+                    depth = self.catalog.depth(index)
+                    if not covering_columns(index,table.tdesc,table.cols,table.plan.query.cond):
+                        depth += stats.depth
+                    key_cost, loop = outer_rows*depth, JoinChoice(JoinStrategy.INDEX_LOOP,key,index)
+                if key_cost < cost:
+                    choice, cost = loop, key_cost
+            choices.append(choice)
+            outer_rows = max(outer_rows,inner_rows) if table.keys else outer_rows*inner_rows
+        return choices
+    
+    def explain(self,pg_cache,params=()):
+        """EXPLAIN QUERY PLAN (depth, detail) pairs with the joins picked for params."""
+        lines = self.tables[0].plan.explain(pg_cache,params)
+        for table, choice in zip(self.tables[1:],self.choose_joins(params)):
+            left = " LEFT-JOIN" if table.join_type == sp.JoinType.LEFT else ""
+            if choice.strategy == JoinStrategy.HASH:
+                keys = " AND ".join(f"{key.outer}={key.inner}" for key in table.keys)
+                build = "OUTER ROWS" if choice.build_outer else table.alias
+                lines.append((0,f"HASH JOIN {table.alias}{' ON '+keys if keys else ''} (BUILD {build}){left}"))
+                lines += [(depth+1,detail) for depth, detail in table.plan.explain(pg_cache,params)]
+                continue
+            inner_col = choice.key.inner.split(".",1)[1]
+            if choice.strategy == JoinStrategy.ROWID_LOOP:
+                lines.append((0,f"SEARCH {table.alias} USING INTEGER PRIMARY KEY (rowid=?){left}"))
+            else:
+                covering = covering_columns(choice.index,table.tdesc,table.cols,table.plan.query.cond) is not None
+                index = ("COVERING INDEX " if covering else "INDEX ")+self.catalog.index_name(choice.index)
+                lines.append((0,f"SEARCH {table.alias} USING {index} ({inner_col}=?){left}"))
+        return lines+self._output_details()
+    
+    def _lookup(self,table,choice,pg_cache,cond):
+        """Function fetching the rows of table whose join key equals a value."""
+        scan_plan = ScanPlan(table.tdesc,table.cols,cond)
+        if choice.strategy == JoinStrategy.ROWID_LOOP:
+            return lambda val: travel_table_range(table.pg_num,pg_cache,scan_plan,val,val) if _is_number(val) else ()
+        index = choice.index
+        collations = (choice.key.collation,)
+        entries = lambda val: travel_idxs(KeyRange((val,),True,(val,),True,collations),index["pg_num"],pg_cache)
+        col_pos = covering_columns(index,table.tdesc,table.cols,cond)
+        if col_pos is not None:
+            return lambda val: covering_rows(entries(val),col_pos,table.cols,cond,table.tdesc)
+        return lambda val: lookup_rows((entry[-1] for entry in entries(val)),table.pg_num,pg_cache,scan_plan)
+    
+    def rows(self,pg_cache,params=()):
+        """Runs the plan, returning its rows before LIMIT/OFFSET."""
+        p_query = self.query
+        if len(params) != p_query.param_count:
+            raise sp.UnboundParameterError(f"Expected {p_query.param_count} bound values, got {len(params)}")
+        bind = (lambda cond: bind_cond(cond,params,self.tdesc)) if params else (lambda cond: cond)
+        rows = self.tables[0].plan.rows(pg_cache,params)
+        width = len(self.tables[0].cols)
+        for table, choice in zip(self.tables[1:],self.choose_joins(params)):
+            left = table.join_type == sp.JoinType.LEFT
+            keys = table.keys
+            if choice.strategy != JoinStrategy.HASH:
+                # The looked up key is exact, the other keys are checked like ON terms
+                keys = [choice.key]
+            match_terms = list(table.filters)
+            match_terms += [sp.QueryCond(key.outer,sp.WhereCmp.EQ,sp.ColumnRef(key.inner),collation=key.collation)
+                            for key in table.keys if key not in keys]
+            match_cond = bind(and_cond(match_terms))
+            match = compile_entry_filter(match_cond,self.row_pos,self.tdesc) if match_cond else None
+            outer_key = join_key(keys,[self.row_pos[key.outer] for key in keys])
+            if choice.strategy == JoinStrategy.HASH:
+                inner_key = join_key(keys,[self.row_pos[key.inner]-width for key in keys])
+                inner_rows = table.plan.rows(pg_cache,params)
+                rows = hash_join(rows,inner_rows,outer_key,inner_key,match,left,len(table.cols),choice.build_outer)
+            else:
+                inner_cond = bind_cond(table.plan.query.cond,params,table.tdesc) if params else table.plan.query.cond
+                lookup = self._lookup(table,choice,pg_cache,inner_cond)
+                key, pos = choice.key, self.row_pos[choice.key.outer]
+                outer_value = lambda row, pos=pos, key=key: None if row[pos] is None else apply_affinity(row[pos],key.affinity)
+                rows = loop_join(rows,lookup,outer_value,match,left,len(table.cols))
+            width += len(table.cols)
+        if self.residual:
+            rows = filter(compile_entry_filter(bind(and_cond(self.residual)),self.row_pos,self.tdesc),rows)
+        positions = [self.row_pos[col] for col in self.out_cols]
+        rows = ([row[pos] for pos in positions] for row in rows)
+        return self._finish(rows,bind(p_query.having))
+
+def plan_select(p_query,catalog):
+    return JoinPlan(p_query,catalog) if p_query.joins else SelectPlan(p_query,catalog)
+
+STATS_HOOKS = []
+
+def add_stats_hook(hook):
+    """Calls hook with the QueryStats of every query once its rows are done."""
+    STATS_HOOKS.append(hook)
+    
+def remove_stats_hook(hook):
+    STATS_HOOKS.remove(hook)
+
+class QueryStats:
+    """Execution statistics of one query, filled in as its rows are read."""
+    # Scans done by parallel workers are not counted
+    def __init__(self,sql):
+        self.sql = sql
+        self.plan = []
+        self.cached = False
+        self.page_reads = Counter()
+        self.levels = {}
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.cells = 0
+        self.rows = 0
+        self.parse_time = 0.0
+        self.plan_time = 0.0
+        self.io_time = 0.0
+        self.execute_time = 0.0
+        self.output_time = 0.0
+        self.done = False
+        
+    def read(self,pg_num,hit,nbytes=0,elapsed=0.0):
+        self.page_reads[pg_num] += 1
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.bytes_read += nbytes
+            self.io_time += elapsed
+            
+    def as_dict(self):
+        ms = lambda secs: round(secs*1e3,3)
+        return {"sql":self.sql,"plan":self.plan,"cached_statement":self.cached,"rows":self.rows,"cells_decoded":self.cells,
+                "pages":{"reads":self.hits+self.misses,"hits":self.hits,"misses":self.misses,
+                         "bytes_read":self.bytes_read,"by_level":self.levels},
+                "time_ms":{"parse":ms(self.parse_time),"plan":ms(self.plan_time),"io":ms(self.io_time),
+                           "decode":ms(max(self.execute_time-self.io_time,0.0)),"output":ms(self.output_time),
+                           "total":ms(self.parse_time+self.plan_time+self.execute_time+self.output_time)}}
+    
+    def rows_view(self):
+        """The statistics as name|value rows, for EXPLAIN."""
+        rows = []
+        def add(prefix,val):
+            if isinstance(val,dict):
+                for key, item in val.items():
+                    add(prefix+"."+key if prefix else key,item)
+            elif isinstance(val,list) and prefix == "plan":
+                rows.extend([prefix,item] for item in val)
             else:
-                col_idxs = []
-                for col in p_query.col_names:
-                    col_idxs.append(tbl_info.col_names.index(col))
-                results = [[r[col_idx] for col_idx in col_idxs] for r in records if r]
-                for res in results:
-                    print(*res,sep="|")
-else:
-    print(f"Invalid command: {command}")
+                rows.append([prefix,",".join(map(str,val)) if isinstance(val,list) else val])
+        add("",self.as_dict())
+        return rows
+
+def read_levels(root,page_reads,pg_cache):
+    """Yields the pages of each level of the B-tree at root that are in page_reads, root first."""
+    # Only pages the query read are looked at again, so the split costs no
+    # more than the query itself however large the tree
+    level = [root]
+    while level:
+        yield level
+        next_level = []
+        for pg in level:
+            page = pg_cache.get_page(pg)
+            if page[0] in (PageType.LeafTable,PageType.LeafIndex):
+                continue
+            cell_ptrs, last_pg_num = parse_interior_header(page)
+            children = [read_int(page,c_ptr,4) for c_ptr in cell_ptrs]+[last_pg_num]
+            next_level.extend(child for child in children if child in page_reads)
+        level = next_level
+
+def page_levels(page_reads,catalog,pg_cache):
+    """Page reads split by B-tree and level, root first; other pages under other."""
+    roots = {1:"sqlite_schema"}
+    roots.update((entry["pg_num"],name) for name, entry in catalog.tables.items())
+    roots.update((entry["pg_num"],name) for name, entry in catalog.indexes.items())
+    levels = {}
+    counted = 0
+    for root, name in roots.items():
+        if root not in page_reads:
+            continue
+        levels[name] = [sum(page_reads[pg] for pg in level) for level in read_levels(root,page_reads,pg_cache)]
+        counted += sum(levels[name])
+    if sum(page_reads.values()) > counted:
+        levels["other"] = [sum(page_reads.values())-counted]
+    return levels
+
+_ROWS_END = object()
+
+def profile_rows(run,stats,catalog,pg_cache):
+    """Yields the rows of run(), collecting the pages read and cells decoded into stats."""
+    rows = None
+    try:
+        while True:
+            outer, _profiling.stats = _profiling.stats, stats
+            start = time.perf_counter()
+            try:
+                if rows is None:
+                    rows = iter(run())
+                row = next(rows,_ROWS_END)
+            finally:
+                stats.execute_time += time.perf_counter()-start
+                _profiling.stats = outer
+            if row is _ROWS_END:
+                break
+            stats.rows += 1
+            start = time.perf_counter()
+            yield row
+            stats.output_time += time.perf_counter()-start
+    finally:
+        stats.levels = page_levels(stats.page_reads,catalog,pg_cache)
+        stats.done = True
+        for hook in list(STATS_HOOKS):
+            hook(stats)
+
+class PreparedStatement:
+    """A SELECT parsed and planned once, run with any ? values."""
+    def __init__(self,sql,catalog):
+        self.sql = sql
+        start = time.perf_counter()
+        self.query = sp.parse(sql)
+        self.parse_time = time.perf_counter()-start
+        if self.query.action != sp.SQLAction.SELECT:
+            raise sp.InvalidQuerySyntaxError("Only SELECT statements can be prepared")
+        start = time.perf_counter()
+        self.plan = plan_select(self.query,catalog)
+        self.plan_time = time.perf_counter()-start
+        
+    @property
+    def param_count(self):
+        return self.query.param_count
+    
+    def column_names(self):
+        """Names of the result columns."""
+        if self.query.explain == sp.ExplainMode.QUERY_PLAN:
+            return ["id","parent","notused","detail"]
+        if self.query.explain == sp.ExplainMode.ANALYZE:
+            return ["name","value"]
+        return [str(item) if isinstance(item,sp.Aggregate) else item.rsplit(".",1)[-1] for item in self.query.select_items]
+        
+    def execute(self,pg_cache,params=(),stats=None):
+        """Runs the statement, profiled into stats when given."""
+        params = tuple(params)
+        explain = self.query.explain
+        if explain == sp.ExplainMode.QUERY_PLAN:
+            return plan_rows(self.plan.explain(pg_cache,params))
+        if explain == sp.ExplainMode.ANALYZE:
+            stats = stats or QueryStats(self.sql)
+        if stats is None:
+            return limit_rows(self.plan.rows(pg_cache,params),self.query)
+        stats.plan = [detail for depth, detail in self.plan.explain(pg_cache,params)]
+        rows = profile_rows(lambda: limit_rows(self.plan.rows(pg_cache,params),self.query),stats,self.plan.catalog,pg_cache)
+        if explain == sp.ExplainMode.ANALYZE:
+            for _ in rows:
+                pass
+            return stats.rows_view()
+        return rows
+
+def prepare(sql,catalog):
+    """PreparedStatement for sql from the catalog's LRU statement cache."""
+    stmt = catalog.statements.get(sql)
+    if stmt is not None:
+        catalog.statements.move_to_end(sql)
+        return stmt
+    stmt = PreparedStatement(sql,catalog)
+    catalog.statements[sql] = stmt
+    if len(catalog.statements) > STATEMENT_CACHE_SIZE:
+        catalog.statements.popitem(last=False)
+    return stmt
+            
+def execute_select(command,catalog,pg_cache,params=(),stats=None):
+    """Runs a SELECT, returning an iterator over its rows."""
+    cached = command in catalog.statements
+    return execute_prepared(prepare(command,catalog),pg_cache,params,stats,cached)
+
+def execute_prepared(stmt,pg_cache,params=(),stats=None,cached=True):
+    # The statement cache is not locked, so threads run statements prepared elsewhere
+    if stats is None and (STATS_HOOKS or stmt.query.explain == sp.ExplainMode.ANALYZE):
+        stats = QueryStats(stmt.sql)
+    if stats is not None:
+        stats.cached = cached
+        if not cached:
+            stats.parse_time, stats.plan_time = stmt.parse_time, stmt.plan_time
+    return stmt.execute(pg_cache,params,stats)
+
+def main(argv):
+    """Command line front end over app.dbapi: python3 -m app.main db command."""
+    from app.dbapi import connect
+    database_file_path = argv[1]
+    command = argv[2]
+    if command == ".serve":
+        from app.server import serve
+        serve(database_file_path,argv[3] if len(argv) > 3 else None)
+        return
+    with connect(database_file_path) as conn:
+        if command == ".dbinfo":
+            # The cell count of the schema root page, as the original tool printed it
+            table_amt = read_int(conn.page_cache.get_page(1),103,2)
+            print(f"database page size: {conn.page_cache.pg_sz}\nnumber of tables: {table_amt}")
+        elif command == ".tables":
+            print(*conn.table_names())
+        elif command.lower().startswith(("select","explain")):
+            cursor = conn.execute(command)
+            for rcd in cursor:
+                print(*rcd,sep="|")
+            if cursor.stats is not None:
+                import json
+                print(json.dumps(cursor.stats.as_dict()),file=sys.stderr)
+        else:
+            print(f"Invalid command: {command}")
+
+if __name__ == "__main__":
+    main(sys.argv)
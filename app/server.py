@@ -0,0 +1,172 @@
+"""Long-running query server keeping the database, page cache and schema open.
+
+Clients send one statement per line, or {"sql": "...", "params": [...]}, and get
+each row as a JSON array on its own line, then {"rows": n} or {"error": msg}.
+".stats on|off" toggles per-query statistics and ".stats" replies with counters.
+"""
+import asyncio, json, os, time
+import app.main as db
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+DEFAULT_ADDRESS = "127.0.0.1:5480"
+BATCH_ROWS = 256
+SERVER_WORKERS = int(os.environ.get("SQLITE_SERVER_WORKERS",4))
+
+def json_value(val):
+    if isinstance(val,bytes):
+        return val.hex()
+    raise TypeError(f"Cannot send {type(val).__name__} value")
+
+def _close_cache(pg_cache):
+    pg_cache.close()
+    pg_cache.db_file.close()
+
+class QueryServer:
+    """Serves read queries on one database to many clients from a pool of worker threads."""
+    # The workers share one page cache, locked, so a page read for one query
+    # is a hit for every other. A write by another process swaps in a new
+    # cache; the old one closes when the last query running on it ends
+    def __init__(self,db_path,workers=SERVER_WORKERS):
+        self.db_path = db_path
+        # Only the change counter is read through this file, never pages, so
+        # checking it does not move the position the cache is reading from
+        self.db_file = open(db_path,"rb",buffering=0)
+        self.pg_cache = None
+        self.catalog = None
+        self.change_counter = None
+        self.workers = max(1,workers)
+        self.active = 0
+        self.queries = 0
+        self.errors = 0
+        self.rows = 0
+        self.query_time = 0.0
+        self._pool = ThreadPoolExecutor(self.workers,thread_name_prefix="query")
+        self._slots = asyncio.Semaphore(self.workers)
+        # Queries running on each page cache, the serving one or one replaced
+        self._running = {}
+
+    def _refresh(self):
+        counter = db.read_change_counter(self.db_file)
+        if counter == self.change_counter:
+            return
+        old = self.pg_cache
+        # Unbuffered, so no page is served stale from a read buffer after a write
+        self.pg_cache = db.LockedPageCache(db.open_page_cache(open(self.db_path,"rb",buffering=0)))
+        self.catalog = db.load_catalog(self.pg_cache,self.catalog)
+        self.change_counter = counter
+        if old is not None and not self._running.get(old):
+            _close_cache(old)
+
+    def _release_cache(self,pg_cache):
+        self._running[pg_cache] -= 1
+        if not self._running[pg_cache]:
+            del self._running[pg_cache]
+            if pg_cache is not self.pg_cache:
+                _close_cache(pg_cache)
+
+    def stats(self):
+        return {"queries":self.queries,"errors":self.errors,"rows":self.rows,"active":self.active,
+                "query_time_ms":round(self.query_time*1e3,3),"cache":self.pg_cache.stats() if self.pg_cache else None}
+
+    async def run_query(self,command,params,writer,stats=None):
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            self._refresh()
+            # Statements are planned here, as the statement cache is not locked
+            pg_cache = self.pg_cache
+            self._running[pg_cache] = self._running.get(pg_cache,0)+1
+            self.active += 1
+            start = time.perf_counter()
+            row_count = 0
+            rows = None
+            try:
+                cached = command in self.catalog.statements
+                stmt = db.prepare(command,self.catalog)
+                rows = await loop.run_in_executor(self._pool,db.execute_prepared,stmt,pg_cache,params,stats,cached)
+                while batch := await loop.run_in_executor(self._pool,list,islice(rows,BATCH_ROWS)):
+                    if writer.is_closing():
+                        raise ConnectionResetError("Client went away")
+                    writer.write(b"".join(json.dumps(rcd,default=json_value).encode()+b"\n" for rcd in batch))
+                    row_count += len(batch)
+                    await writer.drain()
+                return row_count
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                # A query stopped part way, e.g. by a lost client, unpins its
+                # pages as its rows are dropped, before the cache can close
+                rows = None
+                self._release_cache(pg_cache)
+                self.active -= 1
+                self.queries += 1
+                self.rows += row_count
+                self.query_time += time.perf_counter()-start
+
+    async def handle_client(self,reader,writer):
+        profile = db.PROFILE_QUERIES
+        try:
+            while line := await reader.readline():
+                command = line.decode().strip()
+                params = ()
+                if not command:
+                    continue
+                try:
+                    if command.startswith("{"):
+                        request = json.loads(command)
+                        command, params = request["sql"], request.get("params",())
+                    if command.lower() in (".stats on",".stats off"):
+                        profile = command.lower() == ".stats on"
+                        reply = {"stats":profile}
+                    elif command.lower() == ".stats":
+                        self._refresh()
+                        reply = {"stats":self.stats()}
+                    elif not command.lower().startswith(("select","explain")):
+                        reply = {"error":f"Invalid command: {command}"}
+                    else:
+                        stats = db.QueryStats(command) if profile else None
+                        reply = {"rows":await self.run_query(command,params,writer,stats)}
+                        if stats is not None:
+                            reply["stats"] = stats.as_dict()
+                except Exception as err:
+                    reply = {"error":f"{type(err).__name__}: {err}"}
+                writer.write(json.dumps(reply).encode()+b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self,address):
+        """Listens on a Unix socket for an address with a slash, else on host:port or a port."""
+        if "/" in address:
+            return await asyncio.start_unix_server(self.handle_client,address)
+        host, _, port = address.rpartition(":")
+        return await asyncio.start_server(self.handle_client,host or "127.0.0.1",int(port))
+
+    def close(self):
+        self._pool.shutdown(cancel_futures=True)
+        caches = set(self._running)
+        if self.pg_cache is not None:
+            caches.add(self.pg_cache)
+        for pg_cache in caches:
+            _close_cache(pg_cache)
+        self.db_file.close()
+
+async def _serve(db_path,address):
+    q_server = QueryServer(db_path)
+    try:
+        server = await q_server.start(address)
+        async with server:
+            print("Serving",db_path,"on",address,flush=True)
+            await server.serve_forever()
+    finally:
+        q_server.close()
+
+def serve(db_path,address=None):
+    try:
+        asyncio.run(_serve(db_path,address or DEFAULT_ADDRESS))
+    except KeyboardInterrupt:
+        pass
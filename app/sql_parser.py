@@ -1,4 +1,21 @@
-keywords = ["select","from","create","table","index"]
+import math, re, string
+
+from functools import lru_cache
+
+keywords = ["select","from","create","table","index","where","limit","offset","and","or","not","in","between","like","is","null","order","by","asc","desc","collate","group","having","distinct",
+            "join","inner","left","outer","cross","on","as","explain"]
+
+# Words that end the type name of a column definition and start its constraints
+COL_CONSTRAINTS = ("constraint","primary","not","null","unique","check","default","collate","references","generated","as")
+TABLE_CONSTRAINTS = ("constraint","primary","unique","check","foreign")
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    ('(?:[^']|'')*')                                   # string literal, quotes kept
+   |"((?:[^"]|"")*)" | `([^`]*)` | \[([^\]]*)\]       # quoted identifiers
+   |((?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)        # number
+   |([A-Za-z_][A-Za-z0-9_$]*)                          # keyword or identifier
+   |(<=|>=|<>|!=|==|\|\||[-+*/%<>=(),;?.])              # operator
+)""",re.VERBOSE)
 
 class KeywordUsedAsIdentifierNameError(Exception):
     def __init__(self,msg="A keyword cannot be used as a name for columns, tables or indexes"):
@@ -20,16 +37,43 @@ class InvalidQuerySyntaxError(Exception):
         self.message = msg
         super().__init__(self.message)
         
+class UnboundParameterError(Exception):
+    def __init__(self,msg="Every ? in the statement needs a bound value"):
+        self.message = msg
+        super().__init__(self.message)
+        
 class SQLAction:
     NONE         = 0
     SELECT       = 1
     CREATE_TABLE = 2
     CREATE_INDEX = 3
     
+def tokenize(sql_str):
+    """Splits SQL into tokens, lowercasing keywords and identifiers."""
+    # String literals keep their case and quotes, telling them apart from names
+    tokens = []
+    pos = 0
+    sql_str = sql_str.rstrip()
+    while pos < len(sql_str):
+        match = TOKEN_RE.match(sql_str,pos)
+        if not match:
+            raise InvalidQuerySyntaxError("Unrecognised token at '"+sql_str[pos:pos+10]+"'")
+        literal, dq_name, bq_name, br_name, number, word, op = match.groups()
+        if literal is not None:
+            tokens.append(literal)
+        elif number is not None or op is not None:
+            tokens.append(number or op)
+        else:
+            name = next(tok for tok in (dq_name,bq_name,br_name,word) if tok is not None)
+            tokens.append(name.replace('""','"').lower())
+        pos = match.end()
+    return tokens
+
 class TokenStream:
     def __init__(self,tokens):
         self.idx = -1
         self.stream = tokens
+        self.param_count = 0
         
     def get_next(self):
         self.idx += 1
@@ -47,12 +91,21 @@ class TokenStream:
             raise NoTokenFoundError
         return self.stream[self.idx+1]
     
-    def skip_unneeded_tokens(self):
-        if not self.has_next():
-            raise NoTokenFoundError
-        while self.stream[self.idx+1] in ["primary","key","autoincrement","not","null",","]:
-            self.idx += 1
+    def skip_definition(self):
+        """Skips and returns the tokens up to the ',' or ')' ending a definition."""
+        skipped = []
+        depth = 0
+        while depth or self.peek_next() not in (",",")"):
+            token = self.get_next()
+            depth += (token == "(") - (token == ")")
+            skipped.append(token)
+        return skipped
             
+class ExplainMode:
+    NONE       = 0
+    QUERY_PLAN = 1
+    ANALYZE    = 2
+    
 class WhereCmp:
     EQ = 0
     NE = 1
@@ -60,17 +113,108 @@ class WhereCmp:
     GT = 3
     LE = 4
     GE = 5
+    IN = 6
+    BETWEEN = 7
+    LIKE = 8
+    ISNULL = 9
+    
+class CondJoin:
+    AND = 0
+    OR = 1
+    
+class Collation:
+    BINARY = "binary"
+    NOCASE = "nocase"
+    
+ASCII_FOLD = str.maketrans(string.ascii_uppercase,string.ascii_lowercase)
+    
+NEGATED_CMP = {WhereCmp.EQ:WhereCmp.NE,WhereCmp.NE:WhereCmp.EQ,
+               WhereCmp.LT:WhereCmp.GE,WhereCmp.GE:WhereCmp.LT,
+               WhereCmp.GT:WhereCmp.LE,WhereCmp.LE:WhereCmp.GT}
+    
+def value_key(val):
+    """Sort key in SQLite's storage class order: NULL < INTEGER/REAL < TEXT < BLOB."""
+    if val is None:
+        return (0,0)
+    if isinstance(val,str):
+        return (2,val)
+    if isinstance(val,bytes):
+        return (3,val)
+    return (1,val)
+
+def collate_key(val,collation=None):
+    """value_key under a collation. NOCASE folds ASCII letters only, as in SQLite."""
+    if collation == Collation.NOCASE and isinstance(val,str):
+        return (2,val.translate(ASCII_FOLD))
+    return value_key(val)
+
+class ColumnRef:
+    """A column on the right of a comparison, as in a.id = b.a_id."""
+    def __init__(self,col):
+        self.col = col
+        
+    def __str__(self):
+        return self.col
+
+class Param:
+    """A ? marker, replaced by params[idx] when the statement is executed."""
+    def __init__(self,idx):
+        self.idx = idx
+        
+    def __str__(self):
+        return "?"
+
+@lru_cache(maxsize=64)
+def like_to_regex(pattern):
+    """Compiles a LIKE pattern to a bytes regex over UTF-8, folding ASCII case only."""
+    regex = b""
+    for ch in pattern.encode():
+        if ch == ord("%"):
+            regex += b".*"
+        elif ch == ord("_"):
+            regex += b"(?:[\\x00-\\x7f]|[\\xc0-\\xff][\\x80-\\xbf]*)"
+        else:
+            regex += re.escape(bytes([ch]))
+    return re.compile(regex,re.IGNORECASE|re.DOTALL)
     
+def real_text(val):
+    """A REAL as SQLite writes it as text: 15 significant digits, never without a point."""
+    if math.isinf(val):
+        return "Inf" if val > 0 else "-Inf"
+    text = "%.15g" % val
+    mantissa, exp = text.split("e") if "e" in text else (text,None)
+    if "." not in mantissa:
+        mantissa += ".0"
+    return mantissa if exp is None else mantissa+"e"+exp
+
+def sql_text(val):
+    """A number or text value as the text LIKE matches against."""
+    return real_text(val) if isinstance(val,float) else str(val)
+
+def between_test(key,low,high,negated):
+    """key BETWEEN low AND high in three-valued logic, a None bound being NULL."""
+    # low <= key AND key <= high is NULL, and so never true, when one side is
+    # NULL and the other not false, negated or not
+    above = None if low is None else low <= key
+    below = None if high is None else key <= high
+    if above is False or below is False:
+        return negated
+    if above is None or below is None:
+        return False
+    return not negated
+
 class QueryCond:
-    def __init__(self,col,op,val):
+    def __init__(self,col,op,val,negated=False,collation=None):
         self.col = col
-        self.op = self._cmp_op(op)
+        self.op = op if isinstance(op,int) else self._cmp_op(op)
         self.value = val
+        self.negated = negated
+        self.collation = collation
     
     def _cmp_op(self,op):
         if op == "==" or op == "=":
             return WhereCmp.EQ
-        if op == "!=":
+        if op == "!=" or op == "<>":
             return WhereCmp.NE
         if op == "<":
             return WhereCmp.LT
@@ -80,23 +224,160 @@ class QueryCond:
             return WhereCmp.LE
         if op == ">=":
             return WhereCmp.GE
+        raise InvalidQuerySyntaxError("Unknown comparison operator '"+op+"'")
         
     def __str__(self):
-        return self.col + " " + str(self.op) + " " + self.value
+        return str(self.col) + " " + ("NOT " if self.negated else "") + str(self.op) + " " + str(self.value)
+    
+    def negate(self):
+        if self.op in NEGATED_CMP:
+            self.op = NEGATED_CMP[self.op]
+        else:
+            self.negated = not self.negated
+        return self
+    
+    def columns(self):
+        return [self.col] + ([self.value.col] if isinstance(self.value,ColumnRef) else [])
+    
+    def leaves(self):
+        return [self]
+    
+    def has_params(self):
+        values = self.value if isinstance(self.value,list) else [self.value]
+        return any(isinstance(val,Param) for val in values)
         
     def comp(self,val):
-        if WhereCmp.EQ:
-            return self.value == val
-        if WhereCmp.NE:
-            return self.value != val
-        if WhereCmp.LT:
-            return self.value < val
-        if WhereCmp.GT:
-            return self.value > val
-        if WhereCmp.LE:
-            return self.value <= val
-        if WhereCmp.GE:
-            return self.value >= val
+        """Tests a decoded column value. Comparisons with NULL are never true."""
+        if self.op == WhereCmp.ISNULL:
+            return (val is None) != self.negated
+        if val is None:
+            return False
+        collation = self.collation
+        key = collate_key(val,collation)
+        if self.op == WhereCmp.IN:
+            if self.negated and None in self.value:
+                return False
+            return (key in {collate_key(v,collation) for v in self.value}) != self.negated
+        if self.op == WhereCmp.BETWEEN:
+            low, high = (None if val is None else collate_key(val,collation) for val in self.value)
+            return between_test(key,low,high,self.negated)
+        if self.op == WhereCmp.LIKE:
+            # LIKE never matches a blob, as in SQLite built with SQLITE_LIKE_DOESNT_MATCH_BLOBS
+            if isinstance(val,bytes):
+                return self.negated
+            return bool(like_to_regex(self.value).fullmatch(sql_text(val).encode())) != self.negated
+        if self.value is None:
+            return False
+        lit = collate_key(self.value,collation)
+        if self.op == WhereCmp.EQ:
+            return key == lit
+        if self.op == WhereCmp.NE:
+            return key != lit
+        if self.op == WhereCmp.LT:
+            return key < lit
+        if self.op == WhereCmp.GT:
+            return key > lit
+        if self.op == WhereCmp.LE:
+            return key <= lit
+        if self.op == WhereCmp.GE:
+            return key >= lit
+
+class QueryCondGroup:
+    def __init__(self,join,conds):
+        self.join = join
+        self.conds = conds
+        
+    def __str__(self):
+        join = " AND " if self.join == CondJoin.AND else " OR "
+        return "(" + join.join(str(cond) for cond in self.conds) + ")"
+    
+    def negate(self):
+        self.join = CondJoin.OR if self.join == CondJoin.AND else CondJoin.AND
+        for cond in self.conds:
+            cond.negate()
+        return self
+    
+    def columns(self):
+        return [col for cond in self.conds for col in cond.columns()]
+    
+    def leaves(self):
+        return [leaf for cond in self.conds for leaf in cond.leaves()]
+    
+    def has_params(self):
+        return any(cond.has_params() for cond in self.conds)
+    
+    def comp(self,record):
+        """Tests a record given as a dict of column name to decoded value."""
+        if self.join == CondJoin.AND:
+            return all(comp_record(cond,record) for cond in self.conds)
+        return any(comp_record(cond,record) for cond in self.conds)
+    
+def comp_record(cond,record):
+    """Tests a condition against a dict from column name, or Aggregate, to value."""
+    if isinstance(cond,QueryCondGroup):
+        return cond.comp(record)
+    return cond.comp(record.get(cond.col))
+
+def _bind_value(val,params):
+    if not isinstance(val,Param):
+        return val
+    if val.idx >= len(params):
+        raise UnboundParameterError
+    return params[val.idx]
+
+def bind_params(cond,params):
+    """Copy of a condition with each ? replaced by its value, leaving the template as is."""
+    if cond is None:
+        return None
+    if isinstance(cond,QueryCondGroup):
+        return QueryCondGroup(cond.join,[bind_params(sub_cond,params) for sub_cond in cond.conds])
+    if isinstance(cond.value,list):
+        value = [_bind_value(val,params) for val in cond.value]
+    else:
+        value = _bind_value(cond.value,params)
+    if cond.op == WhereCmp.LIKE and not isinstance(value,str):
+        # A bound pattern is read as text, and LIKE NULL matches nothing, negated or not
+        if value is None:
+            return QueryCond(cond.col,WhereCmp.EQ,None,False,cond.collation)
+        value = value.decode(errors="replace") if isinstance(value,bytes) else sql_text(value)
+    return QueryCond(cond.col,cond.op,value,cond.negated,cond.collation)
+
+class AggFunc:
+    COUNT = "count"
+    SUM   = "sum"
+    AVG   = "avg"
+    MIN   = "min"
+    MAX   = "max"
+    
+AGG_FUNCS = (AggFunc.COUNT,AggFunc.SUM,AggFunc.AVG,AggFunc.MIN,AggFunc.MAX)
+    
+class Aggregate:
+    """An aggregate call in a SELECT list, HAVING or ORDER BY; col is None for COUNT(*)."""
+    def __init__(self,func,col=None,distinct=False):
+        self.func = func
+        self.col = col
+        self.distinct = distinct
+        
+    def __eq__(self,other):
+        return isinstance(other,Aggregate) and (self.func,self.col,self.distinct) == (other.func,other.col,other.distinct)
+    
+    def __hash__(self):
+        return hash((self.func,self.col,self.distinct))
+    
+    def __str__(self):
+        return self.func + "(" + ("distinct " if self.distinct else "") + (self.col or "*") + ")"
+
+class JoinType:
+    INNER = "inner"
+    LEFT  = "left"
+    
+class JoinClause:
+    """A table joined in the FROM clause; a comma or CROSS JOIN has no ON condition."""
+    def __init__(self,table,alias,join_type=JoinType.INNER,cond=None):
+        self.table = table
+        self.alias = alias
+        self.join_type = join_type
+        self.cond = cond
 
 class ParsedQuery:
     def __init__(self):
@@ -104,50 +385,65 @@ class ParsedQuery:
         self.all_cols = False
         self.count_cols = False
         self.col_names = []
+        self.col_pos = {}
+        self.col_collations = []
+        self.select_items = []
         self.col_dtypes = []
         self.table = None
+        self.alias = None
+        self.joins = []
+        self.rowid_col = None
         self.cond = None
         self.index = None
+        self.group_by = []
+        self.having = None
+        self.order_by = []
+        self.order_collations = []
+        self.limit = None
+        self.offset = 0
+        self.param_count = 0
+        self.explain = ExplainMode.NONE
     
     def has_action(self):
         return self.action != SQLAction.NONE
 
 def parse(sql_str):
-    token_stream = TokenStream(sql_str.lower().replace("(","( ").replace(")"," )").replace(","," , ").split())
+    token_stream = TokenStream(tokenize(sql_str))
     p_query = ParsedQuery()
     while token_stream.has_next():
         token = token_stream.get_next()
-        if "select" == token:
+        if "explain" == token:
+            if p_query.has_action() or p_query.explain:
+                raise InvalidQuerySyntaxError("EXPLAIN must start the statement")
+            p_query.explain = ExplainMode.ANALYZE
+            if token_stream.has_next() and token_stream.peek_next() == "query":
+                token_stream.get_next()
+                if not token_stream.has_next() or token_stream.get_next() != "plan":
+                    raise InvalidQuerySyntaxError("Expected PLAN after EXPLAIN QUERY")
+                p_query.explain = ExplainMode.QUERY_PLAN
+        elif "select" == token:
             if p_query.has_action():
                 raise QueryActionAlreadySetError
             p_query.action = SQLAction.SELECT
-            col_name = token_stream.get_next()
-            if col_name == "*":
-                p_query.all_cols = True
-            elif col_name == "count(":
-                sym = token_stream.get_next()
-                endpar = token_stream.get_next()
-                if sym == "*" and endpar == ")":
-                    p_query.count_cols = True
+            while True:
+                col_name = token_stream.get_next()
+                if col_name == "*":
+                    p_query.all_cols = True
+                    p_query.col_names.append(col_name)
+                    p_query.select_items.append(col_name)
+                elif _at_aggregate(col_name,token_stream):
+                    p_query.select_items.append(_parse_aggregate(col_name,token_stream))
                 else:
-                    raise InvalidQuerySyntaxError
-            else:
-                col_names = []
-                while True:
-                    if col_name in keywords:
-                        raise KeywordUsedAsIdentifierNameError
-                    col_names.append(col_name)
-                    if token_stream.peek_next() == ",":
-                        token_stream.get_next()
-                        col_name = token_stream.get_next()
-                    else:
-                        break
-                p_query.col_names = col_names
+                    col_name = _parse_column_name(col_name,token_stream,star=True)
+                    p_query.col_names.append(col_name)
+                    p_query.select_items.append(col_name)
+                if not token_stream.has_next() or token_stream.peek_next() != ",":
+                    break
+                token_stream.get_next()
         elif "from" == token:
-            tbl_name = token_stream.get_next()
-            if tbl_name in keywords:
-                raise KeywordUsedAsIdentifierNameError
-            p_query.table = tbl_name
+            p_query.table, p_query.alias = _parse_table_ref(token_stream)
+            while token_stream.has_next() and token_stream.peek_next() in (",","join","inner","left","cross"):
+                p_query.joins.append(_parse_join(token_stream))
         elif "create" == token:
             if p_query.has_action():
                 raise QueryActionAlreadySetError
@@ -162,12 +458,24 @@ def parse(sql_str):
                     raise InvalidQuerySyntaxError("Expected a '(' after the table name")
                 while token_stream.peek_next() != ")":
                     col_name = token_stream.get_next()
-                    data_type = token_stream.get_next()
-                    if token_stream.peek_next() != ")":
-                        token_stream.skip_unneeded_tokens()
+                    col_def = token_stream.skip_definition()
+                    if token_stream.peek_next() == ",":
+                        token_stream.get_next()
+                    if col_name in TABLE_CONSTRAINTS:
+                        continue
+                    type_len = next((i for i, tok in enumerate(col_def) if tok in COL_CONSTRAINTS),len(col_def))
+                    data_type = " ".join(col_def[:type_len])
+                    constraints = col_def[type_len:]
+                    if data_type == "integer" and "primary" in constraints:
+                        # An INTEGER PRIMARY KEY column is an alias for the rowid
+                        p_query.rowid_col = col_name
                     p_query.col_names.append(col_name)
                     p_query.col_dtypes.append(data_type)
-            elif action == "index":
+                    p_query.col_collations.append(_find_collation(constraints))
+            elif action in ("index","unique"):
+                if action == "unique" and token_stream.get_next() != "index":
+                    raise InvalidQuerySyntaxError("Expected INDEX after UNIQUE")
+                p_query.action = SQLAction.CREATE_INDEX
                 if p_query.col_names:
                     print("HAS COLUMNS:",p_query.col_names)
                 idx_name = token_stream.get_next()
@@ -184,20 +492,253 @@ def parse(sql_str):
                     raise InvalidQuerySyntaxError("Expected a '(' after the table name")
                 while token_stream.peek_next() != ")":
                     col_name = token_stream.get_next()
+                    col_def = token_stream.skip_definition()
+                    if token_stream.peek_next() == ",":
+                        token_stream.get_next()
                     p_query.col_names.append(col_name)
+                    p_query.col_collations.append(_find_collation(col_def))
             else:
                 raise InvalidQuerySyntaxError("Create keyword must be followed by either table or index") 
+            p_query.col_pos = {col:pos for pos, col in enumerate(p_query.col_names)}
         elif "where" == token:
-            col_name = token_stream.get_next()
-            cmp_op = token_stream.get_next()
-            value = token_stream.get_next()
-            if value.startswith("'"):
-                if value.endswith("'"):
-                    value = value[1:-1] #.title()
+            p_query.cond = _parse_cond_or(token_stream)
+        elif "group" == token:
+            if token_stream.get_next() != "by":
+                raise InvalidQuerySyntaxError("Expected BY after GROUP")
+            while True:
+                col_name = _parse_column_name(token_stream.get_next(),token_stream)
+                p_query.group_by.append(col_name)
+                if not token_stream.has_next() or token_stream.peek_next() != ",":
+                    break
+                token_stream.get_next()
+        elif "having" == token:
+            if not p_query.group_by:
+                raise InvalidQuerySyntaxError("HAVING needs a GROUP BY clause")
+            p_query.having = _parse_cond_or(token_stream)
+        elif "order" == token:
+            if token_stream.get_next() != "by":
+                raise InvalidQuerySyntaxError("Expected BY after ORDER")
+            while True:
+                col_name = token_stream.get_next()
+                if _at_aggregate(col_name,token_stream):
+                    col_name = _parse_aggregate(col_name,token_stream)
                 else:
-                    while not value.endswith("'"):
-                        value += " " + token_stream.get_next()
-                    value = value[1:-1] #.title()
-            p_query.cond = QueryCond(col_name,cmp_op,value)
+                    col_name = _parse_column_name(col_name,token_stream)
+                collation = _parse_collate(token_stream)
+                desc = False
+                if token_stream.has_next() and token_stream.peek_next() in ("asc","desc"):
+                    desc = token_stream.get_next() == "desc"
+                p_query.order_by.append((col_name,desc))
+                p_query.order_collations.append(collation)
+                if not token_stream.has_next() or token_stream.peek_next() != ",":
+                    break
+                token_stream.get_next()
+        elif "limit" == token:
+            p_query.limit = _parse_count(token_stream)
+            if token_stream.has_next() and token_stream.peek_next() in ("offset",","):
+                sep = token_stream.get_next()
+                value = _parse_count(token_stream)
+                if sep == "offset":
+                    p_query.offset = value
+                else:
+                    p_query.offset, p_query.limit = p_query.limit, value
+            if p_query.limit < 0:
+                p_query.limit = None
+            p_query.offset = max(p_query.offset,0)
+        elif ";" == token:
+            if token_stream.has_next():
+                raise InvalidQuerySyntaxError("Only one statement can be run at a time")
+    p_query.param_count = token_stream.param_count
+    p_query.count_cols = p_query.select_items == [Aggregate(AggFunc.COUNT)] and not p_query.group_by
     return p_query
+
+def _parse_column_name(token,token_stream,star=False):
+    """A column name, or table.col; with star set, table.* too."""
+    if token in keywords:
+        raise KeywordUsedAsIdentifierNameError
+    if not token_stream.has_next() or token_stream.peek_next() != ".":
+        return token
+    token_stream.get_next()
+    col_name = token_stream.get_next()
+    if col_name in keywords or (col_name == "*" and not star):
+        raise KeywordUsedAsIdentifierNameError
+    return token+"."+col_name
+
+def _parse_table_ref(token_stream):
+    """A table name and its alias, None if it has none."""
+    tbl_name = token_stream.get_next()
+    if tbl_name in keywords:
+        raise KeywordUsedAsIdentifierNameError
+    alias = None
+    if token_stream.has_next() and token_stream.peek_next() == "as":
+        token_stream.get_next()
+        alias = token_stream.get_next()
+        if alias in keywords:
+            raise KeywordUsedAsIdentifierNameError
+    elif token_stream.has_next() and token_stream.peek_next() not in keywords and token_stream.peek_next() not in (",",";"):
+        alias = token_stream.get_next()
+    return tbl_name, alias
+
+def _parse_join(token_stream):
+    token = token_stream.get_next()
+    join_type = JoinType.INNER
+    if token == "left":
+        join_type = JoinType.LEFT
+        if token_stream.peek_next() == "outer":
+            token_stream.get_next()
+    if token != "," and token != "join" and token_stream.get_next() != "join":
+        raise InvalidQuerySyntaxError("Expected JOIN after "+token.upper())
+    tbl_name, alias = _parse_table_ref(token_stream)
+    cond = None
+    if token != "," and token != "cross" and token_stream.has_next() and token_stream.peek_next() == "on":
+        token_stream.get_next()
+        cond = _parse_cond_or(token_stream)
+    if join_type == JoinType.LEFT and cond is None:
+        raise InvalidQuerySyntaxError("LEFT JOIN needs an ON condition")
+    return JoinClause(tbl_name,alias,join_type,cond)
+
+def _at_aggregate(token,token_stream):
+    return token in AGG_FUNCS and token_stream.has_next() and token_stream.peek_next() == "("
+
+def _parse_aggregate(func,token_stream):
+    token_stream.get_next()
+    distinct = token_stream.peek_next() == "distinct"
+    if distinct:
+        token_stream.get_next()
+    col_name = token_stream.get_next()
+    if col_name == "*":
+        if func != AggFunc.COUNT or distinct:
+            raise InvalidQuerySyntaxError("Only COUNT takes *")
+        col_name = None
+    else:
+        col_name = _parse_column_name(col_name,token_stream)
+    if token_stream.get_next() != ")":
+        raise InvalidQuerySyntaxError("Aggregate functions take a single column")
+    return Aggregate(func,col_name,distinct)
+
+def _find_collation(tokens):
+    if "collate" not in tokens:
+        return None
+    pos = tokens.index("collate")+1
+    if pos >= len(tokens) or tokens[pos] not in (Collation.BINARY,Collation.NOCASE):
+        raise InvalidQuerySyntaxError("Only the BINARY and NOCASE collations are supported")
+    return tokens[pos]
+
+def _parse_collate(token_stream,collation=None):
+    # The collation of an optional COLLATE clause, else collation
+    if token_stream.has_next() and token_stream.peek_next() == "collate":
+        token_stream.get_next()
+        return _find_collation(["collate",token_stream.get_next()])
+    return collation
+
+def _parse_cond_or(token_stream):
+    conds = [_parse_cond_and(token_stream)]
+    while token_stream.has_next() and token_stream.peek_next() == "or":
+        token_stream.get_next()
+        conds.append(_parse_cond_and(token_stream))
+    return conds[0] if len(conds) == 1 else QueryCondGroup(CondJoin.OR,conds)
+
+def _parse_cond_and(token_stream):
+    conds = [_parse_cond_not(token_stream)]
+    while token_stream.has_next() and token_stream.peek_next() == "and":
+        token_stream.get_next()
+        conds.append(_parse_cond_not(token_stream))
+    return conds[0] if len(conds) == 1 else QueryCondGroup(CondJoin.AND,conds)
+
+def _parse_cond_not(token_stream):
+    token = token_stream.get_next()
+    if token == "not":
+        return _parse_cond_not(token_stream).negate()
+    if token == "(":
+        cond = _parse_cond_or(token_stream)
+        if token_stream.get_next() != ")":
+            raise InvalidQuerySyntaxError("Expected a ')' to close the condition")
+        return cond
+    if _at_aggregate(token,token_stream):
+        col_name = _parse_aggregate(token,token_stream)
+    else:
+        col_name = _parse_column_name(token,token_stream)
+    collation = _parse_collate(token_stream)
+    op = token_stream.get_next()
+    negated = False
+    if op == "is":
+        if token_stream.peek_next() == "not":
+            token_stream.get_next()
+            negated = True
+        if token_stream.get_next() != "null":
+            raise InvalidQuerySyntaxError("Expected NULL after IS")
+        return QueryCond(col_name,WhereCmp.ISNULL,None,negated)
+    if op == "not":
+        negated = True
+        op = token_stream.get_next()
+    if op == "in":
+        if token_stream.get_next() != "(":
+            raise InvalidQuerySyntaxError("Expected a '(' after IN")
+        values = [_parse_value(token_stream)]
+        while token_stream.peek_next() == ",":
+            token_stream.get_next()
+            values.append(_parse_value(token_stream))
+        if token_stream.get_next() != ")":
+            raise InvalidQuerySyntaxError("Expected a ')' to close the IN list")
+        # A COLLATE after the list applies to the IN result, so compares nothing
+        _parse_collate(token_stream)
+        return QueryCond(col_name,WhereCmp.IN,values,negated,collation)
+    if op == "between":
+        low = _parse_value(token_stream)
+        if token_stream.get_next() != "and":
+            raise InvalidQuerySyntaxError("Expected AND in BETWEEN")
+        high = _parse_value(token_stream)
+        high_collation = _parse_collate(token_stream,collation)
+        if high_collation == collation:
+            return QueryCond(col_name,WhereCmp.BETWEEN,[low,high],negated,collation)
+        # A COLLATE after the upper bound only applies to the comparison with it
+        cond = QueryCondGroup(CondJoin.AND,[QueryCond(col_name,WhereCmp.GE,low,False,collation),
+                                            QueryCond(col_name,WhereCmp.LE,high,False,high_collation)])
+        return cond.negate() if negated else cond
+    if op == "like":
+        pattern = _parse_value(token_stream)
+        if not isinstance(pattern,(str,Param)):
+            raise InvalidQuerySyntaxError("LIKE needs a string pattern")
+        return QueryCond(col_name,WhereCmp.LIKE,pattern,negated)
+    if negated:
+        raise InvalidQuerySyntaxError("NOT must be followed by IN, BETWEEN or LIKE")
+    value = _parse_value(token_stream,columns=True)
+    return QueryCond(col_name,op,value,False,_parse_collate(token_stream,collation))
+
+def _parse_value(token_stream,columns=False):
+    """A literal or ? marker, or with columns set, a ColumnRef."""
+    value = token_stream.get_next()
+    if value == "?":
+        token_stream.param_count += 1
+        return Param(token_stream.param_count-1)
+    if value.startswith("'"):
+        return value[1:-1].replace("''","'")
+    if value == "null":
+        return None
+    if columns and (value[0].isalpha() or value[0] == "_") and value not in keywords:
+        return ColumnRef(_parse_column_name(value,token_stream))
+    sign = 1
+    if value in ("-","+"):
+        sign = -1 if value == "-" else 1
+        value = token_stream.get_next()
+    try:
+        return sign*int(value)
+    except ValueError:
+        pass
+    try:
+        return sign*float(value)
+    except ValueError:
+        raise InvalidQuerySyntaxError("Expected a literal value, got '"+value+"'")
+
+def _parse_count(token_stream):
+    token = token_stream.get_next()
+    sign = 1
+    if token in ("-","+"):
+        # LIMIT -1 is no limit, a negative OFFSET none
+        sign = -1 if token == "-" else 1
+        token = token_stream.get_next()
+    try:
+        return sign*int(token)
+    except ValueError:
+        raise InvalidQuerySyntaxError("Expected an integer in LIMIT/OFFSET, got '"+token+"'")
             
\ No newline at end of file
@@ -0,0 +1,50 @@
+import os, sqlite3, sys
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app.main as db
+from app.dbapi import connect
+
+@pytest.fixture
+def make_db(tmp_path):
+    # Writes a database with stdlib sqlite3: script, then each (sql, rows) in inserts
+    count = [0]
+    def make(script,inserts=(),page_size=4096):
+        count[0] += 1
+        path = str(tmp_path/("test%d.db" % count[0]))
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA page_size = %d" % page_size)
+        conn.executescript(script)
+        for sql, rows in inserts:
+            conn.executemany(sql,rows)
+        conn.commit()
+        conn.close()
+        return path
+    return make
+
+@pytest.fixture
+def compare():
+    # Checks a query returns the same rows from the engine as from sqlite3
+    def check(path,sql,params=(),ordered=False):
+        with connect(path) as conn:
+            got = [tuple(row) for row in conn.execute(sql,params)]
+        expected = sqlite3.connect(path).execute(sql,params).fetchall()
+        if not ordered:
+            got, expected = sorted(got,key=repr), sorted(expected,key=repr)
+        assert got == expected, sql
+        return got
+    return check
+
+@pytest.fixture
+def open_db():
+    # Page cache and catalog of a database, for tests calling engine internals
+    files = []
+    def open_(path):
+        db_file = open(path,"rb")
+        files.append(db_file)
+        pg_cache = db.open_page_cache(db_file,use_mmap=False)
+        return pg_cache, db.load_catalog(pg_cache,sidecar=False)
+    yield open_
+    for db_file in files:
+        db_file.close()
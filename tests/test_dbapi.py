@@ -0,0 +1,45 @@
+import gc, sqlite3
+import pytest
+
+from app.dbapi import connect
+
+@pytest.fixture
+def live_db(make_db):
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, v INTEGER);",
+                   [("INSERT INTO t (v) VALUES (?)",[(idx,) for idx in range(2000)])])
+
+def write(path):
+    # Another connection changes the last row in place, bumping the change
+    # counter without growing the file past a mapping taken before, nor
+    # touching the leaves cursors part way through are reading
+    writer = sqlite3.connect(path)
+    writer.execute("UPDATE t SET v = -1 WHERE id = 2000")
+    writer.commit()
+    writer.close()
+
+def last_v(conn):
+    return conn.execute("SELECT v FROM t WHERE id = 2000").fetchall()
+
+@pytest.mark.parametrize("use_mmap",[False,True])
+def test_unfetched_cursor_keeps_its_cache(live_db,use_mmap):
+    with connect(live_db,use_mmap=use_mmap) as conn:
+        pending = conn.execute("SELECT id, v FROM t")
+        write(live_db)
+        # The reload waits for pending, which has not read a row yet
+        assert len(conn.execute("SELECT id FROM t").fetchall()) == 2000
+        assert len(pending.fetchall()) == 2000
+        assert last_v(conn) == [(-1,)]
+
+@pytest.mark.parametrize("use_mmap",[False,True])
+def test_done_cursors_let_the_reload_run(live_db,use_mmap):
+    with connect(live_db,use_mmap=use_mmap) as conn:
+        dropped = conn.execute("SELECT id FROM t")
+        closed = conn.execute("SELECT id FROM t")
+        part = conn.execute("SELECT id FROM t")
+        assert part.fetchmany(10) == [(idx,) for idx in range(1,11)]
+        write(live_db)
+        del dropped
+        gc.collect()
+        closed.close()
+        assert len(part.fetchall()) == 1990
+        assert last_v(conn) == [(-1,)]
@@ -0,0 +1,186 @@
+import random, sqlite3
+import pytest
+
+import app.main as db
+import app.sql_parser as sp
+from app.dbapi import connect
+
+def mixed_value(rng):
+    kind = rng.randrange(5)
+    if kind == 0:
+        return rng.randrange(-500,500)
+    if kind == 1:
+        return rng.randrange(-5000,5000)/8
+    if kind == 2:
+        return "k%05d" % rng.randrange(3000)
+    if kind == 3:
+        return bytes([rng.randrange(256) for _ in range(3)])
+    return None if rng.random() < 0.5 else rng.randrange(10)
+
+@pytest.fixture
+def index_db(make_db):
+    rng = random.Random(7)
+    rows = [(None,mixed_value(rng),rng.randrange(50),"x"*rng.randrange(40)) for _ in range(4000)]
+    # Small pages give the index several interior levels
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, k, g INTEGER, pad TEXT);"
+                   "CREATE INDEX idx_t_k ON t (k);"
+                   "CREATE INDEX idx_t_g_k ON t (g, k);",
+                   [("INSERT INTO t VALUES (?,?,?,?)",rows)],page_size=512)
+
+def index_entries(path,sql,params=()):
+    return [tuple(row) for row in sqlite3.connect(path).execute(sql,params)]
+
+def test_index_has_interior_levels(index_db,open_db):
+    pg_cache, catalog = open_db(index_db)
+    assert len(list(db.btree_levels(catalog.indexes["idx_t_k"]["pg_num"],pg_cache))) >= 3
+
+def test_cursor_walks_forward_and_back(index_db,open_db):
+    pg_cache, catalog = open_db(index_db)
+    expected = index_entries(index_db,"SELECT k, rowid FROM t ORDER BY k, rowid")
+    with db.IndexCursor(pg_cache,catalog.indexes["idx_t_k"]["pg_num"]) as cursor:
+        forward = []
+        valid = cursor.first()
+        while valid:
+            forward.append(tuple(cursor.entry()))
+            valid = cursor.next()
+        assert forward == expected
+        backward = []
+        valid = cursor.last()
+        while valid:
+            backward.append(tuple(cursor.entry()))
+            valid = cursor.prev()
+        assert backward == expected[::-1]
+    assert not pg_cache._pins
+
+@pytest.mark.parametrize("key",[-1000,-3,0,7,7.5,250.125,"k00000","k01500","k01500x","zzz",b"",b"\x80",b"\xff\xff\xff\xff"])
+def test_seek_matches_sqlite(index_db,open_db,key):
+    pg_cache, catalog = open_db(index_db)
+    with db.IndexCursor(pg_cache,catalog.indexes["idx_t_k"]["pg_num"]) as cursor:
+        for inclusive, op in ((True,">="),(False,">")):
+            expected = index_entries(index_db,"SELECT k, rowid FROM t WHERE k %s ? ORDER BY k, rowid" % op,(key,))
+            valid = cursor.seek((key,),inclusive)
+            assert valid == bool(expected)
+            if valid:
+                # Walk on from the seek position across leaf and interior entries
+                got = [tuple(cursor.entry())]
+                for _ in range(30):
+                    if not cursor.next():
+                        break
+                    got.append(tuple(cursor.entry()))
+                assert got == expected[:len(got)]
+                assert len(got) == min(31,len(expected))
+        for inclusive, op in ((True,"<="),(False,"<")):
+            expected = index_entries(index_db,"SELECT k, rowid FROM t WHERE k %s ? AND k IS NOT NULL ORDER BY k DESC, rowid DESC" % op,(key,))
+            valid = cursor.seek_last((key,),inclusive)
+            if not expected:
+                # Only NULL keys, which a bound never matches, come before it
+                assert not valid or cursor.entry()[0] is None
+                continue
+            assert valid
+            got = [tuple(cursor.entry())]
+            for _ in range(30):
+                if not cursor.prev() or cursor.entry()[0] is None:
+                    break
+                got.append(tuple(cursor.entry()))
+            assert got == expected[:len(got)]
+            assert len(got) == min(31,len(expected))
+
+def test_prev_after_next_crosses_interior_cells(index_db,open_db):
+    pg_cache, catalog = open_db(index_db)
+    expected = index_entries(index_db,"SELECT k, rowid FROM t ORDER BY k, rowid")
+    with db.IndexCursor(pg_cache,catalog.indexes["idx_t_k"]["pg_num"]) as cursor:
+        assert cursor.seek(expected[len(expected)//2][:1])
+        pos = expected.index(tuple(cursor.entry()))
+        for step in [1]*40+[-1]*90+[1]*120:
+            assert (cursor.next() if step > 0 else cursor.prev())
+            pos += step
+            assert tuple(cursor.entry()) == expected[pos]
+
+def test_key_range_from_cond():
+    def cond_of(where):
+        return sp.parse("SELECT * FROM t WHERE "+where).cond
+    eq = db.KeyRange.from_cond(cond_of("k = 5"))
+    assert (eq.low,eq.low_incl,eq.high,eq.high_incl) == ((5,),True,(5,),True)
+    lt = db.KeyRange.from_cond(cond_of("k < 5"))
+    assert (lt.low,lt.low_incl,lt.high,lt.high_incl) == ((None,),False,(5,),False)
+    ge = db.KeyRange.from_cond(cond_of("k >= 'b'"))
+    assert (ge.low,ge.low_incl,ge.high) == (("b",),True,None)
+    between = db.KeyRange.from_cond(cond_of("k BETWEEN 2 AND 9"))
+    assert (between.low,between.high) == ((2,),(9,))
+    like = db.KeyRange.from_cond(cond_of("k LIKE '12%'"))
+    assert (like.low,like.low_incl,like.high,like.high_incl) == (("12",),True,("13",),False)
+    assert not db.KeyRange.is_exact(cond_of("k LIKE '12%'"))
+    for where in ("k != 5","k = NULL","k LIKE 'ab%'","k IN (1, 2)","NOT k = 5","k IS NULL"):
+        assert db.KeyRange.from_cond(cond_of(where)) is None, where
+
+def test_key_range_bounds():
+    both = db.KeyRange((2,),False,(9,),True).intersect(db.KeyRange((2,),True,(12,),False))
+    assert (both.low,both.low_incl,both.high,both.high_incl) == ((2,),False,(9,),True)
+    assert both.below_low((2,"row")) and not both.below_low((2.5,"row"))
+    assert both.above_high((9.5,"row")) and not both.above_high((9,"row"))
+    open_high = db.KeyRange((None,),False,(5,),False)
+    assert open_high.below_low((None,1))
+    assert open_high.above_high((5,1)) and open_high.above_high(("a",1))
+    assert not open_high.above_high((4.9,1))
+    nocase = db.KeyRange(("abc",),True,("abc",),True,(sp.Collation.NOCASE,))
+    assert not nocase.below_low(("ABC",1)) and not nocase.above_high(("aBc",1))
+    assert db.KeyRange().above_high(("anything",1)) is False
+
+RANGE_QUERIES = [
+    "SELECT k, id FROM t WHERE k > 10 AND k <= 200 ORDER BY k",
+    "SELECT k, id FROM t WHERE k >= 10 AND k < 200 ORDER BY k DESC",
+    "SELECT k FROM t WHERE k BETWEEN -50 AND 'k00100' ORDER BY k",
+    "SELECT k FROM t WHERE k < 0 ORDER BY k DESC",
+    "SELECT k FROM t WHERE k > 'k02990' ORDER BY k",
+    "SELECT k, id FROM t WHERE k >= 'k02000' ORDER BY k DESC",
+    "SELECT k FROM t WHERE k = 7.5",
+    "SELECT g, k FROM t WHERE g = 12 AND k > 0 AND k < 'k01000' ORDER BY k",
+    "SELECT g, k FROM t WHERE g = 12 ORDER BY g, k DESC",
+    "SELECT g, k FROM t WHERE g BETWEEN 10 AND 12 ORDER BY g",
+    "SELECT count(*) FROM t WHERE k > 100 AND k > 50 AND k < 'k' AND k <= 'k00500'",
+]
+
+@pytest.mark.parametrize("sql",RANGE_QUERIES)
+def test_range_scans_match_sqlite(index_db,compare,sql):
+    with connect(index_db) as conn:
+        plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN "+sql))
+    assert "INDEX" in plan, plan
+    compare(index_db,sql,ordered="ORDER BY" in sql and "g, k" not in sql)
+
+@pytest.fixture
+def like_db(make_db):
+    rng = random.Random(9)
+    rows = [(n,n/4,str(n),rng.choice([n,str(n),n+0.5])) for n in (rng.randrange(-50,3000) for _ in range(2000))]
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, a INTEGER, r REAL, s TEXT, x);"
+                   "CREATE INDEX idx_t_a ON t (a);"
+                   "CREATE INDEX idx_t_r ON t (r);"
+                   "CREATE INDEX idx_t_s ON t (s);"
+                   "CREATE INDEX idx_t_x ON t (x);",
+                   [("INSERT INTO t (a, r, s, x) VALUES (?,?,?,?)",rows)])
+
+@pytest.mark.parametrize("col, seeks",[("a",False),("r",False),("s",True),("x",False)])
+def test_like_prefix_seeks_only_text_columns(like_db,compare,col,seeks):
+    # Numbers sort before text in an index, so a text range would skip them
+    for pattern in ("1%","12%","-3%","2.5%"):
+        sql = "SELECT id FROM t WHERE %s LIKE '%s'" % (col,pattern)
+        with connect(like_db) as conn:
+            plan = " ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN "+sql))
+        assert ("SEARCH" in plan) == seeks, plan
+        assert ("(s>? AND s<?)" in plan) == seeks, plan
+        compare(like_db,sql)
+
+@pytest.mark.parametrize("sql, tree",[("SELECT pad FROM t WHERE id = 2500","t"),("SELECT id FROM t WHERE k = 'k01500'","idx_t_k")])
+def test_profile_levels_read_only_the_query_pages(index_db,sql,tree):
+    with connect(index_db,use_mmap=False,profile=True) as conn:
+        pg_cache = conn.page_cache
+        before = pg_cache.hits+pg_cache.misses
+        cursor = conn.execute(sql)
+        cursor.fetchall()
+        pages = cursor.stats.as_dict()["pages"]
+        # Splitting the reads by level looks again at the query's own pages at most
+        assert pg_cache.hits+pg_cache.misses-before <= 2*pages["reads"]
+        by_level = pages["by_level"]
+        assert sum(map(sum,by_level.values())) == pages["reads"]
+        # One page of each level on the way down to the key
+        entry = conn.catalog.tables.get(tree) or conn.catalog.indexes[tree]
+        assert by_level[tree] == [1]*len(list(db.btree_levels(entry["pg_num"],pg_cache)))
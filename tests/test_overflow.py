@@ -0,0 +1,58 @@
+import pytest
+
+import app.main as db
+
+def payload_lengths(page_size,is_table):
+    # Text lengths putting the record payload either side of where SQLite starts
+    # spilling and where the local part wraps round an overflow page
+    max_local = db.max_local_payload(page_size,is_table)
+    min_local = ((page_size-12)*32//255)-23
+    lengths = set()
+    for edge in (max_local,min_local+(page_size-4),min_local+2*(page_size-4),max_local+(page_size-4)):
+        lengths.update(range(edge-16,edge+8))
+    lengths.update((1,page_size*3,page_size*5+17))
+    return sorted(length for length in lengths if length > 0)
+
+@pytest.fixture(params=[512,1024,4096])
+def overflow_db(request,make_db):
+    page_size = request.param
+    rows = []
+    for length in payload_lengths(page_size,True)+payload_lengths(page_size,False):
+        rows.append(("%07d" % length+"x"*(length-7) if length >= 7 else "y"*length,length,length%13))
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, body TEXT, size INTEGER, tail INTEGER);"
+                   "CREATE INDEX idx_t_body ON t (body);"
+                   "CREATE TABLE b (id INTEGER PRIMARY KEY, data BLOB, tail INTEGER);",
+                   [("INSERT INTO t (body, size, tail) VALUES (?,?,?)",rows),
+                    ("INSERT INTO b (data, tail) VALUES (?,?)",[(bytes(range(256))*(size//256+1),tail) for body, size, tail in rows])],
+                   page_size=page_size)
+
+def test_local_payload_size_follows_sqlite():
+    # Worked out by hand from the file format rules for 4096 byte pages, where
+    # min_local is 489 and each overflow page holds 4092 bytes
+    assert db.max_local_payload(4096,True) == 4061
+    assert db.max_local_payload(4096,False) == 1002
+    assert db.local_payload_size(4061,4096,True) == 4061
+    assert db.local_payload_size(4062,4096,True) == 489
+    assert db.local_payload_size(5000,4096,True) == 908
+    assert db.local_payload_size(4581,4096,True) == 4581-4092
+    assert db.local_payload_size(8153,4096,True) == 4061
+    assert db.local_payload_size(8154,4096,True) == 489
+    assert db.local_payload_size(1002,4096,False) == 1002
+    assert db.local_payload_size(1003,4096,False) == 489
+
+@pytest.mark.parametrize("sql",[
+    "SELECT id, body, size, tail FROM t",
+    "SELECT id, tail FROM t",
+    "SELECT id FROM t WHERE tail = 5",
+    "SELECT size FROM t WHERE body LIKE '0001%'",
+    "SELECT id, data, tail FROM b",
+    "SELECT tail FROM b WHERE tail > 6",
+])
+def test_overflow_table_rows_match_sqlite(overflow_db,compare,sql):
+    compare(overflow_db,sql)
+
+def test_overflow_index_entries_match_sqlite(overflow_db,compare):
+    compare(overflow_db,"SELECT body FROM t ORDER BY body",ordered=True)
+    compare(overflow_db,"SELECT body FROM t ORDER BY body DESC",ordered=True)
+    for size in payload_lengths(512,False)[:5]+[3000]:
+        compare(overflow_db,"SELECT id, size FROM t WHERE body >= ? ORDER BY body LIMIT 3",("%07d" % size,),ordered=True)
@@ -0,0 +1,51 @@
+import random
+import pytest
+
+import app.sql_parser as sp
+from app.dbapi import connect
+
+@pytest.fixture
+def param_db(make_db):
+    rng = random.Random(3)
+    names = ["ann","Ann","bob","carl","dora",None,"10","7"]
+    rows = [(rng.choice(names),rng.choice([None,1,7,10,"7",2.5]),str(rng.randrange(20)),rng.randrange(5)) for _ in range(600)]
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT COLLATE NOCASE, v, code TEXT, g INTEGER);"
+                   "CREATE INDEX idx_t_name ON t (name);"
+                   "CREATE INDEX idx_t_code ON t (code);"
+                   "CREATE TABLE u (id INTEGER PRIMARY KEY, t_id INTEGER, label TEXT);",
+                   [("INSERT INTO t (name, v, code, g) VALUES (?,?,?,?)",rows),
+                    ("INSERT INTO u (t_id, label) VALUES (?,?)",[(rng.randrange(1,700),rng.choice(names)) for _ in range(300)])])
+
+@pytest.mark.parametrize("sql, param_sets",[
+    ("SELECT id FROM t WHERE name = ?",[("ann",),("ANN",),("zed",),(None,),(7,)]),
+    ("SELECT id FROM t WHERE code = ?",[("7",),(7,),(7.0,),("07",)]),
+    ("SELECT id FROM t WHERE code > ? AND code <= ?",[("1","3"),(1,3),("9",None)]),
+    ("SELECT id FROM t WHERE v = ?",[(7,),("7",),(7.0,),(2.5,)]),
+    ("SELECT id FROM t WHERE id = ?",[(5,),("5",),(5.0,),(5.5,),("x",),(None,)]),
+    ("SELECT id FROM t WHERE id BETWEEN ? AND ?",[(10,20),("10","20"),(20,10)]),
+    ("SELECT id FROM t WHERE name IN (?, ?) AND g = ?",[("ann","bob",1),("DORA",None,2)]),
+    ("SELECT id FROM t WHERE name LIKE ?",[("a%",),("%o%",),("_ob",),(7,),(None,)]),
+    ("SELECT id FROM t WHERE name NOT LIKE ?",[("a%",),(10,),(None,)]),
+    ("SELECT id FROM t WHERE name = ? OR v = ?",[("carl",1),(None,None)]),
+    ("SELECT g, count(*) FROM t WHERE code < ? GROUP BY g HAVING count(*) > ?",[("5",10),(5,0)]),
+    ("SELECT name FROM t WHERE g = ? ORDER BY name, id LIMIT 5",[(1,),(2,)]),
+    ("SELECT t.id, u.label FROM t JOIN u ON u.t_id = t.id WHERE t.g = ? AND u.label = ?",[(1,"ann"),(3,"dora")]),
+])
+def test_bound_statements_match_sqlite(param_db,compare,sql,param_sets):
+    # The same statement is run with every set of values, reusing its cached plan
+    for params in param_sets:
+        compare(param_db,sql,params,ordered="ORDER BY" in sql)
+
+def test_prepared_statement_is_reused(param_db):
+    with connect(param_db) as conn:
+        first = conn.execute("SELECT id FROM t WHERE name = ?",("ann",)).fetchall()
+        stmts = len(conn.catalog.statements)
+        assert conn.execute("SELECT id FROM t WHERE name = ?",("ann",)).fetchall() == first
+        assert conn.execute("SELECT id FROM t WHERE name = ?",("bob",)).fetchall() != first
+        assert len(conn.catalog.statements) == stmts
+
+@pytest.mark.parametrize("params",[(),("ann","bob")])
+def test_wrong_number_of_values(param_db,params):
+    with connect(param_db) as conn:
+        with pytest.raises(sp.UnboundParameterError):
+            conn.execute("SELECT id FROM t WHERE name = ?",params).fetchall()
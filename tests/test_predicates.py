@@ -0,0 +1,62 @@
+import random
+import pytest
+
+import app.main as db
+import app.sql_parser as sp
+
+VALUES = [None,0,1,-1,7,7.0,7.5,-300,70000,2**40,-2**40,2**62,"","7","07","abc","ABC","abd","a%c","a_c","abcdef",b"",b"abc",b"\x00\xff"]
+
+@pytest.fixture
+def pred_db(make_db):
+    rng = random.Random(11)
+    rows = [tuple(rng.choice(VALUES) for _ in range(5)) for _ in range(1500)]
+    # No indexes, so every query is a table scan through the compiled predicate
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, i INTEGER, r REAL, s TEXT, n NUMERIC, x);",
+                   [("INSERT INTO t (i, r, s, n, x) VALUES (?,?,?,?,?)",rows)])
+
+CONDITIONS = [
+    "i = 7", "i = '7'", "i != 7", "i < 7", "i >= 7.5", "i > 'a'", "i <= -1",
+    "r = 7", "r > 0", "r < '7.5'", "r BETWEEN -1 AND 7",
+    "s = 'abc'", "s = 7", "s != 'abc'", "s > 'abc'", "s < 7", "s BETWEEN 'a' AND 'abd'",
+    "n = 7", "n = '7'", "n > '07'", "n IN (1, 7, 'abc')",
+    "x = 7", "x = '7'", "x = 7.5", "x < 'a'", "x >= 'abc'", "x IN (0, '', 'abc')",
+    "s LIKE 'ab%'", "s LIKE 'AB%'", "s LIKE 'a_c'", "s LIKE 'a%c'", "x LIKE '7%'", "i LIKE '7'",
+    "r LIKE '7.%'", "r LIKE '7'", "r LIKE '-1.0'", "r NOT LIKE '%.0'", "r LIKE '4.6%e+18'", "r LIKE '10995%.0'",
+    "s NOT LIKE 'ab%'", "i NOT IN (1, 7)", "x NOT IN (1, NULL)", "s NOT BETWEEN 'a' AND 'b'",
+    "i IS NULL", "x IS NOT NULL", "i = NULL", "i != NULL",
+    "i BETWEEN NULL AND 5", "i NOT BETWEEN NULL AND 5", "NOT (i BETWEEN 5 AND NULL)",
+    "r NOT BETWEEN 0 AND NULL", "s NOT BETWEEN 'abc' AND NULL", "x NOT BETWEEN NULL AND NULL",
+    "NOT (x BETWEEN NULL AND 'a') AND i > 0", "id NOT BETWEEN NULL AND 100",
+    "s = 'abc' COLLATE NOCASE", "s = 'ABC' COLLATE NOCASE", "s > 'ABC' COLLATE NOCASE",
+    "x IN ('ABC', 'a%c') COLLATE NOCASE",
+    "id = 10", "id > 1400", "id BETWEEN 5 AND 9", "id IN (1, 2, 1500)",
+    "i = 7 AND s = 'abc'", "i = 7 OR s = 'abc'", "NOT (i = 7 OR s > 'abc')",
+    "(i > 0 OR r < 0) AND NOT x IS NULL", "NOT (i = 7 AND (x = 'abc' OR n IS NULL))",
+]
+
+def parse_cond(where,tdesc):
+    cond = sp.parse("SELECT * FROM t WHERE "+where).cond
+    db.bind_affinity(cond,tdesc)
+    return cond
+
+@pytest.mark.parametrize("where",CONDITIONS)
+def test_compiled_matches_interpreted(pred_db,open_db,compare,where):
+    pg_cache, catalog = open_db(pred_db)
+    table = catalog.tables["t"]
+    tdesc = table["query"]
+    cols = list(tdesc.col_names)
+    cond = parse_cond(where,tdesc)
+    compiled = list(db.travel_tables(table["pg_num"],pg_cache,db.ScanPlan(tdesc,cols,cond)))
+    rows = db.travel_tables(table["pg_num"],pg_cache,db.ScanPlan(tdesc,cols))
+    interpreted = [row for row in rows if sp.comp_record(cond,dict(zip(cols,row)))]
+    assert compiled == interpreted
+    # Decoded rows, as in index entries and joins, go through compile_entry_filter
+    entry_filter = db.compile_entry_filter(cond,{col: pos for pos, col in enumerate(cols)},tdesc)
+    assert [row for row in db.travel_tables(table["pg_num"],pg_cache,db.ScanPlan(tdesc,cols)) if entry_filter(row)] == interpreted
+    assert [tuple(row) for row in compiled] == compare(pred_db,"SELECT * FROM t WHERE "+where+" ORDER BY id",ordered=True)
+
+@pytest.mark.parametrize("where",CONDITIONS)
+def test_batch_masks_match_sqlite(pred_db,compare,monkeypatch,where):
+    # Aggregate scans filter whole ColumnBatches with batch_mask
+    monkeypatch.setattr(db,"BATCH_DECODE","1")
+    compare(pred_db,"SELECT count(*), max(r), min(x) FROM t WHERE "+where)
@@ -0,0 +1,51 @@
+import itertools, sqlite3
+import pytest
+
+import app.main as db
+
+# One value of each serial type: NULL, 1, 2, 3, 4, 6 and 8 byte integers, a real,
+# the constants 0 and 1, blobs and text
+SERIAL_VALUES = [None,-100,100,-30000,30000,-8000000,8000000,-2**31,2**31-1,-2**40,2**40,-2**62,2**62,
+                 -1.5,0.25,0,1,b"",b"\x00\x01","","text"]
+
+@pytest.fixture
+def layout_db(make_db):
+    # Every pair of serial types for a and c, each row twice so its header repeats
+    rows = [(a,7,c,c) for a, c in itertools.product(SERIAL_VALUES,repeat=2)]*2
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, a, b INTEGER, c REAL, d);",
+                   [("INSERT INTO t (a, b, c, d) VALUES (?,?,?,?)",rows)])
+
+def test_cached_layouts_decode_like_first_reads(layout_db,open_db):
+    pg_cache, catalog = open_db(layout_db)
+    table = catalog.tables["t"]
+    tdesc = table["query"]
+    expected = sqlite3.connect(layout_db).execute("SELECT * FROM t").fetchall()
+    for cols in (tdesc.col_names,["d","a"],["c"],["id","c"]):
+        plan = db.ScanPlan(tdesc,list(cols))
+        wanted = [[row[tdesc.col_pos[col]] for col in cols] for row in expected]
+        # The first scan reads every header twice and caches a layout for it,
+        # the second decodes every row from the cached layouts
+        assert list(db.travel_tables(table["pg_num"],pg_cache,plan)) == wanted
+        assert len(plan._layouts) > len(SERIAL_VALUES)
+        assert list(db.travel_tables(table["pg_num"],pg_cache,plan)) == wanted
+
+def test_layout_cache_limit(layout_db,open_db,monkeypatch):
+    monkeypatch.setattr(db,"LAYOUT_CACHE_SIZE",8)
+    pg_cache, catalog = open_db(layout_db)
+    table = catalog.tables["t"]
+    tdesc = table["query"]
+    plan = db.ScanPlan(tdesc,list(tdesc.col_names))
+    expected = sqlite3.connect(layout_db).execute("SELECT * FROM t").fetchall()
+    for _ in range(2):
+        assert [tuple(row) for row in db.travel_tables(table["pg_num"],pg_cache,plan)] == expected
+    assert len(plan._layouts) == 8
+
+@pytest.mark.parametrize("sql",[
+    "SELECT * FROM t",
+    "SELECT a, c FROM t WHERE b = 7",
+    "SELECT d FROM t WHERE a > 0",
+    "SELECT id, c FROM t WHERE c < 1",
+    "SELECT a, d FROM t WHERE d = 'text' OR a IS NULL",
+])
+def test_layout_queries_match_sqlite(layout_db,compare,sql):
+    compare(layout_db,sql)
@@ -0,0 +1,70 @@
+import asyncio, json, sqlite3
+import pytest
+
+from app.server import QueryServer
+
+@pytest.fixture
+def server_db(make_db):
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, name TEXT, v INTEGER, pad TEXT);",
+                   [("INSERT INTO t (name, v, pad) VALUES (?,?,?)",[("n%d" % (idx%40),idx,"x"*500) for idx in range(3000)])])
+
+async def ask(address,*commands):
+    # Replies to each command: its rows, then the closing {"rows": n} or other reply
+    reader, writer = await asyncio.open_unix_connection(address)
+    replies = []
+    for command in commands:
+        writer.write(command.encode()+b"\n")
+        rows = []
+        while isinstance(line := json.loads(await reader.readline()),list):
+            rows.append(tuple(line))
+        replies.append((rows,line))
+    writer.close()
+    return replies
+
+def run_server(db_path,tmp_path,client):
+    async def main():
+        q_server = QueryServer(db_path,workers=3)
+        address = str(tmp_path/"server.sock")
+        try:
+            async with await q_server.start(address):
+                return await client(q_server,address)
+        finally:
+            q_server.close()
+    return asyncio.run(main())
+
+def test_clients_share_one_page_cache(server_db,tmp_path):
+    sql = "SELECT id, v FROM t WHERE name = 'n7'"
+    expected = sqlite3.connect(server_db).execute(sql).fetchall()
+    async def client(q_server,address):
+        replies = await asyncio.gather(*(ask(address,sql) for _ in range(6)))
+        return replies, (await ask(address,".stats"))[0][1]["stats"]
+    replies, stats = run_server(server_db,tmp_path,client)
+    for [(rows, reply)] in replies:
+        assert sorted(rows) == expected and reply == {"rows":len(expected)}
+    assert stats["queries"] == 6 and stats["active"] == 0
+    # Every page after the first scan is a hit in the one cache all queries read
+    cache = stats["cache"]
+    if cache["policy"] != "mmap":
+        assert cache["hits"] >= 5*cache["misses"]
+
+def test_write_swaps_the_cache(server_db,tmp_path):
+    async def client(q_server,address):
+        reader, writer = await asyncio.open_unix_connection(address)
+        # A query left part way, its rows more than the socket buffers hold,
+        # keeps the cache it started on
+        writer.write(b"SELECT id, pad FROM t\n")
+        await reader.readline()
+        old = q_server.pg_cache
+        writer_conn = sqlite3.connect(server_db)
+        writer_conn.execute("UPDATE t SET v = -1 WHERE id = 1")
+        writer_conn.commit()
+        writer_conn.close()
+        [(rows, reply)] = await ask(address,"SELECT v FROM t WHERE id = 1")
+        assert rows == [(-1,)] and q_server.pg_cache is not old
+        assert old in q_server._running
+        writer.close()
+        while q_server.active:
+            await asyncio.sleep(0.01)
+        return q_server
+    q_server = run_server(server_db,tmp_path,client)
+    assert not q_server._running
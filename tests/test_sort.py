@@ -0,0 +1,64 @@
+import functools, random
+import pytest
+
+import app.main as db
+
+@pytest.fixture
+def spills(monkeypatch):
+    # Counts the runs external_sort writes to disk
+    runs = []
+    spill_run = db._spill_run
+    def counting_spill(rows):
+        runs.append(len(rows))
+        return spill_run(rows)
+    monkeypatch.setattr(db,"_spill_run",counting_spill)
+    return runs
+
+@pytest.mark.parametrize("count",[0,1,6,7,8,49,50,333])
+@pytest.mark.parametrize("reverse",[False,True])
+def test_external_sort_matches_sorted(spills,count,reverse):
+    rng = random.Random(count)
+    rows = [(rng.randrange(20),idx) for idx in range(count)]
+    key = lambda row: row[0]
+    got = list(db.external_sort(rows,key,reverse,run_rows=7))
+    # Stable in both directions, as list.sort is
+    assert got == sorted(rows,key=key,reverse=reverse)
+    assert spills == [7]*(count//7)
+
+def test_external_sort_closes_runs_when_dropped(monkeypatch):
+    runs = []
+    spill_run = db._spill_run
+    monkeypatch.setattr(db,"_spill_run",lambda rows: runs.append(spill_run(rows)) or runs[-1])
+    rows = db.external_sort(((idx%5,idx) for idx in range(100)),lambda row: row[0],run_rows=10)
+    assert next(rows) == (0,0)
+    assert len(runs) == 10 and not any(run.closed for run in runs)
+    rows.close()
+    assert all(run.closed for run in runs)
+
+@pytest.fixture
+def sort_db(make_db):
+    rng = random.Random(5)
+    words = ["apple","Apple","APPLE","banana","Banana","cherry",None,"","b"]
+    rows = [(rng.choice(words),rng.choice([None,1,2.5,-3,"7",b"\x01"]),rng.randrange(100)) for _ in range(700)]
+    return make_db("CREATE TABLE t (id INTEGER PRIMARY KEY, s TEXT, v, n INTEGER);",
+                   [("INSERT INTO t (s, v, n) VALUES (?,?,?)",rows)])
+
+@pytest.mark.parametrize("sql",[
+    "SELECT id, s FROM t ORDER BY s, id",
+    "SELECT id, s FROM t ORDER BY s DESC, id DESC",
+    "SELECT id, s FROM t ORDER BY s COLLATE NOCASE, id",
+    "SELECT id, v FROM t ORDER BY v DESC, id",
+    "SELECT id, n, s FROM t WHERE n > 20 ORDER BY n, s DESC, id",
+    "SELECT s, count(*) FROM t GROUP BY s ORDER BY count(*) DESC, s",
+])
+def test_order_by_spilled_sort_matches_sqlite(sort_db,compare,spills,monkeypatch,sql):
+    monkeypatch.setattr(db,"external_sort",functools.partial(db.external_sort,run_rows=16))
+    compare(sort_db,sql,ordered=True)
+    assert spills or "GROUP BY" in sql
+
+@pytest.mark.parametrize("limit",["LIMIT -1 OFFSET 690","LIMIT -1 OFFSET 0","LIMIT 5 OFFSET -3","LIMIT 690, -1",
+                                  "LIMIT +4 OFFSET +2","LIMIT -1"])
+def test_signed_limit_matches_sqlite(sort_db,compare,limit):
+    # A negative LIMIT means no limit and a negative OFFSET none
+    compare(sort_db,"SELECT id, s FROM t ORDER BY s, id "+limit,ordered=True)
+    compare(sort_db,"SELECT id FROM t "+limit,ordered=True)